@@ -0,0 +1,70 @@
+"""
+Per-request debug artifacts.
+
+A verification can be captured for later inspection, either on request
+(X-Debug-Artifact header) or by sampling: the detectors record the ROI
+luminance curve and the per-band energy traces, the matcher its decision for
+every expected event. Captures are stored as gzipped JSON, one file per job,
+and only the newest `keep` are retained. Nothing is recorded for uncaptured
+requests.
+"""
+import gzip
+import json
+import os
+import re
+from typing import Optional
+
+from logs import compact
+
+# Captures kept on disk (oldest are deleted first)
+DEBUG_ARTIFACT_KEEP = 200
+
+_ARTIFACT_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class ArtifactStore:
+    """Debug artifacts in `directory`, by job id. Blocking; call from a thread pool."""
+
+    def __init__(self, directory: str, keep: int = DEBUG_ARTIFACT_KEEP):
+        self.directory = directory
+        self.keep = max(1, keep)
+        self.saved = 0
+
+    def _path(self, artifact_id: str) -> str:
+        if not _ARTIFACT_ID.match(artifact_id):
+            raise ValueError(f"Invalid artifact id: {artifact_id!r}")
+        return os.path.join(self.directory, f"{artifact_id}.json.gz")
+
+    def save(self, artifact_id: str, artifact: dict) -> int:
+        """Write `artifact` (floats rounded, numpy values unwrapped); returns the compressed size."""
+        os.makedirs(self.directory, exist_ok=True)
+        data = gzip.compress(json.dumps(compact(artifact), separators=(",", ":")).encode(), compresslevel=6)
+        path = self._path(artifact_id)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        self.saved += 1
+        self._prune()
+        return len(data)
+
+    def load(self, artifact_id: str) -> Optional[dict]:
+        try:
+            path = self._path(artifact_id)
+        except ValueError:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return json.loads(gzip.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+
+    def _prune(self):
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".json.gz")]
+        if len(entries) <= self.keep:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.keep]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -1,91 +1,547 @@
 import librosa
 import numpy as np
-from typing import List, Tuple
+from bisect import bisect_left
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
-def detect_chirps(audio_path: str, target_freqs: List[float], tolerance: float = 50.0) -> List[float]:
+from logs import DEBUG, get_logger
+
+N_FFT = 2048
+HOP_LENGTH = 512
+CLUSTER_RADIUS = 0.2  # seconds
+# Bins measured on each side of a target band by the goertzel engine so a
+# target only counts when it dominates its neighbourhood
+GUARD_BINS = 3
+# Hops per block consumed by the streaming engine (~0.74s at 44.1 kHz)
+STREAM_BLOCK_HOPS = 64
+# Noise sampled on each side of an analysis window for its local threshold
+BACKGROUND_S = 0.25
+# Filter banks kept per worker process (one per challenge's frequency set)
+FILTER_BANK_CACHE_SIZE = 64
+_NO_END = np.iinfo(np.int64).max // 2
+
+ENGINES = ("stft", "goertzel")
+
+log = get_logger("audio")
+
+# target -> [(time, peak_freq, peak_mag)]
+Matches = Dict[float, List[Tuple[float, float, float]]]
+
+def detect_chirps(audio: Union[str, np.ndarray], target_freqs: List[float], tolerance: float = 50.0,
+                  sr: Optional[int] = None, engine: str = "stft",
+                  max_duration_s: Optional[float] = None,
+                  windows: Optional[List[Tuple[float, float]]] = None) -> List[float]:
     """
-    Detects timestamps of target frequencies in the audio file.
+    Detects timestamps of target frequencies in the audio.
+    `audio` is either a path to an audio file or mono PCM samples at `sr` Hz
+    (as produced by ingest.decode_clip).
+    engine: "stft" computes the full spectrogram (reference mode); "goertzel"
+    only measures the target bands plus a few guard bins around them, in
+    fixed-size blocks (see ChirpStream).
+    Only the first `max_duration_s` seconds are analyzed, if set.
+    `windows` restricts the goertzel engine to [(start_s, end_s)] spans with
+    a local threshold each (the reference STFT always analyzes everything).
     Returns a list of timestamps (seconds) where the target frequencies were strongest.
     """
-    # Load audio
-    y, sr = librosa.load(audio_path, sr=None)
-    print(f"[AUDIO] Loaded audio: sr={sr}, duration={len(y)/sr:.2f}s")
-    
-    # Compute STFT
-    n_fft = 2048
-    hop_length = 512
-    D = librosa.stft(y, n_fft=n_fft, hop_length=hop_length)
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown chirp detector engine: {engine}")
+    if isinstance(audio, str):
+        y, sr = librosa.load(audio, sr=None)
+    else:
+        if sr is None:
+            raise ValueError("sr is required when passing PCM samples")
+        y = np.asarray(audio, dtype=np.float32)
+    if max_duration_s is not None:
+        y = y[:int(max_duration_s * sr)]
+    log.debug("Loaded audio", sr=sr, duration_s=len(y) / sr, targets_hz=target_freqs, tolerance_hz=tolerance,
+              engine=engine)
+
+    if engine == "goertzel":
+        stream = ChirpStream(target_freqs, sr, tolerance=tolerance, windows=windows)
+        stream.feed(y)
+        return stream.finish()
+    return cluster_matches(_stft_matches(y, sr, target_freqs, tolerance), target_freqs)
+
+def _stft_matches(y: np.ndarray, sr: int, target_freqs: List[float], tolerance: float) -> Matches:
+    """Reference engine: full STFT, per-frame argmax over every bin."""
+    D = librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH)
     S = np.abs(D)
-    freqs = librosa.fft_frequencies(sr=sr, n_fft=n_fft)
-    
-    print(f"[AUDIO] Looking for frequencies: {target_freqs} Hz (tolerance ±{tolerance} Hz)")
-    
-    detected_times = []
-    
+    freqs = librosa.fft_frequencies(sr=sr, n_fft=N_FFT)
+
     # Use a more lenient threshold: mean + 1 std dev
     mean_mag = np.mean(S)
     std_mag = np.std(S)
     frame_threshold = mean_mag + std_mag
-    print(f"[AUDIO] Frame magnitude: mean={mean_mag:.4f}, std={std_mag:.4f}, threshold={frame_threshold:.4f}")
-    
+    log.debug("Frame magnitude", mean=mean_mag, std=std_mag, threshold=frame_threshold)
+
     # For each time frame, find the peak frequency
     matches_by_freq = {freq: [] for freq in target_freqs}
     all_detections = []  # Track all potential matches for debugging
-    
+
     for i in range(S.shape[1]):
         frame_mag = S[:, i]
         peak_idx = np.argmax(frame_mag)
         peak_freq = freqs[peak_idx]
         peak_mag = frame_mag[peak_idx]
-        
+
         # Check if peak matches any target
         for target in target_freqs:
             if abs(peak_freq - target) < tolerance:
-                time = librosa.frames_to_time(i, sr=sr, hop_length=hop_length)
+                time = librosa.frames_to_time(i, sr=sr, hop_length=HOP_LENGTH)
                 all_detections.append((time, target, peak_freq, peak_mag))
                 # Only record if magnitude is significant
                 if peak_mag > frame_threshold:
-                    detected_times.append(time)
                     matches_by_freq[target].append((time, peak_freq, peak_mag))
                     break
-    
+
     # Debug: show all potential matches even if below threshold
-    if all_detections and not detected_times:
-        print(f"[AUDIO] Found {len(all_detections)} potential matches below threshold:")
-        for t, target, freq, mag in all_detections[:5]:  # Show first 5
-            print(f"  {t:.3f}s: {target}Hz (actual={freq:.1f}Hz, mag={mag:.4f})")
-    
-    print(f"[AUDIO] Raw detections before clustering: {len(detected_times)}")
-    for freq, matches in matches_by_freq.items():
-        if matches:
-            print(f"  {freq}Hz: {len(matches)} frames")
-    
-    if not detected_times:
-        print("[AUDIO] No chirps detected!")
+    if all_detections and not any(matches_by_freq.values()):
+        log.debug("Potential matches below threshold", count=len(all_detections),
+                  first=[{"t": t, "target": target, "freq": freq, "mag": mag}
+                         for t, target, freq, mag in all_detections[:5]])
+    return matches_by_freq
+
+def band_bins(target: float, sr: int, tolerance: float = 50.0) -> List[int]:
+    """DFT bins (N_FFT at `sr`) whose centre lies within `tolerance` Hz of `target`."""
+    bin_hz = sr / N_FFT
+    return [k for k in range(int((target - tolerance) / bin_hz), int((target + tolerance) / bin_hz) + 2)
+            if abs(k * bin_hz - target) < tolerance]
+
+@dataclass(frozen=True)
+class FilterBank:
+    """Bins and coefficients the goertzel engine evaluates for one set of targets (read-only arrays)."""
+    bin_freqs: np.ndarray
+    rect_bins: np.ndarray
+    centre: np.ndarray
+    below: np.ndarray
+    above: np.ndarray
+    cos: np.ndarray
+    sin: np.ndarray
+    rotation: Tuple[np.ndarray, ...]
+    window_sq: np.ndarray
+    band_cols: Dict[float, np.ndarray]
+
+@lru_cache(maxsize=FILTER_BANK_CACHE_SIZE)
+def filter_bank(target_freqs: Tuple[float, ...], sr: int, tolerance: float = 50.0,
+                bands: Optional[Tuple[Tuple[int, ...], ...]] = None) -> FilterBank:
+    """
+    The target bands plus GUARD_BINS on either side, with the block-local
+    DFT basis and Hann terms over them. `bands` are the band_bins of each
+    target when already known (plans.DetectionPlan). Cached, so retries of a
+    challenge in the same worker reuse it.
+    """
+    bin_hz = sr / N_FFT
+    measured = set()
+    if bands is None:
+        bands = tuple(tuple(band_bins(target, sr, tolerance)) for target in target_freqs)
+    for band in bands:
+        if band:
+            measured.update(range(band[0] - GUARD_BINS, band[-1] + GUARD_BINS + 1))
+    bins = np.array(sorted(k for k in measured if 0 < k < N_FFT // 2), dtype=np.int64)
+    bin_freqs = bins * bin_hz
+
+    # Hann(k) = 0.5 R(k) - 0.25 R(k-1) - 0.25 R(k+1) on the rectangular-window DFT R
+    rect_bins = np.unique(np.concatenate([bins - 1, bins, bins + 1]))
+    col = {k: i for i, k in enumerate(rect_bins.tolist())}
+
+    # Block-local DFT basis (real GEMMs) and the phase rotation that places
+    # block b of a frame at offset b * HOP_LENGTH
+    blocks_per_frame = N_FFT // HOP_LENGTH
+    phase = 2 * np.pi * np.outer(np.arange(HOP_LENGTH), rect_bins) / N_FFT
+    window_sq = (librosa.filters.get_window("hann", N_FFT, fftbins=True) ** 2).astype(np.float32)
+    bank = FilterBank(
+        bin_freqs=bin_freqs,
+        rect_bins=rect_bins,
+        centre=np.array([col[k] for k in bins], dtype=np.int64),
+        below=np.array([col[k - 1] for k in bins], dtype=np.int64),
+        above=np.array([col[k + 1] for k in bins], dtype=np.int64),
+        cos=np.cos(phase).astype(np.float32),
+        sin=np.sin(phase).astype(np.float32),
+        rotation=tuple(np.exp(-2j * np.pi * rect_bins * b * HOP_LENGTH / N_FFT).astype(np.complex64)
+                       for b in range(blocks_per_frame)),
+        window_sq=window_sq.reshape(blocks_per_frame, HOP_LENGTH).T.copy(),
+        band_cols={t: np.flatnonzero(np.abs(bin_freqs - t) < tolerance) for t in target_freqs},
+    )
+    for array in (bank.bin_freqs, bank.rect_bins, bank.centre, bank.below, bank.above, bank.cos, bank.sin,
+                  bank.window_sq, *bank.rotation, *bank.band_cols.values()):
+        array.setflags(write=False)
+    return bank
+
+class ChirpStream:
+    """
+    Incremental filter-bank ("goertzel") chirp detector.
+
+    Evaluates the DFT only at the bins inside each target band
+    (|f - target| < tolerance) and GUARD_BINS on either side. Frames, window
+    and hop are identical to the STFT engine, but each hop-sized block is
+    transformed once and shared by the N_FFT / HOP_LENGTH frames overlapping
+    it, and the Hann window is applied in the frequency domain.
+
+    PCM is consumed in fixed blocks of `block_hops` hops; only the last few
+    block transforms, running power sums for the threshold and the sparse
+    per-frame candidates are kept. Samples past `max_duration_s` are ignored.
+
+    With `windows` ([(start_s, end_s)], e.g. expected event ± tolerance) only
+    frames inside a window (led by CLUSTER_RADIUS so cluster starts resolve as
+    in a full pass) are transformed, and each window gets its own threshold
+    from the frame power inside it plus BACKGROUND_S of surrounding noise.
+    Once that noise span has been read the threshold is final, so the
+    window's candidates are thresholded and clustered right away and only its
+    chirp timestamps are kept: memory is bounded by the windows, not the clip.
+    Without windows the threshold covers the whole clip, so candidates (only
+    frames where a target band dominates) are kept until finish().
+    With `trace`, the peak magnitude of every target band is kept for each
+    transformed frame (see trace()). `bands` skips deriving the band bins
+    (see filter_bank).
+    Usable directly as an ingest consumer (`on_audio`).
+    """
+
+    def __init__(self, target_freqs: List[float], sr: int, tolerance: float = 50.0,
+                 max_duration_s: Optional[float] = None, block_hops: int = STREAM_BLOCK_HOPS,
+                 windows: Optional[List[Tuple[float, float]]] = None, trace: bool = False,
+                 bands: Optional[Sequence[Sequence[int]]] = None):
+        self.target_freqs = list(target_freqs)
+        self.sr = sr
+        self.tolerance = tolerance
+        self.max_samples = int(max_duration_s * sr) if max_duration_s else None
+        self.block_samples = block_hops * HOP_LENGTH
+
+        bank = filter_bank(tuple(self.target_freqs), sr, tolerance,
+                           tuple(tuple(band) for band in bands) if bands is not None else None)
+        self.bin_freqs = bank.bin_freqs
+        self._centre, self._below, self._above = bank.centre, bank.below, bank.above
+        self.blocks_per_frame = N_FFT // HOP_LENGTH
+        self._cos, self._sin, self._rotation = bank.cos, bank.sin, bank.rotation
+        self._window_sq = bank.window_sq
+
+        # Threshold segments in frame units: (core_lo, core_hi, noise_lo, noise_hi).
+        # Without windows a single segment covers the whole clip.
+        self.windowed = windows is not None
+        if windows is None:
+            self._segments = [(0, _NO_END, 0, _NO_END)]
+        else:
+            merged = []
+            for lo, hi in sorted((max(0.0, lo - CLUSTER_RADIUS), hi) for lo, hi in windows):
+                if merged and lo <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], hi)
+                else:
+                    merged.append([lo, hi])
+            to_frame = sr / HOP_LENGTH
+            background = int(np.ceil(BACKGROUND_S * to_frame))
+            self._segments = []
+            for lo, hi in merged:
+                core_lo, core_hi = int(np.ceil(lo * to_frame)), int(np.floor(hi * to_frame))
+                self._segments.append((core_lo, core_hi, max(0, core_lo - background), core_hi + background))
+        self._segment_power = np.zeros(len(self._segments))
+        self._segment_frames = np.zeros(len(self._segments), dtype=np.int64)
+
+        # Carried state: unprocessed samples (starting with the STFT centering
+        # pad) and the transforms of the last blocks_per_frame - 1 blocks
+        self._pending: List[np.ndarray] = [np.zeros(N_FFT // 2, dtype=np.float32)]
+        self._pending_len = N_FFT // 2
+        self._dft_tail = np.zeros((0, len(bank.rect_bins)), dtype=np.complex64)
+        self._power_tail = np.zeros((0, self.blocks_per_frame), dtype=np.float32)
+
+        self.samples_seen = 0
+        self.n_frames = 0
+        self.frames_transformed = 0
+        # target -> [(frame, peak_freq, peak_mag, segment)] for dominant in-band frames
+        # of segments whose threshold is not final yet
+        self._candidates: Dict[float, List[Tuple[int, float, float, int]]] = {t: [] for t in self.target_freqs}
+        # target -> clustered chirp times from the settled segments (the first _settled ones)
+        self._chirps: Dict[float, List[float]] = {t: [] for t in self.target_freqs}
+        self._settled = 0
+        self._matched = 0
+        self._finished = False
+        # Debug trace: transformed frame indices and per-band peak magnitudes
+        self._trace_frames: Optional[List[np.ndarray]] = [] if trace else None
+        self._trace_bands: Dict[float, List[np.ndarray]] = {t: [] for t in self.target_freqs}
+        self._band_cols = bank.band_cols
+
+    def on_audio(self, samples: np.ndarray, time_s: float):
+        self.feed(samples)
+
+    def feed(self, samples: np.ndarray):
+        if self.max_samples is not None:
+            samples = samples[:max(0, self.max_samples - self.samples_seen)]
+        samples = np.asarray(samples, dtype=np.float32)
+        self.samples_seen += len(samples)
+        # Large inputs are consumed piecewise so the working set stays one block
+        for start in range(0, len(samples), self.block_samples):
+            piece = samples[start:start + self.block_samples]
+            self._pending.append(piece)
+            self._pending_len += len(piece)
+            if self._pending_len >= self.block_samples:
+                self._drain(final=False)
+
+    def _drain(self, final: bool):
+        buf = np.concatenate(self._pending)
+        step = HOP_LENGTH if final else self.block_samples
+        usable = (len(buf) // step) * step
+        self._pending = [buf[usable:]]
+        self._pending_len = len(buf) - usable
+        for start in range(0, usable, self.block_samples):
+            self._process(buf[start:min(usable, start + self.block_samples)].reshape(-1, HOP_LENGTH))
+            self._settle(final=False)
+
+    def _process(self, blocks: np.ndarray):
+        keep = self.blocks_per_frame - 1
+        # Global index of the first new block; block j feeds frames j - keep .. j
+        first_block = self.n_frames + len(self._dft_tail)
+        block_index = first_block + np.arange(len(blocks))
+        needed = np.zeros(len(blocks), dtype=bool)
+        for core_lo, core_hi, _, _ in self._segments:
+            needed |= (block_index >= core_lo) & (block_index <= core_hi + keep)
+
+        new_dft = np.zeros((len(blocks), len(self._cos[0])), dtype=np.complex64)
+        rows = np.flatnonzero(needed)
+        if len(rows) == len(blocks):
+            new_dft[:] = (blocks @ self._cos) - 1j * (blocks @ self._sin)
+        elif len(rows):
+            new_dft[rows] = (blocks[rows] @ self._cos) - 1j * (blocks[rows] @ self._sin)
+        block_dft = np.concatenate([self._dft_tail, new_dft])
+        block_power = np.concatenate([self._power_tail, (blocks * blocks) @ self._window_sq])
+        self._dft_tail = block_dft[-keep:]
+        self._power_tail = block_power[-keep:]
+        n = len(block_dft) - keep
+        if n <= 0:
+            return
+
+        frame_index = self.n_frames + np.arange(n)
+        self.n_frames += n
+        # Frames produced by the trailing pad beyond librosa's frame count don't exist
+        valid = frame_index < (1 + self.samples_seen // HOP_LENGTH) if self._finished else np.ones(n, dtype=bool)
+
+        # Per-frame one-sided spectral power via Parseval, N * sum((w x)^2) / 2
+        # (DC/Nyquist terms ignored); cheap, so it is computed for every frame
+        frame_power = np.zeros(n, dtype=np.float64)
+        for b in range(self.blocks_per_frame):
+            frame_power += block_power[b:b + n, b]
+        frame_power *= N_FFT / 2.0
+
+        core = np.zeros(n, dtype=bool)
+        segment = np.zeros(n, dtype=np.int64)
+        for s, (core_lo, core_hi, noise_lo, noise_hi) in enumerate(self._segments):
+            in_noise = valid & (frame_index >= noise_lo) & (frame_index <= noise_hi)
+            self._segment_power[s] += frame_power[in_noise].sum()
+            self._segment_frames[s] += int(in_noise.sum())
+            in_core = valid & (frame_index >= core_lo) & (frame_index <= core_hi) & ~core
+            segment[in_core] = s
+            core |= in_core
+
+        idx = np.flatnonzero(core)
+        if len(idx) == 0 or len(self.bin_freqs) == 0:
+            return
+        self.frames_transformed += len(idx)
+
+        R = np.zeros((len(idx), block_dft.shape[1]), dtype=np.complex64)
+        for b in range(self.blocks_per_frame):
+            R += self._rotation[b] * block_dft[idx + b]
+        S = np.abs(0.5 * R[:, self._centre] - 0.25 * R[:, self._below] - 0.25 * R[:, self._above])
+
+        if self._trace_frames is not None:
+            self._trace_frames.append(frame_index[idx])
+            for target, cols in self._band_cols.items():
+                self._trace_bands[target].append(S[:, cols].max(axis=1) if len(cols) else np.zeros(len(idx)))
+
+        peak_col = np.argmax(S, axis=1)
+        peak_freq = self.bin_freqs[peak_col]
+        peak_mag = S[np.arange(len(idx)), peak_col]
+
+        # Stand-in for the reference "argmax over every bin": the peak must beat
+        # its guard bins and exceed the expected maximum of a noise-only spectrum
+        # with the same frame power (~ln(n_bins) + Euler-Mascheroni times the mean)
+        n_bins_full = N_FFT // 2 + 1
+        dominant = peak_mag ** 2 > (np.log(n_bins_full) + 0.5772) * frame_power[idx] / n_bins_full
+
+        # Mirror the reference loop: the first target whose band holds the peak
+        # claims the frame (the threshold is applied once it is known)
+        claimed = ~dominant
+        for target in self.target_freqs:
+            hit = (np.abs(peak_freq - target) < self.tolerance) & ~claimed
+            claimed |= hit
+            sel = np.flatnonzero(hit)
+            self._candidates[target].extend(zip(frame_index[idx[sel]].tolist(), peak_freq[sel].tolist(),
+                                                peak_mag[sel].tolist(), segment[idx[sel]].tolist()))
+
+    def _settle(self, final: bool):
+        """
+        Thresholds and clusters the candidates of every segment whose noise
+        span has been read (all of them when `final`), in segment order, and
+        drops them. Cores are disjoint and ordered, so each target's pending
+        candidates start with the oldest unsettled segment's.
+        """
+        thresholds = None
+        while self._settled < len(self._segments) and (final or self._segments[self._settled][3] < self.n_frames):
+            s = self._settled
+            if thresholds is None:
+                thresholds = self.thresholds()
+            for target, candidates in self._candidates.items():
+                n = 0
+                while n < len(candidates) and candidates[n][3] == s:
+                    n += 1
+                chirps = self._chirps[target]
+                for i, _, mag, _ in candidates[:n]:
+                    if mag > thresholds[s]:
+                        self._matched += 1
+                        t = i * HOP_LENGTH / self.sr
+                        # Same rule as cluster_matches: a chirp starts CLUSTER_RADIUS after the previous one
+                        if not chirps or abs(t - chirps[-1]) > CLUSTER_RADIUS:
+                            chirps.append(t)
+                del candidates[:n]
+            self._settled += 1
+
+    @property
+    def analyzed_until_s(self) -> float:
+        """Time of the last frame whose candidates are final."""
+        return (self.n_frames - 1) * HOP_LENGTH / self.sr
+
+    def has_candidate_between(self, start_s: float, end_s: float) -> bool:
+        """
+        Whether any frame in [start_s, end_s] could still become a detection.
+        Clustered chirps always start on a candidate frame, so False means no
+        chirp can be reported in that window whatever the final threshold is.
+        """
+        lo = int(np.ceil(start_s * self.sr / HOP_LENGTH))
+        hi = int(np.floor(end_s * self.sr / HOP_LENGTH))
+        for candidates in self._candidates.values():
+            i = bisect_left(candidates, (lo,))
+            if i < len(candidates) and candidates[i][0] <= hi:
+                return True
+        # Settled windows only keep their chirp starts, which are what gets reported
+        for chirps in self._chirps.values():
+            i = bisect_left(chirps, start_s)
+            if i < len(chirps) and chirps[i] <= end_s:
+                return True
+        return False
+
+    def thresholds(self) -> np.ndarray:
+        """
+        Per-segment magnitude thresholds. Mean + std of the full spectrogram
+        is not available without every bin, so use its RMS (Parseval), which
+        matches it for sparse spectra.
+        """
+        n_bins_full = N_FFT // 2 + 1
+        return np.sqrt(self._segment_power / np.maximum(1, self._segment_frames * n_bins_full))
+
+    def _flush(self):
+        """Flushes the trailing pad and settles every segment."""
+        if self._finished:
+            return
+        self._finished = True
+        self._pending.append(np.zeros(N_FFT // 2 + HOP_LENGTH, dtype=np.float32))
+        self._drain(final=True)
+        # Same frame count as librosa.stft(center=True)
+        self.n_frames = min(self.n_frames, 1 + self.samples_seen // HOP_LENGTH)
+        self._settle(final=True)
+        log.debug("Band thresholds (rms)", thresholds=self.thresholds(), bins=len(self.bin_freqs),
+                  frames_transformed=self.frames_transformed, frames=self.n_frames, matched_frames=self._matched)
+
+    def finish(self) -> List[float]:
+        """Returns clustered chirp timestamps, as detect_chirps does."""
+        self._flush()
+        chirps = sorted(t for times in self._chirps.values() for t in times)
+        log.debug("Clustered detections", chirps_s=chirps)
+        return chirps
+
+    def trace(self) -> Optional[dict]:
+        """
+        Per-band energy trace recorded with `trace` (None otherwise): the peak
+        magnitude inside each target band for every transformed frame, and the
+        per-window thresholds (frame ranges in `windows`) it was compared to.
+        """
+        if self._trace_frames is None:
+            return None
+        self._flush()
+        frames = np.concatenate(self._trace_frames) if self._trace_frames else np.zeros(0, dtype=np.int64)
+        return {
+            "engine": "goertzel",
+            "frame_s": HOP_LENGTH / self.sr,
+            "frames": frames.tolist(),
+            "bands": {
+                str(target): np.concatenate(parts).tolist() if parts else []
+                for target, parts in self._trace_bands.items()
+            },
+            "windows": [[lo, min(hi, self.n_frames - 1)] for lo, hi, _, _ in self._segments],
+            "thresholds": self.thresholds().tolist(),
+        }
+
+class BufferedChirpDetector:
+    """
+    Ingest consumer for the reference STFT engine, which needs the whole
+    signal: buffers PCM up to `max_duration_s` and runs detect_chirps at the
+    end. Unlike ChirpStream its memory grows with the clip; only the goertzel
+    engine streams.
+    """
+
+    def __init__(self, target_freqs: List[float], sr: int, tolerance: float = 50.0,
+                 max_duration_s: Optional[float] = None):
+        self.target_freqs = target_freqs
+        self.sr = sr
+        self.tolerance = tolerance
+        self.max_duration_s = max_duration_s
+        self.blocks: List[np.ndarray] = []
+
+    def on_audio(self, samples: np.ndarray, time_s: float):
+        self.blocks.append(samples)
+
+    def finish(self) -> List[float]:
+        y = np.concatenate(self.blocks) if self.blocks else np.zeros(0, dtype=np.float32)
+        return detect_chirps(y, self.target_freqs, tolerance=self.tolerance, sr=self.sr,
+                             engine="stft", max_duration_s=self.max_duration_s)
+
+    def trace(self) -> Optional[dict]:
+        """The reference engine records no band trace."""
+        return None
+
+def chirp_detector(target_freqs: List[float], sr: int, engine: str = "goertzel", tolerance: float = 50.0,
+                   max_duration_s: Optional[float] = None, windows: Optional[List[Tuple[float, float]]] = None,
+                   trace: bool = False, bands: Optional[Sequence[Sequence[int]]] = None):
+    """
+    Ingest consumer for the given engine; call `.finish()` after demuxing for
+    the timestamps. `windows`, `trace` and `bands` (see filter_bank) only
+    apply to the goertzel engine.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown chirp detector engine: {engine}")
+    if engine == "goertzel":
+        return ChirpStream(target_freqs, sr, tolerance=tolerance, max_duration_s=max_duration_s, windows=windows,
+                           trace=trace, bands=bands)
+    return BufferedChirpDetector(target_freqs, sr, tolerance=tolerance, max_duration_s=max_duration_s)
+
+def cluster_matches(matches_by_freq: Matches, target_freqs: List[float]) -> List[float]:
+    """Collapses per-frame matches into one timestamp per chirp."""
+    detected = sum(len(m) for m in matches_by_freq.values())
+    if log.enabled(DEBUG):
+        log.debug("Raw detections before clustering", frames=detected,
+                  per_band={freq: len(matches) for freq, matches in matches_by_freq.items() if matches})
+
+    if not detected:
+        log.debug("No chirps detected")
         return []
-    
+
     # Cluster nearby detections per frequency (within 200ms) into single events
     # Process each frequency separately so close chirps of different frequencies aren't merged
     clustered = []
-    cluster_radius = 0.2  # seconds
-    
+
     for freq in target_freqs:
         freq_matches = matches_by_freq[freq]
         if not freq_matches:
             continue
-        
+
         # Sort by time and take the median time for this frequency
         freq_times = sorted([t for t, _, _ in freq_matches])
-        
+
         # Cluster this frequency's detections
         freq_clustered = []
         for t in freq_times:
-            if not freq_clustered or abs(t - freq_clustered[-1]) > cluster_radius:
+            if not freq_clustered or abs(t - freq_clustered[-1]) > CLUSTER_RADIUS:
                 freq_clustered.append(t)
-        
+
         # Add this frequency's clusters to the main list
         clustered.extend(freq_clustered)
-    
+
     clustered = sorted(clustered)
-    print(f"[AUDIO] Clustered detections: {[f'{t:.3f}s' for t in clustered]}")
+    log.debug("Clustered detections", chirps_s=clustered)
     return clustered
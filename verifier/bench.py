@@ -0,0 +1,248 @@
+"""
+Benchmarks for the detection pipeline.
+
+Synthesizes challenge recordings (synthetic.py: tones and ROI strobes at the
+times a real challenge derives, like test_verifier's assets) across durations,
+resolutions, frame rates, codecs and noise levels, and measures the wall
+time, CPU time and peak RSS of each stage:
+
+  decode           ingest.decode_clip, both streams in one pass
+  chirps_stft      detect_chirps on the decoded PCM, reference STFT engine
+  chirps_goertzel  detect_chirps on the decoded PCM, filter-bank engine
+  strobes          detect_strobes on the clip (video decode included)
+  analyze_match    pipeline.analyze_clip with the server's default settings, then the matcher
+                   (the worker side of /verify: no upload spooling, chain reads or pinning;
+                   loadtest.py measures the whole service)
+
+Every (clip, stage) pair runs in a fresh process, so peak RSS belongs to that
+stage alone. Results can be stored as a baseline and later runs compared
+against it; a stage regresses when its time or RSS grows by more than
+--threshold, or when it stops finding the challenge events.
+
+bench_baseline.json holds the default case set measured on a reference host
+(see its platform and cpus). Times only compare on similar hardware: in CI, save
+a baseline from the target branch on the same runner before comparing.
+
+    python bench.py                                 # vary one factor at a time around 5s 480p 30fps VP8
+    python bench.py --grid --resolutions 480p,1080p --codecs vp8,h264
+    python bench.py --save-baseline                 # write bench_baseline.json
+    python bench.py --compare                       # exit 1 on a regression
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from synthetic import CODECS, RESOLUTIONS, ROI, ClipSpec, clip_path, expected_events
+
+# Detected events must land this close to the challenge times to count as found
+FOUND_TOLERANCE_S = 0.15
+
+STAGES = ("decode", "chirps_stft", "chirps_goertzel", "strobes", "analyze_match")
+
+BASE_CASE = {"duration_s": 5.0, "resolution": "480p", "fps": 30, "codec": "vp8", "noise": 0.0}
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+# Default regression threshold (fraction), and the smallest time change worth reporting
+REGRESSION_THRESHOLD = 0.25
+MIN_TIME_DELTA_S = 0.02
+
+
+def _found(detected: List[float], times: List[float]) -> bool:
+    return all(any(abs(d - t) <= FOUND_TOLERANCE_S for d in detected) for t in times)
+
+
+def _peak_rss_mb() -> float:
+    """High-water RSS of this process (VmHWM; ru_maxrss survives fork/exec, so it can be the parent's)."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _reset_peak_rss():
+    """Restart the high-water mark from the current RSS (Linux 4.0+), so setup doesn't count."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def run_stage(stage: str, path: str, repeat: int) -> dict:
+    """Time `stage` on the clip at `path` (in the calling process) after a warm-up run; returns the median."""
+    from audio import detect_chirps
+    from ingest import AUDIO_SAMPLE_RATE, PcmCollector, decode_clip, demux
+    from matching import match_events
+    from pipeline import analyze_clip
+    from video import detect_strobes
+
+    freqs, times = expected_events()
+    samples = None
+    if stage.startswith("chirps_"):
+        pcm = PcmCollector()
+        demux(path, [pcm])
+        samples = pcm.result()
+
+    def run() -> bool:
+        if stage == "decode":
+            clip = decode_clip(path, ROI)
+            return len(clip.samples) > 0 and len(clip.luminance) > 0
+        if stage.startswith("chirps_"):
+            engine = stage.split("_", 1)[1]
+            return _found(detect_chirps(samples, freqs, sr=AUDIO_SAMPLE_RATE, engine=engine), times)
+        if stage == "strobes":
+            return _found(detect_strobes(path, ROI), times)
+        if stage == "analyze_match":
+            analysis = analyze_clip(path, freqs, times, engine="goertzel", max_duration_s=30.0, luma_step=2)
+            return analysis.early_reject is None and \
+                match_events(times, analysis.audio_peaks, analysis.strobe_peaks).ok
+        raise ValueError(f"Unknown stage {stage}")
+
+    # One untimed run first, as in a warm analysis worker (lazy imports, caches)
+    found = run()
+    _reset_peak_rss()
+    rss_before = _peak_rss_mb()
+    walls, cpus = [], []
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        found = run() and found
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    peak = _peak_rss_mb()
+    return {
+        "wall_s": round(statistics.median(walls), 4),
+        "cpu_s": round(statistics.median(cpus), 4),
+        "peak_rss_mb": round(peak, 1),
+        "rss_growth_mb": round(peak - rss_before, 1),
+        "found": found,
+    }
+
+
+def _quiet_logs():
+    import logs
+    logs.configure(level="WARNING")
+
+
+def build_cases(args) -> List[ClipSpec]:
+    axes = {
+        "duration_s": [float(v) for v in args.durations.split(",")],
+        "resolution": args.resolutions.split(","),
+        "fps": [int(v) for v in args.fps.split(",")],
+        "codec": args.codecs.split(","),
+        "noise": [float(v) for v in args.noise.split(",")],
+    }
+    for resolution in axes["resolution"]:
+        if resolution not in RESOLUTIONS:
+            raise SystemExit(f"Unknown resolution {resolution}; choose from {', '.join(RESOLUTIONS)}")
+    for codec in axes["codec"]:
+        if codec not in CODECS:
+            raise SystemExit(f"Unknown codec {codec}; choose from {', '.join(CODECS)}")
+    if args.grid:
+        return [ClipSpec(*values) for values in itertools.product(*axes.values())]
+    # One factor at a time around the base case
+    cases = [ClipSpec(**BASE_CASE)]
+    for axis, values in axes.items():
+        for value in values:
+            spec = ClipSpec(**dict(BASE_CASE, **{axis: value}))
+            if spec not in cases:
+                cases.append(spec)
+    return cases
+
+
+def compare(results: Dict[str, Dict[str, dict]], baseline: Dict[str, Dict[str, dict]],
+            threshold: float) -> List[str]:
+    """Regressions of `results` against `baseline`, one line each."""
+    regressions = []
+    for case, stages in results.items():
+        for stage, now in stages.items():
+            before = baseline.get(case, {}).get(stage)
+            if before is None:
+                continue
+            if before["found"] and not now["found"]:
+                regressions.append(f"{case} {stage}: no longer finds the challenge events")
+            for metric, min_delta in (("wall_s", MIN_TIME_DELTA_S), ("cpu_s", MIN_TIME_DELTA_S), ("peak_rss_mb", 1.0)):
+                if now[metric] > before[metric] * (1 + threshold) and now[metric] - before[metric] >= min_delta:
+                    regressions.append(f"{case} {stage}: {metric} {before[metric]} -> {now[metric]} "
+                                       f"(+{100 * (now[metric] / max(before[metric], 1e-9) - 1):.0f}%)")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the verifier's detection pipeline on synthetic clips")
+    parser.add_argument("--durations", default="5,10,30", help="clip lengths in seconds")
+    parser.add_argument("--resolutions", default=",".join(RESOLUTIONS))
+    parser.add_argument("--fps", default="24,30,60")
+    parser.add_argument("--codecs", default=",".join(CODECS))
+    parser.add_argument("--noise", default="0,0.25,0.5", help="noise amplitude relative to the tones/flashes")
+    parser.add_argument("--grid", action="store_true", help="every combination instead of one factor at a time")
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage (the median is reported)")
+    parser.add_argument("--clips-dir", help="keep synthesized clips here between runs")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true", help="exit 1 when a stage regresses against the baseline")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    stages = args.stages.split(",")
+    for stage in stages:
+        if stage not in STAGES:
+            raise SystemExit(f"Unknown stage {stage}; choose from {', '.join(STAGES)}")
+    cases = build_cases(args)
+    clips_dir = args.clips_dir or tempfile.mkdtemp(prefix="pops-bench-")
+    os.makedirs(clips_dir, exist_ok=True)
+
+    results: Dict[str, Dict[str, dict]] = {}
+    print(f"{'case':<36} {'stage':<16} {'wall_s':>8} {'cpu_s':>8} {'rss_mb':>8} {'+rss_mb':>8} found")
+    # A fresh process per stage run, so the RSS high-water mark is that stage's
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                             max_tasks_per_child=1, initializer=_quiet_logs) as pool:
+        for spec in cases:
+            path = clip_path(spec, clips_dir)
+            results[spec.name] = {}
+            for stage in stages:
+                result = pool.submit(run_stage, stage, path, args.repeat).result()
+                results[spec.name][stage] = result
+                print(f"{spec.name:<36} {stage:<16} {result['wall_s']:>8.3f} {result['cpu_s']:>8.3f} "
+                      f"{result['peak_rss_mb']:>8.1f} {result['rss_growth_mb']:>8.1f} "
+                      f"{'yes' if result['found'] else 'NO'}", flush=True)
+
+    report = {"python": sys.version.split()[0], "platform": platform.platform(), "cpus": os.cpu_count(),
+              "repeat": args.repeat, "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}; run with --save-baseline first")
+            return 2
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%} against {args.baseline}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
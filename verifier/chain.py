@@ -0,0 +1,490 @@
+"""
+Async chain reads for challenge lookup.
+
+Everything /verify needs from the chain (token owner, current challenge and
+the latest block number) goes out as one JSON-RPC batch over a pooled
+keep-alive aiohttp session, with a timeout on every round trip. Endpoints
+that reject batches are served with the same calls sent concurrently.
+Lookups for many clones at once (/verify/batch) share their batches and a
+single block number read.
+
+A background BlockTracker keeps the block height in memory, and
+ChallengeCache serves repeat lookups for a Pop clone without RPC while its
+challenge is within its block range and no ChallengeGenerated log has been
+seen for it. Given a shared.SharedStore, several server processes keep the
+cache and the block height there instead; only the process holding the
+poller lease polls the chain and scans its logs.
+"""
+import asyncio
+import dataclasses
+import itertools
+import json
+import time
+from dataclasses import dataclass, replace
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import aiohttp
+from eth_abi import decode
+from web3 import Web3
+
+from logs import get_logger
+from shared import FileLease, SharedStore
+
+# Pop contract ABI for reading challenges
+POP_ABI = json.loads('''[
+    {
+        "inputs": [],
+        "name": "currentChallenge",
+        "outputs": [
+            {"internalType": "bytes32", "name": "challengeHash", "type": "bytes32"},
+            {"internalType": "uint256", "name": "baseBlock", "type": "uint256"},
+            {"internalType": "uint256", "name": "expiresBlock", "type": "uint256"}
+        ],
+        "stateMutability": "view",
+        "type": "function"
+    },
+    {
+        "inputs": [],
+        "name": "tokenOwner",
+        "outputs": [{"internalType": "address", "name": "", "type": "address"}],
+        "stateMutability": "view",
+        "type": "function"
+    }
+]''')
+
+# Per round-trip timeout (seconds)
+RPC_TIMEOUT_S = 5.0
+# Keep-alive connections held open to the RPC endpoint
+RPC_POOL_SIZE = 8
+# Calls per JSON-RPC batch when reading many clones (providers cap batch sizes)
+MAX_BATCH_CALLS = 100
+
+# Block height polling period; Celo produces a block about every second
+BLOCK_POLL_INTERVAL_S = 1.0
+# Largest block span scanned for challenge logs in one request (longer gaps flush the cache)
+MAX_LOG_RANGE = 500
+
+EMPTY_CHALLENGE = "0x" + "00" * 32
+CHALLENGE_GENERATED_TOPIC = "0x" + bytes(Web3.keccak(text="ChallengeGenerated(bytes32,uint256,uint256)")).hex()
+
+log = get_logger("chain")
+
+
+class ChainError(Exception):
+    """The RPC endpoint failed, timed out or returned an error for a call."""
+
+
+@dataclass
+class ChallengeState:
+    token_owner: str
+    challenge_hash: str  # 0x-prefixed hex
+    base_block: int
+    expires_block: int
+    current_block: int
+
+
+def _output_types(fn_name: str) -> List[str]:
+    entry = next(e for e in POP_ABI if e.get("name") == fn_name)
+    return [o["type"] for o in entry["outputs"]]
+
+
+def _call_data(fn_name: str) -> str:
+    return "0x" + bytes(Web3.keccak(text=f"{fn_name}()")[:4]).hex()
+
+
+class ChainReader:
+    """
+    Batched JSON-RPC client. The session is created on first use inside the
+    running event loop; call close() on shutdown.
+    """
+
+    def __init__(self, rpc_url: str, timeout_s: float = RPC_TIMEOUT_S, pool_size: int = RPC_POOL_SIZE):
+        self.rpc_url = rpc_url
+        self.timeout_s = timeout_s
+        self.pool_size = pool_size
+        self.batch_supported = True
+        self.requests = 0
+        self.errors = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._ids = itertools.count(1)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout_s),
+                headers={"Content-Type": "application/json"},
+            )
+        return self._session
+
+    async def _post(self, payload) -> Any:
+        self.requests += 1
+        try:
+            async with self._get_session().post(self.rpc_url, data=json.dumps(payload)) as response:
+                if response.status != 200:
+                    raise ChainError(f"RPC HTTP {response.status}: {(await response.text())[:200]}")
+                return await response.json(content_type=None)
+        except asyncio.TimeoutError:
+            self.errors += 1
+            raise ChainError(f"RPC timed out after {self.timeout_s}s")
+        except aiohttp.ClientError as e:
+            self.errors += 1
+            raise ChainError(f"RPC request failed: {e}")
+        except ChainError:
+            self.errors += 1
+            raise
+
+    @staticmethod
+    def _result(reply: dict) -> Any:
+        if "error" in reply:
+            error = reply["error"]
+            raise ChainError(error.get("message", str(error)) if isinstance(error, dict) else str(error))
+        return reply["result"]
+
+    @classmethod
+    def _result_or_error(cls, reply: dict) -> Any:
+        try:
+            return cls._result(reply)
+        except ChainError as e:
+            return e
+
+    async def call(self, method: str, params: list) -> Any:
+        """Single JSON-RPC call."""
+        reply = await self._post({"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": params})
+        return self._result(reply)
+
+    async def batch(self, calls: List[Tuple[str, list]], return_exceptions: bool = False) -> List[Any]:
+        """
+        Send `calls` as one JSON-RPC batch and return the results in order.
+        Falls back to concurrent single calls (and stays there) if the
+        endpoint answers a batch with anything but a list of replies. With
+        `return_exceptions`, a failed call's ChainError takes its place in
+        the results instead of being raised.
+        """
+        if self.batch_supported:
+            ids = [next(self._ids) for _ in calls]
+            payload = [{"jsonrpc": "2.0", "id": i, "method": m, "params": p} for i, (m, p) in zip(ids, calls)]
+            replies = await self._post(payload)
+            if isinstance(replies, list) and len(replies) == len(calls):
+                by_id = {reply.get("id"): reply for reply in replies}
+                if all(i in by_id for i in ids):
+                    result = self._result_or_error if return_exceptions else self._result
+                    return [result(by_id[i]) for i in ids]
+            log.warning("RPC endpoint does not support batches, sending calls individually")
+            self.batch_supported = False
+        return list(await asyncio.gather(*(self.call(m, p) for m, p in calls), return_exceptions=return_exceptions))
+
+    async def block_number(self) -> int:
+        return int(await self.call("eth_blockNumber", []), 16)
+
+    @staticmethod
+    def _challenge_calls(address: str) -> List[Tuple[str, list]]:
+        return [
+            ("eth_call", [{"to": address, "data": _call_data("tokenOwner")}, "latest"]),
+            ("eth_call", [{"to": address, "data": _call_data("currentChallenge")}, "latest"]),
+        ]
+
+    @staticmethod
+    def _decode_challenge(address: str, owner_raw: str, challenge_raw: str, block: int) -> ChallengeState:
+        try:
+            (token_owner,) = decode(_output_types("tokenOwner"), bytes.fromhex(owner_raw[2:]))
+            challenge_hash, base_block, expires_block = decode(_output_types("currentChallenge"),
+                                                               bytes.fromhex(challenge_raw[2:]))
+        except Exception as e:
+            raise ChainError(f"Unexpected contract response from {address}: {e}")
+        return ChallengeState(
+            token_owner=Web3.to_checksum_address(token_owner),
+            challenge_hash="0x" + challenge_hash.hex(),
+            base_block=base_block,
+            expires_block=expires_block,
+            current_block=block,
+        )
+
+    async def read_challenge(self, pop_address: str) -> ChallengeState:
+        """Token owner, current challenge and latest block of a Pop clone, in one round trip."""
+        address = Web3.to_checksum_address(pop_address)
+        owner_raw, challenge_raw, block_raw = await self.batch(
+            self._challenge_calls(address) + [("eth_blockNumber", [])])
+        return self._decode_challenge(address, owner_raw, challenge_raw, int(block_raw, 16))
+
+    async def read_challenges(self, pop_addresses: List[str]) -> List[Union[ChallengeState, ChainError]]:
+        """
+        read_challenge for many clones: their calls and one block number go
+        out in batches of up to MAX_BATCH_CALLS, sent concurrently. A clone
+        whose calls fail gets its ChainError in place of its state.
+        """
+        addresses = [Web3.to_checksum_address(a) for a in pop_addresses]
+        per_batch = max(1, (MAX_BATCH_CALLS - 1) // 2)
+        chunks = [addresses[i:i + per_batch] for i in range(0, len(addresses), per_batch)]
+        block_raw, *replies = await asyncio.gather(
+            self.call("eth_blockNumber", []),
+            *(self.batch([c for a in chunk for c in self._challenge_calls(a)], return_exceptions=True)
+              for chunk in chunks),
+        )
+        block = int(block_raw, 16)
+        states = []
+        for chunk, results in zip(chunks, replies):
+            for address, owner_raw, challenge_raw in zip(chunk, results[0::2], results[1::2]):
+                error = next((r for r in (owner_raw, challenge_raw) if isinstance(r, Exception)), None)
+                if error is None:
+                    try:
+                        states.append(self._decode_challenge(address, owner_raw, challenge_raw, block))
+                        continue
+                    except ChainError as e:
+                        error = e
+                states.append(error if isinstance(error, ChainError) else ChainError(str(error)))
+        return states
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class BlockTracker:
+    """
+    Polls the block height in the background so expiry checks read it from
+    memory. Listeners are awaited with (first, last) for every advance before
+    the new height is published. A height older than a few poll periods is
+    refreshed directly on read. With a `store`, the process holding `lease`
+    polls and publishes the height there, and the others take it from there
+    (polling themselves only while no fresh height has been published).
+    """
+
+    def __init__(self, reader: ChainReader, interval_s: float = BLOCK_POLL_INTERVAL_S,
+                 store: Optional[SharedStore] = None, lease: Optional[FileLease] = None):
+        self.reader = reader
+        self.interval_s = interval_s
+        self.store = store
+        self.lease = lease
+        self.block: Optional[int] = None
+        self.updated_at = 0.0
+        self.listeners: List[Callable[[int, int], Awaitable[None]]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def max_age_s(self) -> float:
+        return 3 * self.interval_s
+
+    def observe(self, block: int):
+        """Record a height read elsewhere (e.g. in a challenge batch) if it is newer."""
+        if self.block is None or block >= self.block:
+            self.block = block
+            self.updated_at = time.monotonic()
+
+    async def current(self) -> int:
+        if self.block is None or time.monotonic() - self.updated_at > self.max_age_s:
+            await self.refresh()
+        return self.block
+
+    async def refresh(self):
+        """poll(), or take the height the lease holder published if it is fresh."""
+        if self.store is not None and not (self.lease is not None and self.lease.acquire()):
+            block, age_s = await self.store.block()
+            if block is not None and age_s <= self.max_age_s:
+                if self.block is None or block >= self.block:
+                    self.block = block
+                    self.updated_at = time.monotonic() - age_s
+                return
+        await self.poll()
+
+    async def poll(self):
+        block = await self.reader.block_number()
+        if self.block is not None and block > self.block:
+            for listener in self.listeners:
+                await listener(self.block + 1, block)
+        self.observe(block)
+        if self.store is not None:
+            self.store.put_block(block)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                log.warning("Block poll failed", error=str(e))
+            await asyncio.sleep(self.interval_s)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class ChallengeCache:
+    """
+    Per-Pop-clone challenge cache. An entry is served while the tracked block
+    is inside its [base_block, expires_block] range (or is still the block it
+    was read at, which also covers expired and empty challenges). It is
+    dropped on expiry or when a ChallengeGenerated log from the clone shows
+    up. Concurrent misses for one clone share a single RPC batch. With a
+    `store`, entries live there (shared by every server process) instead of
+    in memory.
+    """
+
+    def __init__(self, reader: ChainReader, tracker: BlockTracker, store: Optional[SharedStore] = None):
+        self.reader = reader
+        self.tracker = tracker
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: Dict[str, ChallengeState] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+        tracker.listeners.append(self._scan_logs)
+
+    async def _load(self, addresses: List[str]) -> Dict[str, ChallengeState]:
+        if self.store is None:
+            return {a: self._entries[a] for a in addresses if a in self._entries}
+        return {a: ChallengeState(**state) for a, state in (await self.store.get_challenges(addresses)).items()}
+
+    def _save(self, address: str, state: ChallengeState):
+        if self.store is None:
+            self._entries[address] = state
+        else:
+            self.store.put_challenge(address, dataclasses.asdict(state))
+
+    async def get(self, pop_address: str) -> ChallengeState:
+        address = Web3.to_checksum_address(pop_address)
+        current = await self.tracker.current()
+        entry = (await self._load([address])).get(address)
+        if entry is not None:
+            if entry.base_block <= current <= entry.expires_block or current == entry.current_block:
+                self.hits += 1
+                return replace(entry, current_block=current)
+            await self._invalidate([address])
+
+        self.misses += 1
+        pending = self._pending.get(address)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[address] = future
+        try:
+            state = await self.reader.read_challenge(address)
+            self.tracker.observe(state.current_block)
+            self._save(address, state)
+            future.set_result(state)
+            return state
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved here, so waiters-less failures aren't logged as unhandled
+            raise
+        finally:
+            del self._pending[address]
+
+    async def get_many(self, pop_addresses: Iterable[str]) -> Dict[str, Union[ChallengeState, Exception]]:
+        """
+        get() for many clones at once, keyed by the addresses as given. The
+        misses are read together (ChainReader.read_challenges) instead of one
+        round trip each. A clone whose lookup failed, or whose address is
+        invalid, maps to the exception.
+        """
+        current = await self.tracker.current()
+        states: Dict[str, Union[ChallengeState, Exception]] = {}
+        waiting: Dict[str, asyncio.Future] = {}
+        missing: Dict[str, List[str]] = {}
+        checksummed: Dict[str, str] = {}
+        for pop_address in dict.fromkeys(pop_addresses):
+            try:
+                checksummed[pop_address] = Web3.to_checksum_address(pop_address)
+            except ValueError as e:
+                states[pop_address] = e
+        entries = await self._load(list(set(checksummed.values())))
+        stale = []
+        for pop_address, address in checksummed.items():
+            entry = entries.get(address)
+            if entry is not None:
+                if entry.base_block <= current <= entry.expires_block or current == entry.current_block:
+                    self.hits += 1
+                    states[pop_address] = replace(entry, current_block=current)
+                    continue
+                stale.append(address)
+            self.misses += 1
+            if address in self._pending:
+                waiting[pop_address] = self._pending[address]
+            elif address in missing:
+                missing[address].append(pop_address)
+            else:
+                missing[address] = [pop_address]
+
+        await self._invalidate(list(dict.fromkeys(stale)))
+        loop = asyncio.get_running_loop()
+        futures = {address: loop.create_future() for address in missing}
+        self._pending.update(futures)
+        try:
+            try:
+                results = await self.reader.read_challenges(list(missing))
+            except Exception as e:
+                results = [e] * len(missing)
+            for (address, given), result in zip(missing.items(), results):
+                future = futures[address]
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                    future.exception()
+                else:
+                    self.tracker.observe(result.current_block)
+                    self._save(address, result)
+                    future.set_result(result)
+                for pop_address in given:
+                    states[pop_address] = result
+        finally:
+            for address, future in futures.items():
+                if not future.done():
+                    future.cancel()
+                del self._pending[address]
+
+        for pop_address, pending in waiting.items():
+            try:
+                states[pop_address] = await asyncio.shield(pending)
+            except Exception as e:
+                states[pop_address] = e
+        return states
+
+    async def _invalidate(self, addresses: List[str]):
+        if not addresses:
+            return
+        if self.store is None:
+            self.invalidations += sum(self._entries.pop(a, None) is not None for a in addresses)
+        else:
+            self.invalidations += await self.store.drop_challenges(addresses)
+
+    async def _scan_logs(self, first: int, last: int):
+        """Drop entries of clones that issued a new challenge in blocks [first, last]."""
+        cached = list(self._entries) if self.store is None else await self.store.challenge_addresses()
+        if not cached:
+            return
+        if last - first >= MAX_LOG_RANGE:
+            await self._invalidate(cached)
+            return
+        try:
+            logs = await self.reader.call("eth_getLogs", [{
+                "fromBlock": hex(first),
+                "toBlock": hex(last),
+                "address": cached,
+                "topics": [CHALLENGE_GENERATED_TOPIC],
+            }])
+        except ChainError as e:
+            # Can't tell which clones changed; start over rather than serve stale challenges
+            log.warning("Challenge log scan failed, flushing cache", error=str(e))
+            await self._invalidate(cached)
+            return
+        await self._invalidate(list({Web3.to_checksum_address(log["address"]) for log in logs}))
+
+    def stats(self) -> dict:
+        return {
+            "block": self.tracker.block,
+            "shared": self.store is not None,
+            "cached_challenges": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
@@ -2,11 +2,17 @@
 Challenge derivation logic for the verifier - must match web/src/lib/challenge.ts
 """
 
+class ChallengeError(ValueError):
+    """The hash yields no usable challenge (the web client would derive NaN timings from it)"""
+
 def hash_to_number(challenge_hash: str, offset: int = 0) -> int:
     """Convert hex hash to number at given offset"""
     # Remove 0x prefix if present
     clean_hash = challenge_hash[2:] if challenge_hash.startswith('0x') else challenge_hash
     slice_str = clean_hash[offset:offset + 8]
+    if not slice_str:
+        # parseInt('', 16) is NaN in the web client
+        raise ChallengeError(f"Challenge hash has no digits at offset {offset}")
     return int(slice_str, 16)
 
 def derive_challenge(challenge_hash: str):
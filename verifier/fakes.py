@@ -0,0 +1,149 @@
+"""
+Local stand-ins for the verifier's external services, shared by the tests
+and loadtest.py: a JSON-RPC endpoint answering the Pop clone reads chain.py
+makes, and an uploader answering pinning.py's /upload.
+"""
+import asyncio
+import random
+import time
+from typing import Iterable, List, Optional
+
+from aiohttp import web
+from eth_abi import encode
+from web3 import Web3
+
+
+def _selector(signature: str) -> str:
+    return "0x" + bytes(Web3.keccak(text=signature)[:4]).hex()
+
+
+class FakeRpc:
+    """
+    JSON-RPC stand-in: every address is a Pop clone whose currentChallenge()
+    is the last one issue()d and whose tokenOwner() is `owner`. Answers
+    eth_blockNumber, eth_call and eth_getLogs (the ChallengeGenerated logs
+    issue() recorded), singly or in batches, which are answered in reverse
+    order so clients must match replies by id. With `block_time_s` the block
+    height advances by one every that many seconds; assign `block` to jump.
+    """
+
+    def __init__(self, challenge_hash: str, base_block: int, expires_block: int, block: int,
+                 owner: str = "0x" + "11" * 20, batches: bool = True, latency_s: float = 0.0,
+                 block_time_s: Optional[float] = None):
+        self.batches = batches
+        self.latency_s = latency_s
+        self.block_time_s = block_time_s
+        self.block = block
+        self.requests: List[object] = []  # request bodies, as received
+        self.logs: List[dict] = []
+        self._outputs = {_selector("tokenOwner()"): "0x" + encode(["address"], [owner]).hex()}
+        self._runner: Optional[web.AppRunner] = None
+        self.issue(challenge_hash, base_block, expires_block)
+
+    @property
+    def block(self) -> int:
+        if self.block_time_s:
+            return self._block + int((time.monotonic() - self._block_set) / self.block_time_s)
+        return self._block
+
+    @block.setter
+    def block(self, block: int):
+        self._block = block
+        self._block_set = time.monotonic()
+
+    def issue(self, challenge_hash: str, base_block: int, expires_block: int, address: Optional[str] = None):
+        """Set the current challenge, logging ChallengeGenerated from `address` at the current block."""
+        self._outputs[_selector("currentChallenge()")] = "0x" + encode(
+            ["bytes32", "uint256", "uint256"], [bytes.fromhex(challenge_hash[2:]), base_block, expires_block]).hex()
+        if address is not None:
+            self.logs.append({"address": address.lower(), "blockNumber": hex(self.block)})
+
+    def reply(self, call: dict) -> dict:
+        method = call.get("method")
+        if method == "eth_blockNumber":
+            return {"jsonrpc": "2.0", "id": call["id"], "result": hex(self.block)}
+        if method == "eth_call" and call["params"][0].get("data") in self._outputs:
+            return {"jsonrpc": "2.0", "id": call["id"], "result": self._outputs[call["params"][0]["data"]]}
+        if method == "eth_getLogs":
+            query = call["params"][0]
+            addresses = [a.lower() for a in query["address"]]
+            logs = [log for log in self.logs if log["address"] in addresses
+                    and int(query["fromBlock"], 16) <= int(log["blockNumber"], 16) <= int(query["toBlock"], 16)]
+            return {"jsonrpc": "2.0", "id": call["id"], "result": logs}
+        return {"jsonrpc": "2.0", "id": call.get("id"), "error": {"code": -32601, "message": f"unsupported: {method}"}}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.requests.append(body)
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        if isinstance(body, list):
+            if not self.batches:
+                return web.json_response({"jsonrpc": "2.0", "id": None,
+                                          "error": {"code": -32600, "message": "batch not supported"}})
+            return web.json_response([self.reply(call) for call in reversed(body)])
+        return web.json_response(self.reply(body))
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        return f"http://{host}:{site._server.sockets[0].getsockname()[1]}/"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeUploader:
+    """
+    Uploader stand-in: /upload answers with the scripted `statuses` first,
+    then with a fake CID after `latency_s` (± `jitter` of it), or with HTTP
+    503 for an `error_rate` fraction of uploads.
+    """
+
+    def __init__(self, statuses: Iterable[int] = (), latency_s: float = 0.0, jitter: float = 0.5,
+                 error_rate: float = 0.0):
+        self.statuses = list(statuses)
+        self.latency_s = latency_s
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.uploads = 0
+        self.failed = 0
+        self.last_upload: Optional[bytes] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def upload(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        data = form["file"].file.read()
+        self.last_upload = data
+        if self.statuses:
+            self.failed += 1
+            return web.json_response({"error": "unavailable"}, status=self.statuses.pop(0))
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s * random.uniform(1 - self.jitter, 1 + self.jitter))
+        if random.random() < self.error_rate:
+            self.failed += 1
+            return web.json_response({"error": "injected failure"}, status=503)
+        self.uploads += 1
+        return web.json_response({"cid": "bafyfake" + Web3.keccak(data).hex()[2:42], "size": len(data)})
+
+    async def wallet(self, request: web.Request) -> web.Response:
+        return web.json_response({"address": "0x" + "22" * 20, "network": "fake"})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/upload", self.upload)
+        app.router.add_get("/wallet", self.wallet)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        return f"http://{host}:{site._server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
@@ -0,0 +1,218 @@
+"""
+Persistent verification history.
+
+Verdicts are stored in SQLite (WAL mode) with indexes for the /history
+filters. Writes are queued in memory and committed in batches by a
+background task, off the request path; reads flush anything queued first,
+so a verdict is visible as soon as its job completes. Every commit bumps a
+revision number, which /history uses as its ETag.
+"""
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from web3 import Web3
+
+from logs import get_logger
+
+# Queued writes are committed at least this often
+FLUSH_INTERVAL_S = 0.25
+# ...or as soon as this many are queued
+FLUSH_BATCH = 200
+# Page size limits for /history
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS verifications (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL UNIQUE,
+    verified INTEGER NOT NULL,
+    challenge TEXT,
+    pop_address TEXT,
+    token_owner TEXT,
+    ipfs_cid TEXT,
+    ipfs_status TEXT,
+    screenshot_preview TEXT,
+    timestamp INTEGER NOT NULL,
+    block_number INTEGER
+);
+CREATE INDEX IF NOT EXISTS verifications_pop ON verifications (pop_address, seq);
+CREATE INDEX IF NOT EXISTS verifications_owner ON verifications (token_owner, seq);
+CREATE INDEX IF NOT EXISTS verifications_verified ON verifications (verified, seq);
+CREATE INDEX IF NOT EXISTS verifications_timestamp ON verifications (timestamp);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0);
+"""
+
+ENTRY_FIELDS = ("job_id", "verified", "challenge", "pop_address", "token_owner", "ipfs_cid", "ipfs_status",
+                "screenshot_preview", "timestamp", "block_number")
+
+log = get_logger("history")
+
+
+class HistoryStore:
+    """
+    Batched SQLite history. All database access goes through one thread.
+    Call start() from the running loop and stop() on shutdown (which commits
+    whatever is still queued).
+    """
+
+    def __init__(self, path: str, flush_interval_s: float = FLUSH_INTERVAL_S, flush_batch: int = FLUSH_BATCH):
+        self.path = path
+        self.flush_interval_s = flush_interval_s
+        self.flush_batch = flush_batch
+        self.written = 0
+        self.flushes = 0
+        self._queue: List[Tuple[str, tuple]] = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def _db(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    # -- database (history thread only) --
+
+    def _write(self, batch: List[Tuple[str, tuple]]):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in batch:
+                conn.execute(sql, params)
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'revision'")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _revision(self) -> int:
+        return self._connection().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+
+    def _page(self, where: List[str], params: list, cursor: Optional[int], limit: int,
+              count: bool) -> Tuple[int, Optional[int], List[dict], Optional[int]]:
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            revision = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+            clause = " WHERE " + " AND ".join(where) if where else ""
+            total = conn.execute(f"SELECT COUNT(*) FROM verifications{clause}", params).fetchone()[0] if count else None
+            page_where = where + (["seq < ?"] if cursor is not None else [])
+            page_clause = " WHERE " + " AND ".join(page_where) if page_where else ""
+            rows = conn.execute(
+                f"SELECT seq, {', '.join(ENTRY_FIELDS)} FROM verifications{page_clause} ORDER BY seq DESC LIMIT ?",
+                params + ([cursor] if cursor is not None else []) + [limit + 1],
+            ).fetchall()
+        finally:
+            conn.execute("COMMIT")
+        entries = [dict(zip(ENTRY_FIELDS, row[1:]), verified=bool(row[2])) for row in rows[:limit]]
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return revision, total, entries, next_cursor
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # -- public API --
+
+    def add(self, entry: dict):
+        """Queue a verification entry (keys as in ENTRY_FIELDS)."""
+        entry = dict(entry)
+        if entry.get("pop_address"):
+            entry["pop_address"] = Web3.to_checksum_address(entry["pop_address"])
+        values = tuple(entry.get(field) for field in ENTRY_FIELDS)
+        placeholders = ", ".join("?" * len(ENTRY_FIELDS))
+        self._enqueue(f"INSERT OR REPLACE INTO verifications ({', '.join(ENTRY_FIELDS)}) VALUES ({placeholders})", values)
+
+    def update_pin(self, job_id: str, ipfs_cid: Optional[str], ipfs_status: str):
+        """Queue the pin outcome of an entry's screenshot."""
+        self._enqueue("UPDATE verifications SET ipfs_cid = ?, ipfs_status = ? WHERE job_id = ?",
+                      (ipfs_cid, ipfs_status, job_id))
+
+    def _enqueue(self, sql: str, params: tuple):
+        self._queue.append((sql, params))
+        if len(self._queue) >= self.flush_batch:
+            self._wake.set()
+
+    async def flush(self):
+        """Commit everything queued so far in one transaction."""
+        batch, self._queue = self._queue, []
+        if not batch:
+            return
+        try:
+            await self._db(self._write, batch)
+        except Exception:
+            self._queue[:0] = batch  # keep them for the next flush
+            raise
+        self.written += len(batch)
+        self.flushes += 1
+
+    async def revision(self) -> int:
+        await self.flush()
+        return await self._db(self._revision)
+
+    async def page(self, cursor: Optional[int] = None, limit: int = DEFAULT_PAGE_SIZE,
+                   pop_address: Optional[str] = None, token_owner: Optional[str] = None,
+                   verified: Optional[bool] = None, since: Optional[int] = None,
+                   count: bool = False) -> Tuple[int, Optional[int], List[dict], Optional[int]]:
+        """
+        Newest-first entries matching the filters, starting below `cursor`.
+        Returns (revision, total matching or None, entries, next cursor or None);
+        the total scans every matching row, so it is only counted with `count`.
+        Raises ValueError for a malformed address filter.
+        """
+        where, params = [], []
+        for column, value in (("pop_address", pop_address), ("token_owner", token_owner)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(Web3.to_checksum_address(value))
+        if verified is not None:
+            where.append("verified = ?")
+            params.append(int(verified))
+        if since is not None:
+            where.append("timestamp >= ?")
+            params.append(since)
+        await self.flush()
+        return await self._db(self._page, where, params, cursor, max(1, min(limit, MAX_PAGE_SIZE)), count)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._conn is not None:
+            await self._db(self._close)
+
+    def stats(self) -> dict:
+        return {"queued": len(self._queue), "written": self.written, "flushes": self.flushes}
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval_s)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error("Write failed, will retry", error=str(e))
@@ -0,0 +1,314 @@
+"""
+Single-pass ingest for uploaded clips.
+
+The container is demuxed and decoded exactly once; decoded frames are fanned
+out to in-memory consumers (mono PCM for the chirp detector, ROI luminance with
+presentation timestamps for the strobe detector, a retained frame for the
+screenshot) instead of re-reading the file with ffmpeg/ffprobe/OpenCV per stage.
+"""
+import io
+
+import av
+import numpy as np
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, List, Optional, Sequence, Tuple, Union
+
+from logs import get_logger
+
+# A path, an open binary file, or the whole clip in memory
+Source = Union[str, BinaryIO, bytes]
+
+# Same rate the old `ffmpeg -ar 44100 -ac 1` extraction produced
+AUDIO_SAMPLE_RATE = 44100
+# Middle of the 5s challenge recording, used when the container has no duration
+DEFAULT_SCREENSHOT_TIME_S = 2.5
+# Every Nth decoded frame is scored as a screenshot candidate
+SCREENSHOT_SCORE_STRIDE = 3
+# Candidates retained until the strobe times are known: the best frame of each
+# SCREENSHOT_BUCKET_S span, at most SCREENSHOT_CANDIDATES of them
+SCREENSHOT_BUCKET_S = 0.5
+SCREENSHOT_CANDIDATES = 8
+# Candidates this close to a detected strobe are skipped (the flash washes the frame out)
+STROBE_EXCLUSION_S = 0.2
+
+log = get_logger("ingest")
+
+
+class PcmCollector:
+    """Collects resampled mono float32 PCM blocks."""
+
+    def __init__(self):
+        self.blocks: List[np.ndarray] = []
+
+    def on_audio(self, samples: np.ndarray, time_s: float):
+        self.blocks.append(samples)
+
+    def result(self) -> np.ndarray:
+        if not self.blocks:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate(self.blocks)
+
+
+# 8-bit formats whose first plane is the full-resolution luma the decoder produced
+LUMA_PLANE_FORMATS = {
+    "yuv420p", "yuvj420p", "yuv422p", "yuvj422p", "yuv440p", "yuvj440p",
+    "yuv444p", "yuvj444p", "yuva420p", "nv12", "nv21", "gray",
+}
+
+
+def roi_luminance(frame: av.VideoFrame, roi: Tuple[int, int, int, int], step: int = 1) -> float:
+    """
+    Mean luminance (full-range 0-255, like a gray conversion) of the
+    (x, y, w, h) ROI of a decoded frame. For YUV frames the decoder's Y plane
+    is summed in place: no colour conversion, no full-frame array and no ROI
+    copy. `step` > 1 subsamples the ROI on both axes.
+    """
+    x, y, w, h = roi
+    fmt = frame.format.name
+    if fmt not in LUMA_PLANE_FORMATS:
+        gray = frame.to_ndarray(format="gray")
+        crop = gray[y:y+h:step, x:x+w:step]
+        return float(np.mean(crop)) if crop.size else 0.0
+
+    plane = frame.planes[0]
+    luma = np.frombuffer(plane, dtype=np.uint8).reshape(plane.height, plane.line_size)
+    crop = luma[y:y+h:step, x:min(x+w, plane.width):step]
+    if crop.size == 0:
+        return 0.0
+    mean = float(crop.sum(dtype=np.uint64)) / crop.size
+    # Limited-range (MPEG) luma spans 16-235; map it the way swscale's gray output does
+    if fmt.startswith("yuvj") or fmt == "gray" or frame.color_range == 2:
+        return mean
+    return min(255.0, max(0.0, (mean - 16.0) * 255.0 / 219.0))
+
+
+class LumaCollector:
+    """Collects the mean luminance of a fixed ROI together with frame PTS."""
+
+    def __init__(self, roi: Tuple[int, int, int, int], step: int = 1):
+        self.roi = roi
+        self.step = step
+        self.luminance: List[float] = []
+        self.times: List[float] = []
+
+    def on_video(self, frame: av.VideoFrame, time_s: float):
+        self.luminance.append(roi_luminance(frame, self.roi, self.step))
+        self.times.append(time_s)
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray]:
+        return np.asarray(self.luminance, dtype=np.float64), np.asarray(self.times, dtype=np.float64)
+
+
+def frame_quality(frame: av.VideoFrame, step: int = 2) -> float:
+    """
+    Cheap screenshot score from a decoded frame's luma (subsampled by `step`):
+    sharpness (variance of the Laplacian) scaled down for frames that are
+    under/over-exposed or have clipped highlights/shadows, like a strobe flash.
+    """
+    if frame.format.name in LUMA_PLANE_FORMATS:
+        plane = frame.planes[0]
+        luma = np.frombuffer(plane, dtype=np.uint8).reshape(plane.height, plane.line_size)[:, :plane.width]
+    else:
+        luma = frame.to_ndarray(format="gray")
+    y = luma[::step, ::step].astype(np.float32)
+    if y.shape[0] < 3 or y.shape[1] < 3:
+        return 0.0
+    laplacian = 4 * y[1:-1, 1:-1] - y[:-2, 1:-1] - y[2:, 1:-1] - y[1:-1, :-2] - y[1:-1, 2:]
+    exposure = 1.0 - abs(float(y.mean()) - 128.0) / 128.0
+    clipped = float(np.count_nonzero((y <= 5) | (y >= 250))) / y.size
+    return float(laplacian.var()) * exposure * (1.0 - clipped)
+
+
+class ScreenshotPicker:
+    """
+    Scores every `stride`-th decoded frame with frame_quality() and retains
+    the best one per time bucket (the best few buckets), so the screenshot
+    can skip frames lit by a strobe once the strobe times are known. Ties go
+    to the frame closest to the target time.
+    """
+
+    def __init__(self, target_time_s: Optional[float] = None, max_time_s: Optional[float] = None,
+                 stride: int = SCREENSHOT_SCORE_STRIDE, candidates: int = SCREENSHOT_CANDIDATES):
+        self.target_time_s = target_time_s
+        self.max_time_s = max_time_s  # decoding stops here, so aim within it
+        self.stride = max(1, stride)
+        self.candidates = max(1, candidates)
+        self.frame_time: Optional[float] = None
+        self.score: Optional[float] = None
+        self._seen = 0
+        # bucket -> (score, -distance to target, time, frame)
+        self._best: Dict[int, Tuple[float, float, float, av.VideoFrame]] = {}
+
+    def on_start(self, duration: Optional[float]):
+        if self.target_time_s is None:
+            span = min(duration, self.max_time_s) if duration and self.max_time_s else duration
+            self.target_time_s = span / 2.0 if span else DEFAULT_SCREENSHOT_TIME_S
+
+    def on_video(self, frame: av.VideoFrame, time_s: float):
+        self._seen += 1
+        if (self._seen - 1) % self.stride:
+            return
+        target = self.target_time_s if self.target_time_s is not None else DEFAULT_SCREENSHOT_TIME_S
+        candidate = (frame_quality(frame), -abs(time_s - target), time_s, frame)
+        bucket = int(time_s // SCREENSHOT_BUCKET_S)
+        current = self._best.get(bucket)
+        if current is None or candidate[:3] > current[:3]:
+            self._best[bucket] = candidate
+        if len(self._best) > self.candidates:
+            del self._best[min(self._best, key=lambda b: self._best[b][:3])]
+
+    def result(self, exclude_times: Sequence[float] = (),
+               exclude_radius_s: float = STROBE_EXCLUSION_S) -> Optional[np.ndarray]:
+        """
+        Returns the best retained frame not within `exclude_radius_s` of an
+        `exclude_times` entry (the best overall if all are) as a BGR array,
+        and sets frame_time/score.
+        """
+        if not self._best:
+            return None
+        ranked = sorted(self._best.values(), key=lambda c: c[:3], reverse=True)
+        clear = [c for c in ranked if all(abs(c[2] - t) > exclude_radius_s for t in exclude_times)]
+        score, _, self.frame_time, frame = (clear or ranked)[0]
+        self.score = round(score, 2)
+        return frame.to_ndarray(format="bgr24")
+
+
+@dataclass
+class DecodedClip:
+    samples: np.ndarray          # mono float32 PCM
+    sample_rate: int
+    luminance: np.ndarray        # mean ROI luminance per frame
+    frame_times: np.ndarray      # seconds from the first video frame
+    screenshot: Optional[np.ndarray]  # BGR frame retained for the screenshot
+    screenshot_time: Optional[float]
+    duration: Optional[float]
+
+
+def probe_duration(container: av.container.InputContainer) -> Optional[float]:
+    """Container duration in seconds, if the muxer recorded one (WebM often doesn't)."""
+    if container.duration is None or container.duration <= 0:
+        return None
+    return container.duration / av.time_base
+
+
+def _open(source: Source) -> av.container.InputContainer:
+    # In-memory uploads are read through a file object over the same buffer
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    return av.open(source)
+
+
+def probe_source(source: Source) -> Optional[float]:
+    """
+    Open the container without decoding anything. Returns its duration if
+    the muxer recorded one; raises av.error.FFmpegError (e.g.
+    InvalidDataError) for data that isn't a media container.
+    """
+    with _open(source) as container:
+        if not container.streams.video and not container.streams.audio:
+            raise av.error.InvalidDataError(0, "no audio or video stream")
+        return probe_duration(container)
+
+
+def demux(source: Source, consumers: list, sample_rate: int = AUDIO_SAMPLE_RATE,
+          max_duration_s: Optional[float] = None, skip_loop_filter: bool = False) -> Optional[float]:
+    """
+    Decode `source` once and dispatch every frame to the consumers.
+    Consumers implement `on_audio(samples, time_s)` and/or `on_video(frame, time_s)`,
+    and optionally `on_start(duration)`.
+    Audio is delivered as mono float32 at `sample_rate`; times are seconds from the
+    start of each stream. Decoding stops once every stream is past
+    `max_duration_s`, if set. `skip_loop_filter` asks the video decoder to skip
+    deblocking (roughly a third cheaper; ROI means barely move but screenshots
+    show block edges). Returns the container duration if known.
+    """
+    audio_consumers = [c for c in consumers if hasattr(c, "on_audio")]
+    video_consumers = [c for c in consumers if hasattr(c, "on_video")]
+
+    with _open(source) as container:
+        duration = probe_duration(container)
+        for consumer in consumers:
+            if hasattr(consumer, "on_start"):
+                consumer.on_start(duration)
+
+        streams = []
+        audio_stream = container.streams.audio[0] if audio_consumers and container.streams.audio else None
+        video_stream = container.streams.video[0] if video_consumers and container.streams.video else None
+        if audio_stream is not None:
+            streams.append(audio_stream)
+        if video_stream is not None:
+            video_stream.thread_type = "AUTO"
+            if skip_loop_filter:
+                video_stream.codec_context.options = {"skip_loop_filter": "all"}
+            streams.append(video_stream)
+        if not streams:
+            return duration
+
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=sample_rate)
+        audio_offset = 0  # samples delivered so far
+        video_start = None
+        video_last = None
+        video_step = 1.0 / float(video_stream.average_rate) if video_stream is not None and video_stream.average_rate else 1.0 / 30.0
+
+        def emit_audio(frames):
+            nonlocal audio_offset
+            for rf in frames:
+                samples = rf.to_ndarray().reshape(-1)
+                time_s = audio_offset / sample_rate
+                audio_offset += samples.shape[0]
+                for consumer in audio_consumers:
+                    consumer.on_audio(samples, time_s)
+
+        audio_done = audio_stream is None
+        video_done = video_stream is None
+        for packet in container.demux(*streams):
+            if audio_done and video_done:
+                break
+            for frame in packet.decode():
+                if isinstance(frame, av.AudioFrame):
+                    if audio_done:
+                        continue
+                    emit_audio(resampler.resample(frame))
+                    if max_duration_s is not None and audio_offset >= max_duration_s * sample_rate:
+                        audio_done = True
+                else:
+                    if video_done:
+                        continue
+                    # Fall back to the nominal rate when a frame carries no PTS
+                    pts_time = frame.time if frame.time is not None else (video_last + video_step if video_last is not None else 0.0)
+                    if video_start is None:
+                        video_start = pts_time
+                    video_last = pts_time
+                    time_s = pts_time - video_start
+                    if max_duration_s is not None and time_s > max_duration_s:
+                        video_done = True
+                        continue
+                    for consumer in video_consumers:
+                        consumer.on_video(frame, time_s)
+
+        if audio_stream is not None and not audio_done:
+            emit_audio(resampler.resample(None))
+
+    return duration
+
+
+def decode_clip(source: Source, roi: Tuple[int, int, int, int]) -> DecodedClip:
+    """Decode a clip once and return everything the verification stages need."""
+    pcm = PcmCollector()
+    luma = LumaCollector(roi)
+    picker = ScreenshotPicker()
+    duration = demux(source, [pcm, luma, picker])
+
+    samples = pcm.result()
+    luminance, frame_times = luma.result()
+    log.debug("Decoded clip", audio_s=len(samples) / AUDIO_SAMPLE_RATE, video_frames=len(luminance),
+              container_duration_s=duration)
+    return DecodedClip(
+        samples=samples,
+        sample_rate=AUDIO_SAMPLE_RATE,
+        luminance=luminance,
+        frame_times=frame_times,
+        screenshot=picker.result(),
+        screenshot_time=picker.frame_time,
+        duration=duration,
+    )
@@ -0,0 +1,149 @@
+"""
+In-memory verification jobs.
+
+POST /verify answers with a job id as soon as the upload is spooled. The
+verification then runs as a background task that records each stage on its
+job, so clients poll GET /verify/{job_id} or follow the server-sent events
+stream instead of holding a connection through decode, detection and the
+IPFS upload.
+"""
+import asyncio
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Finished jobs are kept this long for late pollers
+JOB_TTL_S = 600
+# Upper bound on retained jobs (oldest finished ones are dropped first)
+MAX_JOBS = 1000
+# Comment line sent on an idle event stream so proxies don't cut it
+HEARTBEAT_S = 15.0
+
+TERMINAL_STATUSES = ("complete", "failed")
+
+
+@dataclass
+class Job:
+    id: str
+    created_at: float
+    status: str = "queued"  # queued -> running -> complete | failed
+    stages: List[dict] = field(default_factory=list)  # [{"stage", "at", "data"}]
+    timings: Dict[str, float] = field(default_factory=dict)  # stage -> seconds
+    result: Optional[dict] = None  # the verdict response, extended by later stages
+    error: Optional[str] = None
+    finished_at: Optional[float] = None
+    _changed: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def done(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def snapshot(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stages": self.stages,
+            "result": self.result,
+            "error": self.error,
+            "timings": self.timings,
+        }
+
+    async def timed(self, stage: str, work: Awaitable[T]) -> T:
+        """Await `work`, recording its wall time under `stage` (also on failure)."""
+        started = time.perf_counter()
+        try:
+            return await work
+        finally:
+            self.timings[stage] = round(time.perf_counter() - started, 4)
+
+
+class JobStore:
+    """
+    Job registry for one server process. Mutate jobs only from the event loop.
+    Listeners are called with each job as it finishes. Watchers (which mirror
+    jobs elsewhere) are called with each job and False as it is created and
+    after every stage, and with True when it is discarded.
+    """
+
+    def __init__(self, ttl_s: float = JOB_TTL_S, max_jobs: int = MAX_JOBS):
+        self.ttl_s = ttl_s
+        self.max_jobs = max_jobs
+        self.listeners: List[Callable[[Job], None]] = []
+        self.watchers: List[Callable[[Job, bool], None]] = []
+        self._jobs: Dict[str, Job] = {}
+
+    def create(self) -> Job:
+        self._prune()
+        job = Job(id=uuid.uuid4().hex, created_at=time.time())
+        self._jobs[job.id] = job
+        self._watch(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def active(self) -> int:
+        """Jobs not finished yet."""
+        return sum(not job.done for job in self._jobs.values())
+
+    def discard(self, job: Job):
+        """Forget a job nobody has been told about (e.g. a duplicate submission)."""
+        self._jobs.pop(job.id, None)
+        self._watch(job, discarded=True)
+
+    def record(self, job: Job, stage: str, data: Optional[dict] = None):
+        """Append a completed stage and wake event-stream subscribers."""
+        if job.status == "queued":
+            job.status = "running"
+        job.stages.append({"stage": stage, "at": time.time(), "data": data or {}})
+        self._notify(job)
+        self._watch(job)
+
+    def finish(self, job: Job, error: Optional[str] = None):
+        job.status = "failed" if error else "complete"
+        job.error = error
+        job.finished_at = time.time()
+        job.timings["total"] = round(job.finished_at - job.created_at, 4)
+        self.record(job, job.status, {"error": error} if error else None)
+        for listener in self.listeners:
+            listener(job)
+
+    async def events(self, job: Job, heartbeat_s: float = HEARTBEAT_S) -> AsyncIterator[Optional[dict]]:
+        """
+        Replays the recorded stages, then yields new ones as they happen until
+        the job finishes. Yields None after `heartbeat_s` without a stage.
+        """
+        i = 0
+        while True:
+            changed = job._changed
+            while i < len(job.stages):
+                yield job.stages[i]
+                i += 1
+            if job.done:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=heartbeat_s)
+            except asyncio.TimeoutError:
+                yield None
+
+    def _watch(self, job: Job, discarded: bool = False):
+        for watcher in self.watchers:
+            watcher(job, discarded)
+
+    @staticmethod
+    def _notify(job: Job):
+        job._changed.set()
+        job._changed = asyncio.Event()
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.done and now - job.finished_at > self.ttl_s:
+                del self._jobs[job_id]
+        if len(self._jobs) >= self.max_jobs:
+            finished = sorted((j for j in self._jobs.values() if j.done), key=lambda j: j.finished_at)
+            for job in finished[:len(self._jobs) - self.max_jobs + 1]:
+                del self._jobs[job.id]
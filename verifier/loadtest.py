@@ -0,0 +1,354 @@
+"""
+Local load-testing harness for /verify.
+
+Starts stand-ins for the verifier's dependencies (see fakes.py): a JSON-RPC
+endpoint serving a Pop clone's tokenOwner / currentChallenge and the block
+number, and an uploader whose /upload answers with injectable latency and errors.
+It then drives a verifier (spawned here with uvicorn, or one at --target)
+with synthetic challenge recordings (see synthetic.py), following each job until
+its verdict, and reports throughput and p50/p95/p99 latency per endpoint.
+
+    python loadtest.py --concurrency 4 --duration 60                 # closed loop, 4 clients
+    python loadtest.py --rates 0.5,1,2,4 --duration 30               # open loop per rate: find saturation
+    python loadtest.py --uploader-latency-ms 2000 --uploader-error-rate 0.2
+    python loadtest.py --batch 200                                    # one /verify/batch request
+    python loadtest.py --server-workers 4 --concurrency 8             # uvicorn --workers 4, shared state
+    python loadtest.py --fakes-only                                   # just the stand-ins, for a server you run
+
+Every request uses a new Pop clone address so the verdict cache never
+answers; pass --pop-clones N to cycle N addresses (and --reuse-clip) to
+measure cache hits instead. VERIFY_WORKERS and the server's other settings
+are taken from the environment of a spawned server.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+import aiohttp
+import numpy as np
+from web3 import Web3
+
+import synthetic
+from fakes import FakeRpc, FakeUploader
+
+# Blocks per second the fake chain advances, and how long its challenge stays valid
+BLOCK_TIME_S = 1.0
+CHALLENGE_VALID_BLOCKS = 1_000_000
+# Clients poll a job this often until its verdict
+POLL_INTERVAL_S = 0.25
+PERCENTILES = (50, 95, 99)
+
+
+def fake_chain(start_block: int = 1000, latency_s: float = 0.0) -> FakeRpc:
+    """RPC stand-in holding the benchmark challenge from `start_block`, advancing one block per BLOCK_TIME_S."""
+    return FakeRpc(synthetic.BENCH_CHALLENGE, start_block, start_block + CHALLENGE_VALID_BLOCKS, start_block,
+                   latency_s=latency_s, block_time_s=BLOCK_TIME_S)
+
+
+class Recorder:
+    """Latency samples per endpoint, with status counts."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+
+    def record(self, endpoint: str, status, seconds: float):
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][str(status)] += 1
+
+    def report(self) -> Dict[str, dict]:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        summary = {}
+        for endpoint, values in self.latencies.items():
+            ms = np.array(values) * 1000.0
+            summary[endpoint] = {
+                "count": len(values),
+                "per_s": round(len(values) / elapsed, 2) if elapsed > 0 else None,
+                "statuses": dict(self.statuses[endpoint]),
+                **{f"p{q}_ms": round(float(np.percentile(ms, q)), 1) for q in PERCENTILES},
+                "max_ms": round(float(ms.max()), 1),
+            }
+        return summary
+
+
+async def verify_once(session: aiohttp.ClientSession, target: str, clip: bytes, pop_address: str,
+                      recorder: Recorder, poll_interval_s: float = POLL_INTERVAL_S):
+    """One client: POST /verify, then poll the job until its verdict."""
+    started = time.monotonic()
+    form = aiohttp.FormData()
+    form.add_field("pop_address", pop_address)
+    form.add_field("file", clip, filename="clip.webm", content_type="video/webm")
+    try:
+        async with session.post(f"{target}/verify", data=form) as response:
+            body = await response.json(content_type=None)
+            recorder.record("POST /verify", response.status, time.monotonic() - started)
+    except aiohttp.ClientError as e:
+        recorder.record("POST /verify", type(e).__name__, time.monotonic() - started)
+        return
+    if response.status != 202:
+        recorder.record("job", f"refused {response.status}", time.monotonic() - started)
+        return
+    job_id = body["job_id"]
+    while True:
+        polled = time.monotonic()
+        try:
+            async with session.get(f"{target}/verify/{job_id}") as response:
+                job = await response.json(content_type=None)
+                recorder.record("GET /verify/{job_id}", response.status, time.monotonic() - polled)
+        except aiohttp.ClientError as e:
+            recorder.record("GET /verify/{job_id}", type(e).__name__, time.monotonic() - polled)
+            job = {"status": "running"}
+        if job.get("status") in ("complete", "failed") or response.status == 404:
+            result = job.get("result") or {}
+            outcome = "cached" if body.get("cached") else \
+                "verified" if result.get("verified") else job.get("status", "lost")
+            recorder.record("job", outcome, time.monotonic() - started)
+            return
+        await asyncio.sleep(poll_interval_s)
+
+
+async def verify_batch(session: aiohttp.ClientSession, target: str, clips: List[bytes], pops,
+                       recorder: Recorder) -> dict:
+    """POST every clip in one /verify/batch request and read its NDJSON lines; returns the summary line."""
+    started = time.monotonic()
+    form = aiohttp.FormData()
+    # Every address ahead of the clips, so the server reads all the challenges in one lookup
+    for _ in clips:
+        form.add_field("pop_address", next(pops))
+    for i, clip in enumerate(clips):
+        form.add_field("file", clip, filename=f"clip{i}.webm", content_type="video/webm")
+    summary = {}
+    async with session.post(f"{target}/verify/batch", data=form) as response:
+        if response.status != 200:
+            recorder.record("POST /verify/batch", response.status, time.monotonic() - started)
+            return summary
+        async for raw in response.content:
+            line = json.loads(raw)
+            if line.get("done"):
+                summary = line
+                continue
+            result = line.get("result") or {}
+            outcome = "cached" if line.get("cached") else "verified" if result.get("verified") else line["status"]
+            recorder.record("batch item", outcome, time.monotonic() - started)
+            timings = result.get("metrics", {}).get("timings", {})
+            # Detector time spent in the workers for this clip (both streams when they were split)
+            worker_s = sum(v for k, v in timings.items() if k.endswith("_worker") and k != "total_worker")
+            if worker_s:
+                recorder.record("worker time", "ok", worker_s)
+    recorder.record("POST /verify/batch", response.status, time.monotonic() - started)
+    return summary
+
+
+def _pop_addresses(count: int):
+    fixed = ["0x" + secrets.token_hex(20) for _ in range(count)]
+    i = 0
+    while True:
+        yield Web3.to_checksum_address(fixed[i % count] if count else "0x" + secrets.token_hex(20))
+        i += 1
+
+
+def _clip_for(clip: bytes, reuse: bool) -> bytes:
+    # Appending bytes past the end of the container changes the upload hash without changing the media
+    return clip if reuse else clip + secrets.token_bytes(16)
+
+
+async def closed_loop(target: str, clip: bytes, concurrency: int, duration_s: float, pops, reuse_clip: bool) -> Recorder:
+    recorder = Recorder()
+    deadline = time.monotonic() + duration_s
+
+    async def client(session):
+        while time.monotonic() < deadline:
+            await verify_once(session, target, _clip_for(clip, reuse_clip), next(pops), recorder)
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600)) as session:
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+    recorder.finished = time.monotonic()
+    return recorder
+
+
+async def open_loop(target: str, clip: bytes, rate: float, duration_s: float, pops, reuse_clip: bool,
+                    max_in_flight: int) -> Recorder:
+    """Poisson arrivals at `rate` per second, whatever the server's response times."""
+    recorder = Recorder()
+    deadline = time.monotonic() + duration_s
+    tasks = set()
+    skipped = 0
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=600),
+                                     connector=aiohttp.TCPConnector(limit=max_in_flight)) as session:
+        while time.monotonic() < deadline:
+            if len(tasks) < max_in_flight:
+                task = asyncio.create_task(verify_once(session, target, _clip_for(clip, reuse_clip), next(pops), recorder))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            else:
+                skipped += 1
+            await asyncio.sleep(random.expovariate(rate))
+        if tasks:
+            await asyncio.gather(*tasks)
+    recorder.finished = time.monotonic()
+    if skipped:
+        print(f"[LOAD] {skipped} arrivals skipped: {max_in_flight} clients already in flight")
+    return recorder
+
+
+def print_report(title: str, report: Dict[str, dict]):
+    print(f"\n{title}")
+    print(f"{'endpoint':<22} {'count':>6} {'per_s':>7} {'p50_ms':>9} {'p95_ms':>9} {'p99_ms':>9} {'max_ms':>9}  statuses")
+    for endpoint, row in sorted(report.items()):
+        statuses = " ".join(f"{status}:{n}" for status, n in sorted(row["statuses"].items()))
+        print(f"{endpoint:<22} {row['count']:>6} {row['per_s']:>7} {row['p50_ms']:>9} {row['p95_ms']:>9} "
+              f"{row['p99_ms']:>9} {row['max_ms']:>9}  {statuses}")
+
+
+def spawn_server(rpc_url: str, uploader_url: str, port: int, data_dir: str, log_path: str,
+                 workers: int = 1) -> subprocess.Popen:
+    env = dict(os.environ, RPC_URL=rpc_url, IPFS_UPLOADER_URL=uploader_url, DATA_DIR=data_dir,
+               BLOCK_POLL_INTERVAL_S=str(BLOCK_TIME_S), WEB_CONCURRENCY=str(workers))
+    log = open(log_path, "w")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+         "--no-access-log", "--workers", str(workers)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+
+
+async def wait_ready(target: str, timeout_s: float = 60.0):
+    deadline = time.monotonic() + timeout_s
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(f"{target}/ready") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"Verifier at {target} did not come up within {timeout_s:.0f}s")
+
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run(args) -> int:
+    rpc = fake_chain(latency_s=args.rpc_latency_ms / 1000.0)
+    uploader = FakeUploader(latency_s=args.uploader_latency_ms / 1000.0, error_rate=args.uploader_error_rate)
+    rpc_url = await rpc.start(port=args.rpc_port)
+    uploader_url = await uploader.start(port=args.uploader_port)
+    print(f"[LOAD] Fake RPC at {rpc_url}, fake uploader at {uploader_url}")
+    server = None
+    try:
+        if args.fakes_only:
+            print("[LOAD] Serving the stand-ins until interrupted (set RPC_URL / IPFS_UPLOADER_URL on the verifier)")
+            await asyncio.Event().wait()
+
+        workdir = tempfile.mkdtemp(prefix="pops-load-")
+        if args.clip:
+            with open(args.clip, "rb") as f:
+                clip = f.read()
+        else:
+            spec = synthetic.ClipSpec(duration_s=5.0, resolution=args.resolution, fps=30, codec="vp8", noise=0.25)
+            with open(synthetic.clip_path(spec, workdir), "rb") as f:
+                clip = f.read()
+        target = args.target
+        if target is None:
+            port = _free_port()
+            log_path = os.path.join(workdir, "server.log")
+            server = spawn_server(rpc_url, uploader_url, port, os.path.join(workdir, "data"), log_path,
+                                  workers=args.server_workers)
+            target = f"http://127.0.0.1:{port}"
+            print(f"[LOAD] Spawned verifier at {target} (log: {log_path})")
+        await wait_ready(target)
+
+        pops = _pop_addresses(args.pop_clones)
+        if args.batch:
+            recorder = Recorder()
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=3600)) as session:
+                async with session.get(f"{target}/ready") as response:
+                    workers = (await response.json(content_type=None)).get("workers") or 1
+                summary = await verify_batch(session, target, [_clip_for(clip, args.reuse_clip)
+                                                               for _ in range(args.batch)], pops, recorder)
+            recorder.finished = time.monotonic()
+            report = recorder.report()
+            print_report(f"One batch of {args.batch} clips", report)
+            if summary:
+                worker = report.get("worker time", {})
+                print(f"\n[LOAD] {summary['items']} clips in {summary['elapsed_s']}s: "
+                      f"{summary['items'] / summary['elapsed_s']:.2f} clips/s; detectors alone "
+                      f"({workers} workers, p50 {worker.get('p50_ms', '-')} ms per clip): "
+                      f"{workers * 1000.0 / worker['p50_ms'] if worker else float('nan'):.2f} clips/s")
+        elif args.rates:
+            rows = []
+            for rate in [float(r) for r in args.rates.split(",")]:
+                recorder = await open_loop(target, clip, rate, args.duration, pops, args.reuse_clip, args.max_in_flight)
+                report = recorder.report()
+                print_report(f"Open loop at {rate:g} req/s for {args.duration:g}s", report)
+                rows.append((rate, report))
+            print(f"\n{'offered/s':>9} {'verdicts/s':>10} {'job_p50_ms':>11} {'job_p95_ms':>11} {'job_p99_ms':>11} {'refused':>8}")
+            for rate, report in rows:
+                job = report.get("job", {})
+                refused = sum(n for status, n in job.get("statuses", {}).items() if status.startswith("refused"))
+                done = job.get("count", 0) - refused
+                print(f"{rate:>9g} {done / args.duration:>10.2f} {job.get('p50_ms', '-'):>11} "
+                      f"{job.get('p95_ms', '-'):>11} {job.get('p99_ms', '-'):>11} {refused:>8}")
+        else:
+            recorder = await closed_loop(target, clip, args.concurrency, args.duration, pops, args.reuse_clip)
+            print_report(f"Closed loop, {args.concurrency} clients for {args.duration:g}s", recorder.report())
+        # Pins drain in the background after the verdicts
+        print(f"\n[LOAD] Uploader: {uploader.uploads} uploads, {uploader.failed} injected failures; "
+              f"RPC: {len(rpc.requests)} requests")
+        return 0
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        await rpc.stop()
+        await uploader.stop()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Drive /verify with synthetic clips against stand-in RPC and uploader services")
+    parser.add_argument("--target", help="URL of a running verifier (default: spawn one with uvicorn)")
+    parser.add_argument("--concurrency", type=int, default=4, help="closed-loop clients")
+    parser.add_argument("--rates", help="comma-separated open-loop arrival rates (req/s), run one after another")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per run")
+    parser.add_argument("--batch", type=int, default=0, help="send this many clips in one /verify/batch request instead")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="open-loop cap on concurrent clients")
+    parser.add_argument("--clip", help="upload this file instead of a synthesized recording of the fake challenge")
+    parser.add_argument("--resolution", default="480p", choices=sorted(synthetic.RESOLUTIONS))
+    parser.add_argument("--pop-clones", type=int, default=0, help="cycle this many Pop clones (0: a new one per request)")
+    parser.add_argument("--reuse-clip", action="store_true", help="send identical bytes every time (verdict cache hits)")
+    parser.add_argument("--server-workers", type=int, default=1,
+                        help="server processes of a spawned verifier (uvicorn --workers, shared state)")
+    parser.add_argument("--rpc-latency-ms", type=float, default=0.0)
+    parser.add_argument("--uploader-latency-ms", type=float, default=0.0)
+    parser.add_argument("--uploader-error-rate", type=float, default=0.0)
+    parser.add_argument("--rpc-port", type=int, default=0)
+    parser.add_argument("--uploader-port", type=int, default=0)
+    parser.add_argument("--fakes-only", action="store_true", help="only serve the stand-ins")
+    args = parser.parse_args(argv)
+    try:
+        return asyncio.run(run(args))
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
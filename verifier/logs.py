@@ -0,0 +1,132 @@
+"""
+Structured, level-gated logging.
+
+Every component logs through `get_logger(tag)`: a message plus key=value
+fields, rendered as `[TAG] message key=value ...` (LOG_FORMAT=text, the
+default) or one JSON object per line (LOG_FORMAT=json). Calls below
+LOG_LEVEL return before any field is formatted, so the per-frame and
+per-peak diagnostics logged at DEBUG cost a level check when disabled;
+build anything expensive behind `log.enabled(DEBUG)`.
+Analysis workers are spawned with the server's environment and pick up the
+same settings.
+"""
+import json
+import logging
+import math
+import os
+import sys
+from typing import Any
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+LOG_FORMATS = ("text", "json")
+# Floats in fields are rounded to this many decimals
+FIELD_DECIMALS = 4
+
+_configured = False
+
+
+def compact(value: Any) -> Any:
+    """JSON-safe copy of a field value, with floats rounded and numpy values unwrapped."""
+    if hasattr(value, "tolist"):
+        value = value.tolist()
+    if isinstance(value, float):
+        return round(value, FIELD_DECIMALS) if math.isfinite(value) else str(value)
+    if isinstance(value, dict):
+        return {str(k): compact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [compact(v) for v in value]
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    return str(value)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        parts = [f"[{record.tag.upper()}] {record.getMessage()}"]
+        for key, value in record.fields.items():
+            value = compact(value)
+            text = value if isinstance(value, str) and value and " " not in value and '"' not in value \
+                else json.dumps(value, separators=(",", ":"))
+            parts.append(f"{key}={text}")
+        line = " ".join(parts)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "tag": record.tag,
+            "msg": record.getMessage(),
+        }
+        entry.update((key, compact(value)) for key, value in record.fields.items())
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"))
+
+
+def configure(level: str = None, fmt: str = None):
+    """
+    Install the stdout handler on the "verifier" logger. Reads LOG_LEVEL
+    (default INFO) and LOG_FORMAT (text or json) unless given; safe to call
+    again to change them.
+    """
+    global _configured
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    fmt = (fmt or os.getenv("LOG_FORMAT", "text")).lower()
+    if fmt not in LOG_FORMATS:
+        raise ValueError(f"LOG_FORMAT must be one of {LOG_FORMATS}, got {fmt!r}")
+    root = logging.getLogger("verifier")
+    root.setLevel(level)
+    root.propagate = False
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    root.addHandler(handler)
+    _configured = True
+
+
+class Log:
+    """A component's logger: `log.info("message", key=value, ...)`."""
+
+    def __init__(self, tag: str):
+        self.tag = tag
+        self._logger = logging.getLogger(f"verifier.{tag}")
+
+    def enabled(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def _log(self, level: int, msg: str, fields: dict, exc_info=None):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, msg, exc_info=exc_info, extra={"tag": self.tag, "fields": fields})
+
+    def debug(self, msg: str, **fields):
+        self._log(DEBUG, msg, fields)
+
+    def info(self, msg: str, **fields):
+        self._log(INFO, msg, fields)
+
+    def warning(self, msg: str, **fields):
+        self._log(WARNING, msg, fields)
+
+    def error(self, msg: str, **fields):
+        self._log(ERROR, msg, fields)
+
+    def exception(self, msg: str, **fields):
+        """ERROR with the current exception's traceback."""
+        self._log(ERROR, msg, fields, exc_info=True)
+
+
+def get_logger(tag: str) -> Log:
+    if not _configured:
+        configure()
+    return Log(tag)
+
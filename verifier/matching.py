@@ -0,0 +1,173 @@
+"""
+Matching detected chirps and strobes against a challenge's expected events.
+
+Every expected event takes at most one strobe peak and, if a chirp was
+played at it, one audio peak, each within the tolerance of the expected
+time, and no peak serves two events. Candidates come from a binary search
+over the sorted peaks, so a clip with hundreds of peaks costs the same per
+event as one with a handful. The pairing is an optimal assignment
+(scipy's linear_sum_assignment): as many events matched as possible, then
+the smallest total offset. Nearest-first matching could let an event take
+the only peak a later event was able to use.
+
+Audio is assigned first; strobes are then assigned against both the
+expected time and the event's chirp, which they must also fall within the
+tolerance of.
+"""
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# Max distance between an expected event and the detected chirp/strobe (seconds)
+MATCH_TOLERANCE_S = 0.6
+
+# Slack on the binary-search bounds so float rounding never drops a peak the exact check keeps
+_SEARCH_EPS_S = 1e-9
+
+
+@dataclass
+class EventMatch:
+    expected_s: float
+    audio_expected: bool
+    audio_s: Optional[float]
+    strobe_s: Optional[float]
+    # Why the event failed: "audio", "strobe", "audio_strobe_gap"
+    missed: List[str]
+    # Closest peaks to a missed event, whether or not they were in range or free
+    nearest_audio_s: Optional[float] = None
+    nearest_strobe_s: Optional[float] = None
+
+    @property
+    def ok(self) -> bool:
+        return not self.missed
+
+    def decision(self) -> dict:
+        decision = {"expected_s": self.expected_s, "audio_s": self.audio_s, "strobe_s": self.strobe_s,
+                    "ok": self.ok, "missed": self.missed}
+        if not self.audio_expected:
+            decision["audio_expected"] = False
+        if self.missed:
+            decision["nearest_audio_s"] = self.nearest_audio_s
+            decision["nearest_strobe_s"] = self.nearest_strobe_s
+        return decision
+
+
+@dataclass
+class MatchReport:
+    events: List[EventMatch]
+    tolerance_s: float
+
+    @property
+    def matched(self) -> int:
+        return sum(event.ok for event in self.events)
+
+    @property
+    def required(self) -> int:
+        return len(self.events)
+
+    @property
+    def ok(self) -> bool:
+        """Every expected event matched (no misses allowed)."""
+        return self.matched == self.required
+
+    def decisions(self) -> List[dict]:
+        return [event.decision() for event in self.events]
+
+
+def candidates(expected: np.ndarray, peaks: np.ndarray, tolerance_s: float) -> Tuple[np.ndarray, np.ndarray]:
+    """(event, peak) index pairs with the peak within `tolerance_s` of the event."""
+    if len(expected) == 0 or len(peaks) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    order = np.argsort(peaks, kind="stable")
+    ordered = peaks[order]
+    lo = np.searchsorted(ordered, expected - tolerance_s - _SEARCH_EPS_S, side="left")
+    hi = np.searchsorted(ordered, expected + tolerance_s + _SEARCH_EPS_S, side="right")
+    counts = hi - lo
+    rows = np.repeat(np.arange(len(expected)), counts)
+    # Position of each pair inside its event's run of candidates
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cols = order[np.repeat(lo, counts) + offsets]
+    keep = np.abs(peaks[cols] - expected[rows]) <= tolerance_s
+    return rows[keep], cols[keep]
+
+
+def assign(n_events: int, rows: np.ndarray, cols: np.ndarray, cost: np.ndarray) -> np.ndarray:
+    """
+    Optimal one-to-one assignment over the candidate pairs: the most events
+    matched, then the lowest total cost. Returns the peak index per event, -1
+    where none was assigned.
+    """
+    assigned = np.full(n_events, -1, dtype=int)
+    if len(rows) == 0:
+        return assigned
+    events, event_index = np.unique(rows, return_inverse=True)
+    peaks, peak_index = np.unique(cols, return_inverse=True)
+    # Costlier than all candidate pairs together, so one more match always wins
+    unmatched = float(cost.sum()) + 1.0
+    matrix = np.full((len(events), len(peaks)), unmatched)
+    matrix[event_index, peak_index] = cost
+    r, c = linear_sum_assignment(matrix)
+    real = matrix[r, c] < unmatched
+    assigned[events[r[real]]] = peaks[c[real]]
+    return assigned
+
+
+def _nearest(peaks: np.ndarray, t: float) -> Optional[float]:
+    if len(peaks) == 0:
+        return None
+    ordered = np.sort(peaks)
+    i = int(np.searchsorted(ordered, t))
+    around = ordered[max(0, i - 1):i + 1]
+    return float(around[np.argmin(np.abs(around - t))])
+
+
+def match_events(expected_times_s: Sequence[float], audio_peaks: Sequence[float], strobe_peaks: Sequence[float],
+                 tolerance_s: float = MATCH_TOLERANCE_S, chirp_count: Optional[int] = None) -> MatchReport:
+    """
+    Match detected peaks (seconds) to the expected events. Chirps are played
+    at the first `chirp_count` events (default: all of them); later events
+    need only a strobe.
+    """
+    expected = np.asarray(expected_times_s, dtype=float)
+    audio = np.asarray(audio_peaks, dtype=float)
+    strobes = np.asarray(strobe_peaks, dtype=float)
+    n = len(expected)
+    n_chirps = n if chirp_count is None else min(chirp_count, n)
+
+    rows, cols = candidates(expected[:n_chirps], audio, tolerance_s)
+    audio_match = np.full(n, -1, dtype=int)
+    audio_match[:n_chirps] = assign(n_chirps, rows, cols, np.abs(audio[cols] - expected[rows]))
+
+    rows, cols = candidates(expected, strobes, tolerance_s)
+    near_expected = np.zeros(n, dtype=bool)
+    near_expected[rows] = True
+    # A strobe must also be within the tolerance of its event's chirp, and is preferred close to it
+    chirp = expected[rows]
+    heard = audio_match[rows] >= 0
+    chirp[heard] = audio[audio_match[rows][heard]]
+    gap = np.abs(strobes[cols] - chirp)
+    keep = gap <= tolerance_s
+    rows, cols, gap = rows[keep], cols[keep], gap[keep]
+    near_chirp = np.zeros(n, dtype=bool)
+    near_chirp[rows] = True
+    strobe_match = assign(n, rows, cols, np.abs(strobes[cols] - expected[rows]) + gap)
+
+    events = []
+    for i, t in enumerate(expected.tolist()):
+        audio_s = float(audio[audio_match[i]]) if audio_match[i] >= 0 else None
+        strobe_s = float(strobes[strobe_match[i]]) if strobe_match[i] >= 0 else None
+        missed = []
+        if i < n_chirps and audio_s is None:
+            missed.append("audio")
+        if strobe_s is None:
+            # In range of the expected time, but not of the event's chirp
+            missed.append("audio_strobe_gap" if near_expected[i] and not near_chirp[i] else "strobe")
+        event = EventMatch(expected_s=t, audio_expected=i < n_chirps, audio_s=audio_s, strobe_s=strobe_s,
+                           missed=missed)
+        if missed:
+            event.nearest_audio_s = _nearest(audio, t) if i < n_chirps else None
+            event.nearest_strobe_s = _nearest(strobes, t)
+        events.append(event)
+    return MatchReport(events=events, tolerance_s=tolerance_s)
@@ -0,0 +1,316 @@
+"""
+Durable IPFS pinning outbox.
+
+Verified screenshots are written to a local SQLite outbox and the verdict is
+returned right away with the pin pending. Background workers drain the
+outbox into the uploader service over a pooled aiohttp session, with bounded
+concurrency and exponential backoff; a pin either ends up with the CID the
+uploader returned or as failed with its last error. Nothing is ever invented
+in place of a CID. Pending pins survive a restart.
+"""
+import asyncio
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+import aiohttp
+
+from logs import get_logger
+
+# Uploads to the uploader service in flight at once
+PIN_CONCURRENCY = 2
+# Attempts before a pin is marked failed
+PIN_MAX_ATTEMPTS = 8
+# Delay before the first retry, doubled per attempt up to PIN_BACKOFF_MAX_S
+PIN_BACKOFF_S = 2.0
+PIN_BACKOFF_MAX_S = 600.0
+# Per-upload timeout (Filecoin uploads can be slow)
+PIN_TIMEOUT_S = 120.0
+# Idle workers re-check the outbox at least this often
+IDLE_POLL_S = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pins (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,               -- pending -> pinned | failed
+    image BLOB,                         -- dropped once pinned
+    filename TEXT NOT NULL,
+    content_type TEXT NOT NULL,
+    cid TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,      -- also the lease of an attempt in progress
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pins_due ON pins (status, next_attempt_at);
+"""
+
+PIN_COLUMNS = "id, status, cid, attempts, last_error, created_at, updated_at"
+
+log = get_logger("pin")
+
+
+@dataclass
+class Pin:
+    id: str
+    status: str
+    cid: Optional[str]
+    attempts: int
+    last_error: Optional[str]
+    created_at: float
+    updated_at: float
+
+    def snapshot(self) -> dict:
+        return {
+            "pin_id": self.id,
+            "status": self.status,
+            "cid": self.cid,
+            "attempts": self.attempts,
+            "error": self.last_error,
+        }
+
+
+class PinError(Exception):
+    """An upload attempt failed; `retryable` is False when retrying can't help."""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class PinOutbox:
+    """
+    SQLite-backed pin queue. All database access goes through one thread, so
+    the event loop never blocks on disk. Call start() from the running loop
+    and stop() on shutdown. Listeners are called with the Pin whenever one
+    is pinned or fails for good; attempt listeners with the duration of
+    every upload attempt and whether it succeeded.
+    """
+
+    def __init__(self, path: str, uploader_url: str, concurrency: int = PIN_CONCURRENCY,
+                 max_attempts: int = PIN_MAX_ATTEMPTS, backoff_s: float = PIN_BACKOFF_S,
+                 backoff_max_s: float = PIN_BACKOFF_MAX_S, timeout_s: float = PIN_TIMEOUT_S):
+        self.path = path
+        self.uploader_url = uploader_url.rstrip("/")
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_s = backoff_s
+        self.backoff_max_s = backoff_max_s
+        self.timeout_s = timeout_s
+        self.listeners: List[Callable[[Pin], None]] = []
+        self.attempt_listeners: List[Callable[[float, bool], None]] = []
+        self.enqueued = 0
+        self.pinned = 0
+        self.failed = 0
+        self.retries = 0
+        self.in_flight = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pin-outbox")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._wake = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+
+    async def _db(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    # -- database (outbox thread only) --
+
+    def _insert(self, pin_id: str, image: bytes, filename: str, content_type: str) -> bool:
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT OR IGNORE INTO pins (id, status, image, filename, content_type, next_attempt_at, created_at, updated_at)"
+            " VALUES (?, 'pending', ?, ?, ?, ?, ?, ?)",
+            (pin_id, image, filename, content_type, now, now, now),
+        )
+        return cursor.rowcount == 1
+
+    def _select(self, pin_id: str) -> Optional[Pin]:
+        row = self._connection().execute(f"SELECT {PIN_COLUMNS} FROM pins WHERE id = ?", (pin_id,)).fetchone()
+        return Pin(*row) if row else None
+
+    def _claim(self) -> Tuple[Optional[tuple], Optional[float]]:
+        """Lease the most overdue pending pin; otherwise return when the next one is due."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, image, filename, content_type, attempts FROM pins"
+                " WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                (next_due,) = conn.execute("SELECT MIN(next_attempt_at) FROM pins WHERE status = 'pending'").fetchone()
+                return None, next_due
+            # Leased until the attempt would have timed out; a crash mid-upload retries after that
+            conn.execute(
+                "UPDATE pins SET attempts = attempts + 1, next_attempt_at = ?, updated_at = ? WHERE id = ?",
+                (now + self.timeout_s + 30.0, now, row[0]),
+            )
+            return row, None
+        finally:
+            conn.execute("COMMIT")
+
+    def _settle(self, pin_id: str, status: str, cid: Optional[str], error: Optional[str],
+                next_attempt_at: float) -> Pin:
+        self._connection().execute(
+            "UPDATE pins SET status = ?, cid = ?, last_error = ?, next_attempt_at = ?, updated_at = ?,"
+            " image = CASE WHEN ? = 'pinned' THEN NULL ELSE image END WHERE id = ?",
+            (status, cid, error, next_attempt_at, time.time(), status, pin_id),
+        )
+        return self._select(pin_id)
+
+    def _requeue(self, pin_id: str) -> bool:
+        cursor = self._connection().execute(
+            "UPDATE pins SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ?"
+            " WHERE id = ? AND status = 'failed' AND image IS NOT NULL",
+            (time.time(), time.time(), pin_id),
+        )
+        return cursor.rowcount == 1
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # -- public API --
+
+    async def enqueue(self, pin_id: str, image: bytes, filename: str, content_type: str) -> Pin:
+        """Store `image` for pinning under `pin_id` (idempotent) and return its pending Pin."""
+        if await self._db(self._insert, pin_id, image, filename, content_type):
+            self.enqueued += 1
+            self._wake.set()
+        return await self._db(self._select, pin_id)
+
+    async def get(self, pin_id: str) -> Optional[Pin]:
+        return await self._db(self._select, pin_id)
+
+    async def retry(self, pin_id: str) -> bool:
+        """Queue a failed pin again (with a fresh attempt budget)."""
+        requeued = await self._db(self._requeue, pin_id)
+        if requeued:
+            self._wake.set()
+        return requeued
+
+    def start(self):
+        if self._workers:
+            return
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=self.timeout_s),
+        )
+        self._workers = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        for task in self._workers:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._workers = []
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._conn is not None:
+            await self._db(self._close)
+
+    def stats(self) -> dict:
+        return {
+            "enqueued": self.enqueued,
+            "pinned": self.pinned,
+            "failed": self.failed,
+            "retries": self.retries,
+            "in_flight": self.in_flight,
+        }
+
+    # -- workers --
+
+    def backoff(self, attempts: int) -> float:
+        """Delay after the `attempts`-th failed attempt (with ±20% jitter)."""
+        delay = min(self.backoff_max_s, self.backoff_s * 2 ** (attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                row, next_due = await self._db(self._claim)
+            except Exception as e:
+                log.error("Outbox read failed", error=str(e))
+                row, next_due = None, None
+            if row is None:
+                wait_s = IDLE_POLL_S if next_due is None else min(IDLE_POLL_S, max(0.0, next_due - time.time()))
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=wait_s)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._attempt(*row)
+
+    async def _attempt(self, pin_id: str, image: bytes, filename: str, content_type: str, attempts: int):
+        attempt = attempts + 1
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            cid = await self._upload(image, filename, content_type)
+        except PinError as e:
+            self._attempted(started, False)
+            if e.retryable and attempt < self.max_attempts:
+                delay = self.backoff(attempt)
+                self.retries += 1
+                log.warning("Upload failed, retrying", pin_id=pin_id, attempt=attempt, retry_in_s=round(delay), error=str(e))
+                await self._db(self._settle, pin_id, "pending", None, str(e), time.time() + delay)
+                return
+            log.error("Pin failed", pin_id=pin_id, attempts=attempt, error=str(e))
+            self.failed += 1
+            pin = await self._db(self._settle, pin_id, "failed", None, str(e), time.time())
+        else:
+            self._attempted(started, True)
+            log.info("Pinned", pin_id=pin_id, cid=cid)
+            self.pinned += 1
+            pin = await self._db(self._settle, pin_id, "pinned", cid, None, time.time())
+        finally:
+            self.in_flight -= 1
+        for listener in self.listeners:
+            try:
+                listener(pin)
+            except Exception:
+                log.exception("Listener failed", pin_id=pin_id)
+
+    def _attempted(self, started: float, ok: bool):
+        for listener in self.attempt_listeners:
+            listener(time.monotonic() - started, ok)
+
+    async def _upload(self, image: bytes, filename: str, content_type: str) -> str:
+        form = aiohttp.FormData()
+        form.add_field("file", image, filename=filename, content_type=content_type)
+        try:
+            async with self._session.post(f"{self.uploader_url}/upload", data=form) as response:
+                if response.status != 200:
+                    body = (await response.text())[:200]
+                    # Client errors other than timeouts/rate limits won't go away on retry
+                    retryable = response.status >= 500 or response.status in (408, 429)
+                    raise PinError(f"uploader HTTP {response.status}: {body}", retryable=retryable)
+                result = await response.json(content_type=None)
+        except asyncio.TimeoutError:
+            raise PinError(f"uploader timed out after {self.timeout_s:.0f}s")
+        except aiohttp.ClientError as e:
+            raise PinError(f"uploader unreachable: {e}")
+        cid = result.get("cid") if isinstance(result, dict) else None
+        if not cid:
+            raise PinError(f"uploader returned no CID: {str(result)[:200]}")
+        return cid
@@ -0,0 +1,254 @@
+"""
+Clip analysis pipeline: decodes an upload once, streams it through both
+detectors and the screenshot picker, and stops as soon as nothing later in
+the clip can change the verdict. analyze_audio / analyze_video split the same
+work per stream so the two can run in parallel workers.
+"""
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from audio import N_FFT, chirp_detector
+from ingest import AUDIO_SAMPLE_RATE, ScreenshotPicker, demux
+from logs import get_logger
+from matching import MATCH_TOLERANCE_S
+from video import MIN_STROBE_SPACING_S, StrobeStream, calculate_ssim
+
+# Strobe ROI (x, y, w, h), can be adjusted
+STROBE_ROI = (100, 100, 200, 200)
+
+log = get_logger("pipeline")
+
+# [(start_s, end_s)] spans analyzed around the expected events
+Windows = Sequence[Tuple[float, float]]
+
+
+class EarlyReject(Exception):
+    """Raised mid-decode once an expected window has passed without a candidate event."""
+
+
+def analysis_deadline(expected_times_s: List[float], tolerance_s: float = MATCH_TOLERANCE_S) -> float:
+    """
+    Latest clip time that can still affect the verdict: the last expected
+    event plus the match tolerance, plus the span over which a later frame can
+    still shape an earlier detection (one STFT frame, the strobe peak spacing).
+    """
+    margin = max(N_FFT / AUDIO_SAMPLE_RATE, MIN_STROBE_SPACING_S)
+    return max(expected_times_s) + tolerance_s + margin
+
+
+class WindowGuard:
+    """
+    Ingest consumer placed after the detectors. Once a detector has analyzed
+    past an expected window and holds no candidate event inside it, that
+    event can never be matched, so decoding is aborted with EarlyReject.
+    Detectors without incremental state (the buffered STFT engine) or left
+    out (None, when the streams are analyzed separately) are skipped.
+    Strobes are checked against `strobe_times_s` when given (a challenge can
+    have more strobes than chirps).
+    """
+
+    def __init__(self, expected_times_s: List[float], tolerance_s: float, chirps, strobes,
+                 strobe_times_s: Optional[List[float]] = None):
+        self.tolerance_s = tolerance_s
+        self.expected = {"audio": sorted(expected_times_s),
+                         "strobe": sorted(expected_times_s if strobe_times_s is None else strobe_times_s)}
+        self.chirps = chirps
+        self.strobes = strobes
+        self._next = {"audio": 0, "strobe": 0}
+
+    def on_audio(self, samples: np.ndarray, time_s: float):
+        self._check(self.chirps, "audio")
+
+    def on_video(self, frame, time_s: float):
+        self._check(self.strobes, "strobe")
+
+    def _check(self, detector, kind: str):
+        if not hasattr(detector, "has_candidate_between"):
+            return
+        analyzed = detector.analyzed_until_s
+        expected = self.expected[kind]
+        i = self._next[kind]
+        while i < len(expected) and expected[i] + self.tolerance_s < analyzed:
+            t = expected[i]
+            if not detector.has_candidate_between(t - self.tolerance_s, t + self.tolerance_s):
+                raise EarlyReject(f"no {kind} event within {self.tolerance_s}s of {t:.3f}s")
+            i += 1
+        self._next[kind] = i
+
+
+@dataclass
+class ClipAnalysis:
+    audio_peaks: List[float]
+    strobe_peaks: List[float]
+    screenshot: Optional[np.ndarray]  # BGR frame
+    screenshot_time: Optional[float]
+    analyzed_until_s: float
+    early_reject: Optional[str] = None
+    ssim: Optional[float] = None
+    # Seconds spent in each analysis stage (decode included)
+    timings: Dict[str, float] = field(default_factory=dict)
+    # Detector traces when analyzed with `debug` ({"audio": ..., "video": ...})
+    debug: Optional[dict] = None
+
+
+@dataclass
+class StreamAnalysis:
+    """Result of analyzing one stream on its own (see analyze_audio / analyze_video)."""
+    peaks: List[float]
+    analyzed_until_s: float
+    elapsed_s: float
+    early_reject: Optional[str] = None
+    screenshot: Optional[np.ndarray] = None
+    screenshot_time: Optional[float] = None
+    ssim: Optional[float] = None  # video stream only
+    debug: Optional[dict] = None
+
+
+def _deadline(expected_times_s: List[float], tolerance_s: float, max_duration_s: Optional[float],
+              deadline_s: Optional[float] = None) -> Optional[float]:
+    deadline = deadline_s
+    if deadline is None:
+        deadline = analysis_deadline(expected_times_s, tolerance_s) if expected_times_s else max_duration_s
+    if max_duration_s is not None and deadline is not None:
+        deadline = min(deadline, max_duration_s)
+    return deadline
+
+
+def _windows(expected_times_s: List[float], tolerance_s: float,
+             windows: Optional[Windows] = None) -> Optional[List[Tuple[float, float]]]:
+    if windows is not None:
+        return list(windows)
+    return [(t - tolerance_s, t + tolerance_s) for t in expected_times_s] if expected_times_s else None
+
+
+def _decode(source, consumers: list, deadline: Optional[float], skip_loop_filter: bool,
+            label: str, detectors: list) -> Optional[str]:
+    """Run demux up to `deadline` or an EarlyReject; returns the reject reason, if any."""
+    try:
+        demux(source, consumers, max_duration_s=deadline, skip_loop_filter=skip_loop_filter)
+    except EarlyReject as e:
+        positions = {f"{name}_s": getattr(d, "analyzed_until_s", 0.0) for name, d in detectors}
+        log.info("Early reject", stage=label, reason=str(e), **positions)
+        return str(e)
+    log.debug("Analyzed", stage=label, until_s=deadline)
+    return None
+
+
+def analyze_clip(source, expected_freqs: List[float], expected_times_s: List[float],
+                 engine: str = "goertzel", max_duration_s: Optional[float] = None,
+                 luma_step: int = 1, skip_loop_filter: bool = False,
+                 roi: Tuple[int, int, int, int] = STROBE_ROI,
+                 tolerance_s: float = MATCH_TOLERANCE_S, windowed: bool = True,
+                 debug: bool = False, strobe_times_s: Optional[List[float]] = None,
+                 windows: Optional[Windows] = None, strobe_windows: Optional[Windows] = None,
+                 deadline_s: Optional[float] = None,
+                 band_bins: Optional[Sequence[Sequence[int]]] = None) -> ClipAnalysis:
+    """
+    Decode `source` once and detect chirps/strobes up to the analysis deadline
+    (capped at `max_duration_s`). Aborts early with `early_reject` set when an
+    expected window passes without a candidate event. `expected_times_s` are
+    the chirp times; `strobe_times_s` the strobe times, if there are more.
+    `windowed` limits the chirp transform, and the strobe candidates kept, to
+    the expected times ± tolerance; `debug` returns the detectors' band energy
+    and luminance traces.
+    `windows`, `strobe_windows`, `deadline_s` and `band_bins` take the values a
+    plans.DetectionPlan precomputed; they are derived here when not given.
+    """
+    started = time.perf_counter()
+    strobe_times_s = expected_times_s if strobe_times_s is None else strobe_times_s
+    deadline = _deadline(list(expected_times_s) + list(strobe_times_s), tolerance_s, max_duration_s, deadline_s)
+    windows = _windows(expected_times_s, tolerance_s, windows) if windowed else None
+    chirps = chirp_detector(expected_freqs, AUDIO_SAMPLE_RATE, engine=engine, max_duration_s=deadline,
+                            windows=windows, trace=debug, bands=band_bins)
+    strobes = StrobeStream(roi, max_duration_s=deadline, luma_step=luma_step, trace=debug,
+                           windows=_windows(strobe_times_s, tolerance_s, strobe_windows) if windowed else None)
+    screenshot = ScreenshotPicker(max_time_s=deadline)
+    guard = WindowGuard(expected_times_s, tolerance_s, chirps, strobes, strobe_times_s)
+
+    early_reject = _decode(source, [chirps, strobes, screenshot, guard], deadline, skip_loop_filter, "clip",
+                           [("audio", chirps), ("video", strobes)])
+    strobe_peaks = strobes.finish()
+    frame = screenshot.result(exclude_times=strobe_peaks) if early_reject is None else None
+    audio_peaks = chirps.finish()
+    elapsed = time.perf_counter() - started
+    return ClipAnalysis(
+        audio_peaks=audio_peaks,
+        strobe_peaks=strobe_peaks,
+        screenshot=frame,
+        screenshot_time=screenshot.frame_time,
+        analyzed_until_s=max(getattr(chirps, "analyzed_until_s", 0.0), strobes.analyzed_until_s),
+        early_reject=early_reject,
+        ssim=calculate_ssim(source),
+        timings={"analysis": round(elapsed, 4)},
+        debug={"audio": chirps.trace(), "video": strobes.trace()} if debug else None,
+    )
+
+
+def analyze_audio(source, expected_freqs: List[float], expected_times_s: List[float],
+                  engine: str = "goertzel", max_duration_s: Optional[float] = None,
+                  tolerance_s: float = MATCH_TOLERANCE_S, windowed: bool = True,
+                  debug: bool = False, windows: Optional[Windows] = None, deadline_s: Optional[float] = None,
+                  band_bins: Optional[Sequence[Sequence[int]]] = None) -> StreamAnalysis:
+    """Audio half of analyze_clip: decodes only the audio stream, so it can run beside analyze_video."""
+    started = time.perf_counter()
+    deadline = _deadline(expected_times_s, tolerance_s, max_duration_s, deadline_s)
+    windows = _windows(expected_times_s, tolerance_s, windows) if windowed else None
+    chirps = chirp_detector(expected_freqs, AUDIO_SAMPLE_RATE, engine=engine, max_duration_s=deadline,
+                            windows=windows, trace=debug, bands=band_bins)
+    guard = WindowGuard(expected_times_s, tolerance_s, chirps, None)
+    early_reject = _decode(source, [chirps, guard], deadline, False, "audio", [("audio", chirps)])
+    return StreamAnalysis(
+        peaks=chirps.finish(),
+        analyzed_until_s=getattr(chirps, "analyzed_until_s", 0.0),
+        elapsed_s=time.perf_counter() - started,
+        early_reject=early_reject,
+        debug=chirps.trace() if debug else None,
+    )
+
+
+def analyze_video(source, expected_times_s: List[float], max_duration_s: Optional[float] = None,
+                  luma_step: int = 1, skip_loop_filter: bool = False,
+                  roi: Tuple[int, int, int, int] = STROBE_ROI,
+                  tolerance_s: float = MATCH_TOLERANCE_S, windowed: bool = True,
+                  debug: bool = False, windows: Optional[Windows] = None,
+                  deadline_s: Optional[float] = None) -> StreamAnalysis:
+    """Video half of analyze_clip: strobes and the screenshot from the video stream only."""
+    started = time.perf_counter()
+    deadline = _deadline(expected_times_s, tolerance_s, max_duration_s, deadline_s)
+    strobes = StrobeStream(roi, max_duration_s=deadline, luma_step=luma_step, trace=debug,
+                           windows=_windows(expected_times_s, tolerance_s, windows) if windowed else None)
+    screenshot = ScreenshotPicker(max_time_s=deadline)
+    guard = WindowGuard(expected_times_s, tolerance_s, None, strobes)
+    early_reject = _decode(source, [strobes, screenshot, guard], deadline, skip_loop_filter, "video",
+                           [("video", strobes)])
+    peaks = strobes.finish()
+    frame = screenshot.result(exclude_times=peaks) if early_reject is None else None
+    return StreamAnalysis(
+        peaks=peaks,
+        analyzed_until_s=strobes.analyzed_until_s,
+        elapsed_s=time.perf_counter() - started,
+        early_reject=early_reject,
+        screenshot=frame,
+        screenshot_time=screenshot.frame_time,
+        ssim=calculate_ssim(source),
+        debug=strobes.trace() if debug else None,
+    )
+
+
+def combine_streams(audio: StreamAnalysis, video: StreamAnalysis) -> ClipAnalysis:
+    """Join separately analyzed streams into the ClipAnalysis the matcher expects."""
+    early_reject = audio.early_reject or video.early_reject
+    return ClipAnalysis(
+        audio_peaks=audio.peaks,
+        strobe_peaks=video.peaks,
+        screenshot=video.screenshot if early_reject is None else None,
+        screenshot_time=video.screenshot_time,
+        analyzed_until_s=max(audio.analyzed_until_s, video.analyzed_until_s),
+        early_reject=early_reject,
+        ssim=video.ssim,
+        timings={"audio": round(audio.elapsed_s, 4), "video": round(video.elapsed_s, 4)},
+        debug={"audio": audio.debug, "video": video.debug} if audio.debug or video.debug else None,
+    )
@@ -0,0 +1,141 @@
+"""
+Per-challenge detection plans.
+
+Everything a verification derives from the challenge hash alone, built once:
+the chirp frequencies and strobe timings (challenge.derive_challenge), the
+expected event times, the DFT bins of each chirp band, the analysis windows
+and deadlines, and the matching tolerance. Retries and repeat submissions for
+the same challenge look the plan up instead of re-deriving it, and the
+pipeline takes its windows, deadlines and band bins as they are. The goertzel
+coefficients built from a plan's bands are cached in each analysis worker
+(audio.filter_bank), which is where they are used.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, Tuple
+
+from challenge import ChallengeError, derive_challenge
+from logs import get_logger
+from matching import MATCH_TOLERANCE_S
+
+# Plans kept (least recently used ones are dropped first)
+PLAN_CACHE_SIZE = 1024
+
+log = get_logger("plans")
+
+
+@dataclass(frozen=True)
+class DetectionPlan:
+    challenge_hash: str
+    audio_frequencies: Tuple[int, ...]
+    strobe_timings_ms: Tuple[int, ...]
+    # Every strobe, in seconds; the client plays one chirp per frequency at the first ones
+    expected_times_s: Tuple[float, ...]
+    chirp_times_s: Tuple[float, ...]
+    # DFT bins (N_FFT at AUDIO_SAMPLE_RATE) inside each chirp band, by frequency
+    band_bins: Tuple[Tuple[int, ...], ...]
+    # Analysis windows (expected time ± tolerance) of the chirps and of every strobe
+    windows: Tuple[Tuple[float, float], ...]
+    strobe_windows: Tuple[Tuple[float, float], ...]
+    # Last clip time that matters, for the whole clip and for the audio alone
+    deadline_s: float
+    audio_deadline_s: float
+    tolerance_s: float
+
+    def summary(self) -> dict:
+        return {
+            "challenge": self.challenge_hash,
+            "frequencies_hz": list(self.audio_frequencies),
+            "times_s": list(self.expected_times_s),
+            "chirp_times_s": list(self.chirp_times_s),
+            "deadline_s": self.deadline_s,
+        }
+
+
+def normalize_hash(challenge_hash: str) -> str:
+    clean = challenge_hash[2:] if challenge_hash.startswith("0x") else challenge_hash
+    return "0x" + clean.lower()
+
+
+def build_plan(challenge_hash: str, tolerance_s: float = MATCH_TOLERANCE_S) -> DetectionPlan:
+    """Derive the plan for `challenge_hash`; ChallengeError if it yields no usable challenge."""
+    from audio import band_bins
+    from ingest import AUDIO_SAMPLE_RATE
+    from pipeline import analysis_deadline
+
+    challenge_hash = normalize_hash(challenge_hash)
+    derived = derive_challenge(challenge_hash)
+    frequencies = tuple(derived["audio_frequencies"])
+    timings = tuple(derived["strobe_timings"])
+    expected = tuple(t / 1000.0 for t in timings)
+    chirps = expected[:len(frequencies)]
+    return DetectionPlan(
+        challenge_hash=challenge_hash,
+        audio_frequencies=frequencies,
+        strobe_timings_ms=timings,
+        expected_times_s=expected,
+        chirp_times_s=chirps,
+        band_bins=tuple(tuple(band_bins(f, AUDIO_SAMPLE_RATE)) for f in frequencies),
+        windows=tuple((t - tolerance_s, t + tolerance_s) for t in chirps),
+        strobe_windows=tuple((t - tolerance_s, t + tolerance_s) for t in expected),
+        deadline_s=analysis_deadline(list(expected), tolerance_s),
+        audio_deadline_s=analysis_deadline(list(chirps), tolerance_s),
+        tolerance_s=tolerance_s,
+    )
+
+
+class PlanCache:
+    """Detection plans by challenge hash (LRU). Use from the event loop only."""
+
+    def __init__(self, max_entries: int = PLAN_CACHE_SIZE, tolerance_s: float = MATCH_TOLERANCE_S):
+        self.max_entries = max(1, max_entries)
+        self.tolerance_s = tolerance_s
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, DetectionPlan]" = OrderedDict()
+
+    def get(self, challenge_hash: str) -> DetectionPlan:
+        """The plan for `challenge_hash`, built on a miss; raises ChallengeError."""
+        key = normalize_hash(challenge_hash)
+        plan = self._entries.get(key)
+        if plan is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return plan
+        self.misses += 1
+        plan = build_plan(key, self.tolerance_s)
+        self._store(plan)
+        return plan
+
+    def precompile(self, challenge_hashes: Iterable[str]) -> Dict[str, DetectionPlan]:
+        """
+        Build the plans for many challenges (e.g. the current challenges of
+        many Pops) ahead of their uploads. Hashes without a usable challenge
+        are logged and left out.
+        """
+        plans = {}
+        for challenge_hash in challenge_hashes:
+            key = normalize_hash(challenge_hash)
+            if key in plans:
+                continue
+            plan = self._entries.get(key)
+            if plan is not None:
+                self._entries.move_to_end(key)
+            else:
+                try:
+                    plan = build_plan(key, self.tolerance_s)
+                except ChallengeError as e:
+                    log.warning("No plan for challenge", challenge=key, error=str(e))
+                    continue
+                self._store(plan)
+            plans[key] = plan
+        return plans
+
+    def _store(self, plan: DetectionPlan):
+        self._entries[plan.challenge_hash] = plan
+        self._entries.move_to_end(plan.challenge_hash)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"plans": len(self._entries), "hits": self.hits, "misses": self.misses}
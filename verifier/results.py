@@ -0,0 +1,112 @@
+"""
+Verdict cache for repeated submissions.
+
+Clients on flaky connections re-POST the same clip for the same Pop. A
+verdict only depends on the clip bytes and the challenge it was checked
+against, so finished verdicts are kept (LRU, with a TTL) under
+(upload SHA-256, Pop clone, challenge hash): a repeat is answered with the
+stored verdict and screenshot CID, and a repeat that arrives while the first
+submission is still being verified follows that job instead of starting
+another. Given a shared.SharedStore, finished verdicts are also written there
+and looked up from there on a local miss, so a repeat landing on another
+server process is answered too (jobs still running are followed only within
+their own process).
+"""
+import copy
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from web3 import Web3
+
+from jobs import Job
+from shared import SharedStore
+
+# Verdicts are kept this long (challenges live for a few hundred blocks, ~minutes)
+RESULT_TTL_S = 3600
+# Upper bound on stored verdicts (least recently used ones are dropped first)
+MAX_RESULTS = 1000
+
+ResultKey = Tuple[str, str, str]
+
+
+def result_key(upload_sha256: str, pop_address: str, challenge_hash: str) -> ResultKey:
+    return upload_sha256.lower(), Web3.to_checksum_address(pop_address), challenge_hash.lower()
+
+
+class ResultCache:
+    """Verdicts by ResultKey, plus the jobs currently computing one. Use from the event loop only."""
+
+    def __init__(self, ttl_s: float = RESULT_TTL_S, max_entries: int = MAX_RESULTS,
+                 store: Optional[SharedStore] = None):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.store = store
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self._entries: "OrderedDict[ResultKey, Tuple[float, dict]]" = OrderedDict()
+        self._running: Dict[ResultKey, Job] = {}
+
+    def get(self, key: ResultKey) -> Optional[dict]:
+        """A copy of the stored verdict for `key`, if any (counted as a hit)."""
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl_s:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return copy.deepcopy(entry[1])
+
+    async def lookup(self, key: ResultKey) -> Optional[dict]:
+        """get(), falling back to the shared store (where the verdict may come from another process)."""
+        verdict = self.get(key)
+        if verdict is not None or self.store is None:
+            return verdict
+        verdict = await self.store.get_result("|".join(key))
+        if verdict is None:
+            return None
+        self._store(key, verdict)
+        self.hits += 1
+        return copy.deepcopy(verdict)
+
+    def running(self, key: ResultKey) -> Optional[Job]:
+        """The job already verifying `key`, if any (counted as coalesced)."""
+        job = self._running.get(key)
+        if job is not None:
+            self.coalesced += 1
+        return job
+
+    def start(self, key: ResultKey, job: Job):
+        """Register `job` as computing `key` (a miss)."""
+        self.misses += 1
+        self._running[key] = job
+
+    def finish(self, key: ResultKey, job: Job, cacheable: bool = True):
+        """Unregister `job`, storing its verdict if it completed and `cacheable`."""
+        if self._running.get(key) is job:
+            del self._running[key]
+        if job.status != "complete" or job.result is None or not cacheable:
+            return
+        self._store(key, copy.deepcopy(job.result))
+        if self.store is not None:
+            self.store.put_result("|".join(key), job.result)
+
+    def _store(self, key: ResultKey, verdict: dict):
+        self._entries[key] = (time.monotonic(), verdict)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "cached_results": len(self._entries),
+            "running": len(self._running),
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 3) if lookups else None,
+        }
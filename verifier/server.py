@@ -1,21 +1,48 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-import shutil
+from fastapi.responses import StreamingResponse
+import asyncio
+import contextlib
+import hashlib
+import hmac
+import math
 import os
-from typing import Optional
-from web3 import Web3
+import random
+from typing import Dict, List, Optional, Tuple
 import json
-import subprocess
 import base64
-from pathlib import Path
 import requests
-import io
+import time
 from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
+
+from artifacts import ArtifactStore
+from chain import EMPTY_CHALLENGE, BlockTracker, ChainReader, ChallengeCache
+from challenge import ChallengeError
+from history import HistoryStore
+from jobs import Job, JobStore
+from logs import DEBUG, get_logger
+from matching import match_events
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Counter, Gauge, Registry
+from pinning import Pin, PinOutbox
+from plans import PlanCache
+from results import ResultCache, ResultKey, result_key
+from shared import AnalysisSlots, FileLease, SharedStore
+from uploads import SpooledUpload, UploadError, receive_upload, receive_uploads
+from workers import AnalysisPool, PoolSaturated, PoolUnavailable
 
 # Load environment variables from .env file if it exists
 load_dotenv()
 
-app = FastAPI()
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_components()
+    try:
+        yield
+    finally:
+        await stop_components()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,172 +52,303 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Pop contract ABI for reading challenges
-POP_ABI = json.loads('''[
-    {
-        "inputs": [],
-        "name": "currentChallenge",
-        "outputs": [
-            {"internalType": "bytes32", "name": "challengeHash", "type": "bytes32"},
-            {"internalType": "uint256", "name": "baseBlock", "type": "uint256"},
-            {"internalType": "uint256", "name": "expiresBlock", "type": "uint256"}
-        ],
-        "stateMutability": "view",
-        "type": "function"
-    },
-    {
-        "inputs": [],
-        "name": "tokenOwner",
-        "outputs": [{"internalType": "address", "name": "", "type": "address"}],
-        "stateMutability": "view",
-        "type": "function"
-    }
-]''')
-
-# Store verification history in memory (for demo purposes)
-verification_history = []
-
 # RPC endpoint - should be configurable via env var
 # Using Celo Sepolia testnet public RPC endpoint (Ankr)
 RPC_URL = os.getenv("RPC_URL", "https://rpc.ankr.com/celo_sepolia")
-w3 = Web3(Web3.HTTPProvider(RPC_URL))
+# Timeout for each JSON-RPC round trip (the challenge lookup is a single batch)
+RPC_TIMEOUT_S = float(os.getenv("RPC_TIMEOUT_S", "5"))
+# Block height polling period for challenge expiry checks
+BLOCK_POLL_INTERVAL_S = float(os.getenv("BLOCK_POLL_INTERVAL_S", "1"))
+
+# Chirp detector engine: "goertzel" (target bands only) or "stft" (reference)
+CHIRP_ENGINE = os.getenv("CHIRP_ENGINE", "goertzel")
+# Only transform audio around the expected chirp times (local noise threshold per window),
+# and only keep strobe candidates near the expected strobes
+AUDIO_WINDOWED = os.getenv("AUDIO_WINDOWED", "true").lower() == "true"
+# Only this much of an upload is decoded and analyzed (the challenge spans 5s)
+MAX_ANALYZED_DURATION_S = float(os.getenv("MAX_ANALYZED_DURATION_S", "30"))
+# Strobe ROI luma: sample every Nth pixel/row, optionally skip the decoder's deblocking
+LUMA_SUBSAMPLE = int(os.getenv("LUMA_SUBSAMPLE", "2"))
+VIDEO_SKIP_LOOP_FILTER = os.getenv("VIDEO_SKIP_LOOP_FILTER", "false").lower() == "true"
+# Server processes on this host (`uvicorn --workers` defaults to WEB_CONCURRENCY). With SHARED_STATE
+# (on when there are several), they share the challenge and verdict caches, job states and block
+# polling through DATA_DIR/shared.db, and at most ANALYSIS_SLOTS decode/analysis jobs run at once
+# across all of them
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+SHARED_STATE = os.getenv("SHARED_STATE", str(WEB_CONCURRENCY > 1)).lower() == "true"
+ANALYSIS_SLOTS = int(os.getenv("ANALYSIS_SLOTS", str(os.cpu_count() or 1)))
+# Analysis worker processes (per server process), and how many more uploads may wait for one before 429s
+VERIFY_WORKERS = int(os.getenv("VERIFY_WORKERS", str(
+    max(1, math.ceil(ANALYSIS_SLOTS / WEB_CONCURRENCY)) if SHARED_STATE else max(1, min(4, (os.cpu_count() or 2) - 1)))))
+VERIFY_QUEUE_DEPTH = int(os.getenv("VERIFY_QUEUE_DEPTH", str(2 * VERIFY_WORKERS)))
+# Decode audio and video in separate workers: lower latency, but each stage demuxes and
+# decodes the container, so an upload costs about twice the CPU and I/O of the single pass.
+# Off by default; enable after benchmarking on the target host
+PARALLEL_STAGES = os.getenv("PARALLEL_STAGES", "false").lower() == "true"
+# Upload limits: larger bodies are refused with 413; bodies up to MEMORY_UPLOAD_BYTES are
+# analyzed straight from memory, larger ones are spilled to tmpfs
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+MEMORY_UPLOAD_BYTES = int(os.getenv("MEMORY_UPLOAD_BYTES", str(8 * 1024 * 1024)))
+# Clips whose container reports a longer duration are refused before decoding
+MAX_CLIP_DURATION_S = float(os.getenv("MAX_CLIP_DURATION_S", "60"))
+# Screenshot pinned to IPFS ("jpeg" or "webp", quality 0-100), and the preview embedded in
+# the response (longest side in pixels, size cap in bytes)
+SCREENSHOT_FORMAT = os.getenv("SCREENSHOT_FORMAT", "jpeg").lower()
+SCREENSHOT_QUALITY = int(os.getenv("SCREENSHOT_QUALITY", "85"))
+THUMBNAIL_MAX_PX = int(os.getenv("THUMBNAIL_MAX_PX", "320"))
+THUMBNAIL_MAX_BYTES = int(os.getenv("THUMBNAIL_MAX_BYTES", "24576"))
+IMAGE_TYPES = {"jpeg": (".jpg", "image/jpeg"), "webp": (".webp", "image/webp")}
+if SCREENSHOT_FORMAT not in IMAGE_TYPES:
+    raise ValueError(f"SCREENSHOT_FORMAT must be one of {sorted(IMAGE_TYPES)}, got {SCREENSHOT_FORMAT!r}")
+# Verified screenshots are pinned to IPFS by the uploader service in the background, from a
+# local outbox in DATA_DIR (keep it on persistent storage so pending pins survive restarts)
+IPFS_UPLOADER_URL = os.getenv("IPFS_UPLOADER_URL", "http://localhost:3001")
+DATA_DIR = os.getenv("DATA_DIR", "data")
+PIN_CONCURRENCY = int(os.getenv("PIN_CONCURRENCY", "2"))
+PIN_MAX_ATTEMPTS = int(os.getenv("PIN_MAX_ATTEMPTS", "8"))
+# Verdicts of repeated submissions (same clip, Pop clone and challenge) are served from memory
+RESULT_CACHE_TTL_S = float(os.getenv("RESULT_CACHE_TTL_S", "3600"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1000"))
+# Detection plans derived from challenge hashes, kept for retries of the same challenge
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "1024"))
+# Debug artifacts (luminance curve, band energy traces, matching decisions) for requests sending
+# `X-Debug-Artifact: <DEBUG_ARTIFACT_TOKEN>` (disabled while the token is empty) and for a
+# DEBUG_SAMPLE_RATE fraction of all requests; the newest DEBUG_ARTIFACT_KEEP are kept in DATA_DIR/debug
+DEBUG_ARTIFACT_TOKEN = os.getenv("DEBUG_ARTIFACT_TOKEN", "")
+DEBUG_SAMPLE_RATE = float(os.getenv("DEBUG_SAMPLE_RATE", "0"))
+DEBUG_ARTIFACT_KEEP = int(os.getenv("DEBUG_ARTIFACT_KEEP", "200"))
+# /verify/batch: most clips in one request, and the analysis slots taken before further batch
+# clips wait for one (instead of getting 429s; the default leaves the queue slots to /verify)
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", str(VERIFY_WORKERS)))
+# Start and warm the analysis workers and detector modules at startup (GET /ready reports when done)
+WARMUP = os.getenv("WARMUP", "true").lower() == "true"
+
+os.makedirs(DATA_DIR, exist_ok=True)
+# Verification jobs, and references to their running tasks
+jobs = JobStore()
+# State shared with the other server processes on this host (see shared.py)
+shared = SharedStore(os.path.join(DATA_DIR, "shared.db"), job_ttl_s=jobs.ttl_s,
+                     result_ttl_s=RESULT_CACHE_TTL_S) if SHARED_STATE else None
+chain = ChainReader(RPC_URL, timeout_s=RPC_TIMEOUT_S)
+block_tracker = BlockTracker(chain, interval_s=BLOCK_POLL_INTERVAL_S, store=shared,
+                             lease=FileLease(os.path.join(DATA_DIR, "block-poller.lock")) if SHARED_STATE else None)
+challenges = ChallengeCache(chain, block_tracker, store=shared)
+analysis_pool = AnalysisPool(VERIFY_WORKERS, VERIFY_QUEUE_DEPTH, slots=AnalysisSlots(
+    os.path.join(DATA_DIR, "slots"), ANALYSIS_SLOTS) if SHARED_STATE else None)
+results = ResultCache(ttl_s=RESULT_CACHE_TTL_S, max_entries=RESULT_CACHE_SIZE, store=shared)
+# Detection plans (expected times, bands, windows) by challenge hash
+plans = PlanCache(max_entries=PLAN_CACHE_SIZE)
+pins = PinOutbox(os.path.join(DATA_DIR, "pins.db"), IPFS_UPLOADER_URL,
+                 concurrency=PIN_CONCURRENCY, max_attempts=PIN_MAX_ATTEMPTS)
+# Verification history (SQLite, written in batches in the background)
+history = HistoryStore(os.path.join(DATA_DIR, "history.db"))
+artifacts = ArtifactStore(os.path.join(DATA_DIR, "debug"), keep=DEBUG_ARTIFACT_KEEP)
+
+# Metrics served at /metrics. Stage wall times come from each job's timings
+# when it finishes (worker-side time is reported as "<stage>_worker")
+registry = Registry()
+stage_seconds = registry.histogram("verifier_stage_seconds", "Wall time of verification stages", ["stage"])
+pin_upload_seconds = registry.histogram("verifier_pin_upload_seconds",
+                                        "Screenshot upload attempts to the uploader service", ["outcome"])
+verdicts_total = registry.counter("verifier_verdicts_total", "Verdicts computed", ["verified"])
+rejects_total = registry.counter("verifier_rejects_total", "Uploads refused or not verified, by reason", ["reason"])
+background_tasks = set()
+# Startup progress reported by /ready
+startup = {"ready": False, "stage": "starting", "warmup_s": None, "error": None}
 
-print(f"[INIT] Connected to RPC: {RPC_URL}")
-print(f"[INIT] Current block: {w3.eth.block_number}")
+log = get_logger("server")
+log.info("Using RPC", url=RPC_URL)
 
-def extract_screenshot(video_path: str, timestamp_s: float = None) -> str:
+def encode_screenshot(frame, fmt: str = SCREENSHOT_FORMAT, quality: int = SCREENSHOT_QUALITY) -> bytes:
     """
-    Extract a screenshot from video at given timestamp
-    If timestamp_s is None, extracts from middle of video
-    Returns base64-encoded PNG image
+    Encode an already-decoded BGR frame (picked by the ingest pass) in memory
+    Returns the JPEG/WebP bytes
     """
-    screenshot_path = f"{video_path}_screenshot.png"
-    try:
-        # Get video duration if timestamp not specified
-        if timestamp_s is None:
-            result = subprocess.run([
-                "ffprobe", "-v", "error",
-                "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-                video_path
-            ], capture_output=True, text=True, check=True)
-            duration = float(result.stdout.strip())
-            timestamp_s = duration / 2.0  # Middle of video
-            print(f"[SCREENSHOT] Video duration: {duration:.2f}s, extracting at {timestamp_s:.2f}s (middle)")
-        
-        subprocess.run([
-            "ffmpeg", "-i", video_path,
-            "-ss", str(timestamp_s),
-            "-vframes", "1",
-            "-q:v", "2",
-            screenshot_path
-        ], check=True, capture_output=True)
-        
-        with open(screenshot_path, "rb") as f:
-            img_data = f.read()
-            img_base64 = base64.b64encode(img_data).decode('utf-8')
-        
-        os.remove(screenshot_path)
-        return img_base64
-    except Exception as e:
-        print(f"[ERROR] Failed to extract screenshot: {e}")
-        if os.path.exists(screenshot_path):
-            os.remove(screenshot_path)
-        raise
+    import cv2
+
+    ext, _ = IMAGE_TYPES[fmt]
+    quality_flag = cv2.IMWRITE_WEBP_QUALITY if fmt == "webp" else cv2.IMWRITE_JPEG_QUALITY
+    ok, buf = cv2.imencode(ext, frame, [quality_flag, int(quality)])
+    if not ok:
+        raise ValueError("Failed to encode screenshot frame")
+    return buf.tobytes()
 
-def upload_to_ipfs(image_base64: str) -> str:
+def encode_thumbnail(frame, max_px: int = THUMBNAIL_MAX_PX, max_bytes: int = THUMBNAIL_MAX_BYTES,
+                     fmt: str = SCREENSHOT_FORMAT) -> bytes:
     """
-    Upload image to Filecoin via Synapse SDK (Node.js microservice)
-    Returns the IPFS CID of the uploaded image
+    Downscaled preview for the response: longest side at most max_px, quality
+    (then size) stepped down until it fits in max_bytes
     """
-    # Get uploader service URL from environment
-    uploader_url = os.getenv("IPFS_UPLOADER_URL", "http://localhost:3001")
-    
+    import cv2
+
+    height, width = frame.shape[:2]
+    scale = min(1.0, max_px / max(height, width))
+    while True:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA) if scale < 1.0 else frame
+        for quality in range(SCREENSHOT_QUALITY, 29, -10):
+            thumb = encode_screenshot(small, fmt, quality)
+            if len(thumb) <= max_bytes:
+                return thumb
+        if min(size) <= 16:
+            return thumb
+        scale *= 0.75
+
+async def start_components():
+    # Nothing here waits for the RPC: the block tracker keeps polling until it answers
+    block_tracker.start()
+    history.start()
+    jobs.listeners.append(observe_job)
+    if shared is not None:
+        jobs.watchers.append(mirror_job)
+    pins.attempt_listeners.append(observe_pin_attempt)
+    registry.add_collector(collect_component_metrics)
+    pins.listeners.append(on_pin_settled)
+    pins.start()
+    background(connect_chain())
+    if WARMUP:
+        background(warm_up())
+    else:
+        startup.update(ready=True, stage="ready")
+
+async def stop_components():
+    startup.update(ready=False, stage="stopping")
+    analysis_pool.shutdown()
+    await block_tracker.stop()
+    await chain.close()
+    await pins.stop()
+    await history.stop()
+    if shared is not None:
+        await shared.close()
+
+async def connect_chain():
+    """Log the first block height once the RPC answers."""
+    while block_tracker.block is None:
+        await asyncio.sleep(block_tracker.interval_s)
+    log.info("Current block", block=block_tracker.block)
+
+def warm_server_process():
+    """Load and exercise the server-side stages (screenshot encoding)."""
+    import numpy as np
+    import pipeline  # noqa: F401
+
+    frame = np.zeros((240, 320, 3), dtype=np.uint8)
+    encode_screenshot(frame)
+    encode_thumbnail(frame)
+
+async def warm_up():
+    """
+    Startup warmup (see warmup.py): the analysis workers are started and
+    warmed while the server process warms its own stages. /ready answers 200
+    once both are done; a failed warmup is logged and the server goes ready
+    cold rather than never.
+    """
+    import warmup
+    from synthetic import BENCH_CHALLENGE
+
+    started = time.perf_counter()
     try:
-        # Decode base64 image
-        image_bytes = base64.b64decode(image_base64)
-        
-        # Upload to Filecoin via Synapse SDK microservice
-        print(f"[IPFS] Uploading {len(image_bytes)} bytes to Filecoin via Synapse SDK...")
-        
-        files = {
-            "file": ("screenshot.png", io.BytesIO(image_bytes), "image/png")
-        }
-        
-        response = requests.post(
-            f"{uploader_url}/upload",
-            files=files,
-            timeout=120  # Filecoin uploads may take longer
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            cid = result["cid"]
-            gateway_url = result.get('gateway_url', f'https://w3s.link/ipfs/{cid}')
-            print(f"[IPFS] ==========================================")
-            print(f"[IPFS] Successfully uploaded to Filecoin!")
-            print(f"[IPFS] CID: {cid}")
-            print(f"[IPFS] View image: {gateway_url}")
-            print(f"[IPFS] ==========================================")
-            return cid
-        else:
-            print(f"[IPFS] Upload failed: {response.status_code} - {response.text}")
-            # Fallback to mock CID
-            import hashlib
-            hash_obj = hashlib.sha256(image_base64.encode())
-            hash_hex = hash_obj.hexdigest()
-            
-            # Convert to base32 for valid CID format
-            base32_chars = 'abcdefghijklmnopqrstuvwxyz234567'
-            base32 = ''.join(base32_chars[int(hash_hex[i*2:i*2+2], 16) % 32] for i in range(32))
-            # Extend to 52 chars using hash pattern
-            while len(base32) < 52:
-                idx = (len(base32) * 2) % len(hash_hex)
-                base32 += base32_chars[int(hash_hex[idx:idx+2], 16) % 32]
-            mock_cid = f"bafybei{base32}"
-            print(f"[IPFS] Fallback mock CID: {mock_cid}")
-            return mock_cid
-            
-    except requests.exceptions.ConnectionError:
-        print(f"[IPFS] Could not connect to IPFS uploader at {uploader_url}")
-        print("[IPFS] Make sure the Node.js IPFS uploader service is running")
-        # Fallback to mock CID
-        import hashlib
-        hash_obj = hashlib.sha256(image_base64.encode())
-        hash_hex = hash_obj.hexdigest()
-        
-        # Convert to base32 for valid CID format
-        base32_chars = 'abcdefghijklmnopqrstuvwxyz234567'
-        base32 = ''.join(base32_chars[int(hash_hex[i*2:i*2+2], 16) % 32] for i in range(32))
-        # Extend to 52 chars using hash pattern
-        while len(base32) < 52:
-            idx = (len(base32) * 2) % len(hash_hex)
-            base32 += base32_chars[int(hash_hex[idx:idx+2], 16) % 32]
-        mock_cid = f"bafybei{base32}"
-        print(f"[IPFS] Fallback mock CID: {mock_cid}")
-        return mock_cid
-        
+        startup["stage"] = "warmup_clip"
+        clip = await run_in_threadpool(warmup.warmup_clip, os.path.join(DATA_DIR, "warmup"))
+        startup["stage"] = "warmup"
+        workers = asyncio.create_task(analysis_pool.start(clip))
+        try:
+            await run_in_threadpool(warm_server_process)
+            plans.precompile([BENCH_CHALLENGE])
+        finally:
+            await workers
     except Exception as e:
-        print(f"[IPFS] Error during upload: {e}")
-        # Fallback to mock CID
-        import hashlib
-        hash_obj = hashlib.sha256(image_base64.encode())
-        hash_hex = hash_obj.hexdigest()
-        
-        # Convert to base32 for valid CID format
-        base32_chars = 'abcdefghijklmnopqrstuvwxyz234567'
-        base32 = ''.join(base32_chars[int(hash_hex[i*2:i*2+2], 16) % 32] for i in range(32))
-        # Extend to 52 chars using hash pattern
-        while len(base32) < 52:
-            idx = (len(base32) * 2) % len(hash_hex)
-            base32 += base32_chars[int(hash_hex[idx:idx+2], 16) % 32]
-        mock_cid = f"bafybei{base32}"
-        print(f"[IPFS] Fallback mock CID: {mock_cid}")
-        return mock_cid
+        log.exception("Warmup failed, serving cold")
+        startup["error"] = str(e)
+    startup.update(ready=True, stage="ready", warmup_s=round(time.perf_counter() - started, 3))
+    log.info("Ready", warmup_s=startup["warmup_s"], workers=analysis_pool.workers)
+
+def background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 @app.get("/health")
 def health_check():
-    return {"status": "ok", "tee_mode": True}
+    return {"status": "ok", "tee_mode": True, "pid": os.getpid(), "pool": analysis_pool.stats(),
+            "chain": challenges.stats(), "results": results.stats(), "pins": pins.stats(),
+            "history": history.stats(), "shared": shared.stats() if shared is not None else None}
+
+@app.get("/ready")
+def readiness_check(response: Response):
+    """
+    Readiness for load balancers and autoscalers: 200 once startup warmup is
+    done, 503 while warming up or shutting down. Unlike /health it says
+    whether a verification sent now runs warm. The RPC is reported, not
+    required: the challenge lookup of each request retries it anyway.
+    """
+    if not startup["ready"]:
+        response.status_code = 503
+    return {**startup, "block": block_tracker.block, "workers": analysis_pool.workers}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics (text exposition format)"""
+    return Response(registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+def observe_job(job: Job):
+    for stage, seconds in job.timings.items():
+        stage_seconds.observe(seconds, stage=stage)
+
+def mirror_job(job: Job, discarded: bool):
+    """Job watcher: keep the job's state in the shared store, for requests landing on other processes"""
+    if discarded:
+        shared.drop_job(job.id)
+    else:
+        shared.put_job(job.id, job.snapshot())
+
+def observe_pin_attempt(seconds: float, ok: bool):
+    pin_upload_seconds.observe(seconds, outcome="ok" if ok else "error")
+
+def collect_component_metrics():
+    """Counters kept by the pool, caches, RPC client and pin outbox, read at scrape time"""
+    def gauge(name, help_text, value):
+        metric = Gauge(name, help_text)
+        metric.set(value if value is not None else float("nan"))
+        return metric
+
+    def counter(name, help_text, value):
+        metric = Counter(name, help_text)
+        metric.inc(value)
+        return metric
+
+    def outcomes(name, help_text, values):
+        metric = Counter(name, help_text, ["outcome"])
+        for outcome, value in values.items():
+            metric.inc(value, outcome=outcome)
+        return metric
+
+    pool = analysis_pool.stats()
+    return [
+        gauge("verifier_jobs_in_flight", "Verification jobs not finished yet", jobs.active()),
+        gauge("verifier_pool_workers", "Analysis worker processes", pool["workers"]),
+        gauge("verifier_pool_in_flight", "Requests holding an analysis slot", pool["in_flight"]),
+        gauge("verifier_pool_queue_depth", "Requests waiting for an analysis worker",
+              max(0, pool["in_flight"] - pool["workers"])),
+        gauge("verifier_pool_job_estimate_seconds", "Moving average of analysis job time", pool["job_estimate_s"]),
+        counter("verifier_pool_rejected_total", "Uploads refused because the pool was full", pool["rejected"]),
+        counter("verifier_rpc_requests_total", "JSON-RPC round trips", chain.requests),
+        counter("verifier_rpc_errors_total", "JSON-RPC round trips that failed or timed out", chain.errors),
+        gauge("verifier_block_height", "Block height seen by the block tracker", block_tracker.block),
+        outcomes("verifier_challenge_cache_total", "Challenge cache lookups",
+                 {"hit": challenges.hits, "miss": challenges.misses}),
+        counter("verifier_challenge_cache_invalidations_total", "Challenge cache entries dropped",
+                challenges.invalidations),
+        outcomes("verifier_plan_cache_total", "Detection plan lookups", {"hit": plans.hits, "miss": plans.misses}),
+        outcomes("verifier_result_cache_total", "Verdict cache lookups",
+                 {"hit": results.hits, "coalesced": results.coalesced, "miss": results.misses}),
+        outcomes("verifier_pins_total", "Screenshot pins by outcome",
+                 {"enqueued": pins.enqueued, "pinned": pins.pinned, "failed": pins.failed, "retried": pins.retries}),
+        gauge("verifier_pins_in_flight", "Screenshot uploads in progress", pins.in_flight),
+        gauge("verifier_history_queued", "History writes waiting for the next batch", history.stats()["queued"]),
+    ]
 
 @app.get("/wallet")
 def get_wallet_info():
@@ -198,7 +356,7 @@ def get_wallet_info():
     Proxy endpoint to get wallet address from uploader service.
     This allows access via the main verifier port (8000) instead of uploader port (3001).
     """
-    uploader_url = os.getenv("IPFS_UPLOADER_URL", "http://localhost:3001")
+    uploader_url = IPFS_UPLOADER_URL
     
     try:
         response = requests.get(f"{uploader_url}/wallet", timeout=5)
@@ -228,169 +386,540 @@ def get_wallet_info():
             }
         )
 
-@app.post("/verify")
-async def verify_clip(
-    file: UploadFile = File(...),
-    pop_address: str = Form(...)
-):
-    # Fetch challenge from Pop clone
+@app.post("/verify", status_code=202)
+async def verify_clip(request: Request):
+    """
+    Accept a multipart upload (`pop_address`, then `file`) and start verifying
+    it in the background. Returns a job id right away; follow progress via
+    GET /verify/{job_id} or its /events stream (challenge, audio, strobes,
+    verdict, screenshot).
+    """
+    # Refuse before doing any work when every worker and queue slot is taken
     try:
-        pop_contract = w3.eth.contract(
-            address=Web3.to_checksum_address(pop_address),
-            abi=POP_ABI
-        )
-        
-        # Get token owner
-        token_owner = pop_contract.functions.tokenOwner().call()
-        
-        # Get current challenge
-        challenge_data = pop_contract.functions.currentChallenge().call()
-        
-        challenge_hash = challenge_data[0].hex()
-        base_block = challenge_data[1]
-        expires_block = challenge_data[2]
-        
-        # Verify challenge exists
-        if challenge_hash == '0x' + '00' * 32:
-            raise HTTPException(status_code=400, detail="No challenge found for this token")
-        
-        # Verify block validity
-        current_block = w3.eth.block_number
-        if current_block < base_block or current_block > expires_block:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Challenge expired. Current block: {current_block}, Valid range: {base_block}-{expires_block}"
-            )
-        
-        print(f"[POP] Pop clone: {pop_address}")
-        print(f"[POP] Token owner: {token_owner}")
-        print(f"[POP] Challenge hash: 0x{challenge_hash}")
-        print(f"[POP] Block range: {base_block}-{expires_block} (current: {current_block})")
-        
+        analysis_pool.reserve()
+    except PoolSaturated as e:
+        log.warning("Rejecting upload", reason=str(e))
+        rejects_total.inc(reason="saturated")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after_s)})
+    except PoolUnavailable as e:
+        rejects_total.inc(reason="unavailable")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(analysis_pool.retry_after_s())})
+
+    # The chain lookup doesn't depend on the clip: start it as soon as the
+    # pop_address field has been parsed, while the file part is still arriving
+    job = jobs.create()
+    challenge_task: Optional[asyncio.Task] = None
+
+    def on_field(name: str, value: str):
+        nonlocal challenge_task
+        if name == "pop_address" and challenge_task is None:
+            challenge_task = asyncio.create_task(job.timed("challenge", challenges.get(value)))
+
+    upload: Optional[SpooledUpload] = None
+    try:
+        fields, upload = await job.timed("spool", receive_upload(
+            request, on_field=on_field, max_bytes=MAX_UPLOAD_BYTES, memory_bytes=MEMORY_UPLOAD_BYTES,
+        ))
+        pop_address = fields.get("pop_address")
+        if not pop_address:
+            raise UploadError('Missing "pop_address" field')
+        await check_clip(upload)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to fetch challenge from Pop clone: {str(e)}")
-    
-    temp_file = f"temp_{file.filename}"
-    with open(temp_file, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
+        analysis_pool.release()
+        if challenge_task is not None:
+            challenge_task.cancel()
+        if upload is not None:
+            upload.discard()
+        jobs.finish(job, error=f"Failed to read upload: {e}")
+        if isinstance(e, UploadError):
+            rejects_total.inc(reason=reject_reason(e))
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        raise
+
+    log.info("Upload received", job_id=job.id, filename=upload.filename, bytes=upload.size,
+             sha256=upload.sha256[:16], spilled=upload.path)
+
+    key, answer = await answer_repeat(job, upload, pop_address, challenge_task)
+    if answer is not None:
+        return {"job_id": answer.id, "status": answer.status, "cached": True}
+
+    background(run_verification(job, upload, pop_address, challenge_task, key, debug=debug_trigger(request)))
+    log.info("Job queued", job_id=job.id, pop_address=pop_address)
+    return {"job_id": job.id, "status": job.status}
+
+@app.post("/verify/batch")
+async def verify_batch(request: Request):
+    """
+    Verify many clips in one multipart upload: `pop_address` fields and
+    `file` parts, the i-th file going with the i-th pop_address (send each
+    address before its file). When a file starts, the challenges of all
+    addresses sent so far are read in one batched chain lookup. Each clip is
+    verified as soon as it has arrived and an analysis slot is free; reading
+    the body waits while none is. The response streams one NDJSON line per
+    clip, in completion order, then a summary line.
+    """
+    started = time.monotonic()
+    addresses: List[str] = []
+    lookups: Dict[str, asyncio.Task] = {}
+    items: List[asyncio.Future] = []
+
+    def on_field(name: str, value: str):
+        if name == "pop_address":
+            addresses.append(value)
+
+    def lookup(pop_address: str) -> asyncio.Task:
+        # One read for every address not looked up yet (including ones whose files are still to come)
+        if pop_address not in lookups:
+            pending = list(dict.fromkeys(a for a in addresses if a not in lookups))
+            task = asyncio.create_task(batch_challenges(pending))
+            lookups.update((address, task) for address in pending)
+        return lookups[pop_address]
+
+    def failed_item(index: int, pop_address: Optional[str], filename: Optional[str], error: Exception):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result({"index": index, "pop_address": pop_address, "filename": filename, "job_id": None,
+                           "status": "failed", "error": str(error)})
+        items.append(future)
+
+    async def on_upload(_fields: Dict[str, str], upload):
+        index = len(items)
+        pop_address = addresses[index] if index < len(addresses) else None
+        if isinstance(upload, UploadError):
+            rejects_total.inc(reason=reject_reason(upload))
+            return failed_item(index, pop_address, None, upload)
+        if not pop_address:
+            upload.discard()
+            rejects_total.inc(reason="bad_upload")
+            return failed_item(index, None, upload.filename, UploadError(f'No "pop_address" for file {index}'))
+        try:
+            await analysis_pool.acquire(BATCH_CONCURRENCY)
+        except PoolUnavailable as e:
+            upload.discard()
+            rejects_total.inc(reason="unavailable")
+            return failed_item(index, pop_address, upload.filename, e)
+        job = jobs.create()
+        challenge_task = asyncio.create_task(job.timed("challenge", challenge_state(lookup(pop_address), pop_address)))
+        items.append(background(verify_batch_item(index, job, upload, pop_address, challenge_task)))
+
+    body_error = None
     try:
-        from audio import detect_chirps
-        from video import detect_strobes, calculate_ssim
-        from challenge import derive_challenge
-        
-        # Derive expected patterns from challenge hash
-        derived = derive_challenge('0x' + challenge_hash)
-        expected_freqs = derived["audio_frequencies"]
-        expected_strobes = derived["strobe_timings"]
-        
-        print(f"Challenge: 0x{challenge_hash}")
-        print(f"Expected frequencies: {expected_freqs}")
-        print(f"Expected strobe timings: {expected_strobes}")
-        
-        # Extract audio using ffmpeg
-        audio_path = f"{temp_file}.wav"
-        import subprocess
-        subprocess.run([
-            "ffmpeg", "-i", temp_file, "-vn", 
-            "-acodec", "pcm_s16le", "-ar", "44100", "-ac", "1", 
-            audio_path
-        ], check=True, capture_output=True)
-        
-        # Detect chirps with expected frequencies
-        audio_peaks = detect_chirps(audio_path, expected_freqs)
-        
-        # Detect strobes (ROI can be adjusted)
-        roi = (100, 100, 200, 200) 
-        strobe_peaks = detect_strobes(temp_file, roi)
-        
-        ssim = calculate_ssim(temp_file)
-        
-        os.remove(audio_path)
-
-        # Convert expected strobe timings (ms) to seconds to match detected peak units.
-        # Only consider as many expected times as there are audio tones (typically 3)
-        # to avoid over-constraining verification when the challenge has extra strobes.
-        expected_times_s_full = [t / 1000.0 for t in expected_strobes]
-        expected_times_s = expected_times_s_full[: len(expected_freqs)]
-        tolerance_s = 0.6
-
-        matched_audio = []
-        matched_strobes = []
-        successes = 0
-        
-        # Track which peaks have been used to prevent reuse
-        used_audio_indices = set()
-        used_strobe_indices = set()
-
-        for t in expected_times_s:
-            if not audio_peaks or not strobe_peaks:
-                matched_audio.append(None)
-                matched_strobes.append(None)
+        await receive_uploads(request, on_upload, on_field=on_field, max_files=BATCH_MAX_ITEMS,
+                              max_bytes=MAX_UPLOAD_BYTES, memory_bytes=MEMORY_UPLOAD_BYTES)
+    except UploadError as e:
+        if not items:
+            rejects_total.inc(reason=reject_reason(e))
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        # Clips already started are still reported
+        body_error = str(e)
+    if not items:
+        raise HTTPException(status_code=400, detail='Missing "file" parts')
+    log.info("Batch received", items=len(items), addresses=len(set(addresses)),
+             lookups=len(set(map(id, lookups.values()))), upload_s=round(time.monotonic() - started, 3))
+
+    async def lines():
+        verified = failed = 0
+        for item in asyncio.as_completed(items):
+            line = await item
+            if line["status"] == "failed":
+                failed += 1
+            elif (line.get("result") or {}).get("verified"):
+                verified += 1
+            yield json.dumps(line) + "\n"
+        summary = {"done": True, "items": len(items), "verified": verified, "failed": failed,
+                   "elapsed_s": round(time.monotonic() - started, 3), "error": body_error}
+        log.info("Batch done", **summary)
+        yield json.dumps(summary) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def batch_challenges(pop_addresses: List[str]) -> dict:
+    """ChallengeCache.get_many, building the detection plans of the challenges found before their clips arrive"""
+    states = await challenges.get_many(pop_addresses)
+    plans.precompile(state.challenge_hash for state in states.values()
+                     if not isinstance(state, Exception) and state.challenge_hash != EMPTY_CHALLENGE)
+    return states
+
+async def challenge_state(lookup: asyncio.Task, pop_address: str):
+    """One clone's state out of a ChallengeCache.get_many lookup"""
+    state = (await asyncio.shield(lookup))[pop_address]  # shared by the batch's other clips
+    if isinstance(state, Exception):
+        raise state
+    return state
+
+async def verify_batch_item(index: int, job: Job, upload: SpooledUpload, pop_address: str,
+                            challenge_task: asyncio.Task) -> dict:
+    """Verify one clip of a batch (holding an acquired slot); returns its NDJSON line"""
+    line = {"index": index, "pop_address": pop_address, "filename": upload.filename}
+    answer = job
+    try:
+        try:
+            await check_clip(upload)
+        except UploadError as e:
+            analysis_pool.release()
+            challenge_task.cancel()
+            upload.discard()
+            jobs.finish(job, error=f"Failed to read upload: {e}")
+            rejects_total.inc(reason=reject_reason(e))
+        else:
+            key, answer = await answer_repeat(job, upload, pop_address, challenge_task)
+            if answer is None:
+                answer = job
+                await run_verification(job, upload, pop_address, challenge_task, key)
+            else:
+                async for _ in jobs.events(answer):
+                    pass
+    except Exception as e:
+        log.exception("Batch item failed", job_id=job.id)
+        return {**line, "job_id": job.id, "status": "failed", "error": str(e)}
+    result = answer.result
+    if result is not None:
+        # The preview is there for single uploads; batch clients fetch it from the job if needed
+        result = {k: v for k, v in result.items() if k != "screenshot_preview"}
+    return {**line, "job_id": answer.id, "status": answer.status,
+            "cached": answer is not job or bool((result or {}).get("cached")), "result": result, "error": answer.error}
+
+async def check_clip(upload: SpooledUpload):
+    """Reject what isn't a media container, or is too long, before it takes a worker (UploadError)"""
+    from ingest import probe_source
+    try:
+        duration = await run_in_threadpool(probe_source, upload.source)
+    except Exception as e:
+        raise UploadError(f"Unreadable media file: {e}", status_code=415)
+    if duration is not None and duration > MAX_CLIP_DURATION_S:
+        raise UploadError(f"Clip is {duration:.1f}s long, the limit is {MAX_CLIP_DURATION_S:.0f}s", status_code=413)
+
+def reject_reason(e: UploadError) -> str:
+    return {413: "too_large", 415: "unreadable_media"}.get(e.status_code, "bad_upload")
+
+async def answer_repeat(job: Job, upload: SpooledUpload, pop_address: str,
+                        challenge_task: asyncio.Task) -> Tuple[Optional[ResultKey], Optional[Job]]:
+    """
+    Repeat submission of a clip against a still-valid challenge: answer `job`
+    with the stored verdict, or follow the job already verifying it. Returns
+    the result cache key and the job that answers; the pool slot and upload
+    are then let go. When there is nothing to answer with, the job is None
+    and `job` is registered as verifying the key.
+    """
+    key = await verdict_key(upload, pop_address, challenge_task)
+    if key is None:
+        return None, None
+    cached = await results.lookup(key)
+    running = results.running(key) if cached is None else None
+    if cached is None and running is None:
+        results.start(key, job)
+        return key, None
+    analysis_pool.release()
+    upload.discard()
+    if running is not None:
+        jobs.discard(job)
+        log.info("Duplicate upload, following running job", job_id=running.id)
+        return key, running
+    cached["cached"] = True
+    cached.pop("debug_artifact", None)  # captured for the original request only
+    if cached.get("pin_id"):
+        # The pin may have settled since the verdict was stored; a failed one is retried
+        pin = await pins.get(cached["pin_id"])
+        if pin is not None and pin.status == "failed" and await pins.retry(pin.id):
+            pin = await pins.get(pin.id)
+        if pin is not None:
+            apply_pin(cached, pin)
+    job.result = cached
+    jobs.record(job, "verdict", {"verified": cached["verified"], "cached": True})
+    jobs.finish(job)
+    log.info("Answered from the verdict cache", job_id=job.id)
+    return key, job
+
+async def job_snapshot(job_id: str) -> Optional[dict]:
+    """A job's state: from this process, or from the shared store when another process runs it"""
+    job = jobs.get(job_id)
+    if job is not None:
+        snapshot = job.snapshot()
+    elif shared is not None:
+        snapshot = await shared.get_job(job_id)
+    else:
+        return None
+    result = (snapshot or {}).get("result")
+    if shared is not None and result and result.get("pin_id") and result.get("ipfs_status") == "pending":
+        # Any process's outbox may have pinned it; the pin table is the one record of that
+        pin = await pins.get(result["pin_id"])
+        if pin is not None:
+            apply_pin(result, pin)
+    return snapshot
+
+@app.get("/verify/{job_id}")
+async def get_verification(job_id: str):
+    """Current state of a verification job, including the verdict once known"""
+    snapshot = await job_snapshot(job_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired verification job")
+    return snapshot
+
+@app.get("/pins/{pin_id}")
+async def get_pin(pin_id: str):
+    """IPFS pin state of a verified screenshot: pending, pinned (with its CID) or failed"""
+    pin = await pins.get(pin_id)
+    if pin is None:
+        raise HTTPException(status_code=404, detail="Unknown pin")
+    return pin.snapshot()
+
+def apply_pin(result: dict, pin: Pin):
+    """Reflect a pin's state in a verdict response"""
+    result["ipfs_status"] = pin.status
+    result.pop("ipfs_error", None)
+    if pin.cid:
+        result["ipfs_cid"] = pin.cid
+    if pin.status == "failed":
+        result["ipfs_error"] = pin.last_error
+
+def on_pin_settled(pin: Pin):
+    """Outbox listener: fill in the CID (or error) on the job and the history entry"""
+    job = jobs.get(pin.id)
+    if job is not None and job.result is not None:
+        apply_pin(job.result, pin)
+    history.update_pin(pin.id, pin.cid, pin.status)
+
+@app.get("/verify/{job_id}/events")
+async def stream_verification(job_id: str):
+    """Server-sent events, one per completed stage, ending with complete/failed"""
+    job = jobs.get(job_id)
+    if job is None and (shared is None or await shared.get_job(job_id) is None):
+        raise HTTPException(status_code=404, detail="Unknown or expired verification job")
+
+    async def event_stream():
+        stages = jobs.events(job) if job is not None else shared_job_events(job_id)
+        async for stage in stages:
+            if stage is None:
+                yield ": keep-alive\n\n"
                 continue
+            payload = dict(stage["data"], at=stage["at"])
+            if stage["stage"] in ("verdict", "screenshot", "complete", "failed"):
+                payload["result"] = job.result if job is not None else stage.get("result")
+            yield f"event: {stage['stage']}\ndata: {json.dumps(payload)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def shared_job_events(job_id: str, poll_s: float = 0.25, heartbeat_s: float = 15.0):
+    """JobStore.events for a job another process runs, polled from the shared store"""
+    seen = 0
+    idle_since = time.monotonic()
+    while True:
+        snapshot = await shared.get_job(job_id)
+        if snapshot is None:
+            return
+        for stage in snapshot["stages"][seen:]:
+            yield dict(stage, result=snapshot["result"])
+        if len(snapshot["stages"]) > seen:
+            seen = len(snapshot["stages"])
+            idle_since = time.monotonic()
+        if snapshot["status"] in ("complete", "failed"):
+            return
+        if time.monotonic() - idle_since > heartbeat_s:
+            idle_since = time.monotonic()
+            yield None
+        await asyncio.sleep(poll_s)
+
+def debug_trigger(request: Request) -> Optional[str]:
+    """Why this request gets a debug artifact ("header" or "sampled"), or None"""
+    token = request.headers.get("x-debug-artifact")
+    if token and DEBUG_ARTIFACT_TOKEN and hmac.compare_digest(token, DEBUG_ARTIFACT_TOKEN):
+        return "header"
+    if DEBUG_SAMPLE_RATE > 0 and random.random() < DEBUG_SAMPLE_RATE:
+        return "sampled"
+    return None
+
+@app.get("/verify/{job_id}/debug")
+async def get_debug_artifact(job_id: str, request: Request):
+    """Debug artifact captured for a job (needs X-Debug-Artifact when a token is configured)"""
+    if DEBUG_ARTIFACT_TOKEN and not hmac.compare_digest(request.headers.get("x-debug-artifact", ""),
+                                                        DEBUG_ARTIFACT_TOKEN):
+        raise HTTPException(status_code=403, detail="Debug artifacts need the X-Debug-Artifact token")
+    artifact = await run_in_threadpool(artifacts.load, job_id)
+    if artifact is None:
+        raise HTTPException(status_code=404, detail="No debug artifact for this job")
+    return artifact
+
+async def verdict_key(upload: SpooledUpload, pop_address: str, challenge_task: asyncio.Task) -> Optional[ResultKey]:
+    """Result cache key, or None while the challenge is unknown, empty or expired"""
+    try:
+        state = await asyncio.shield(challenge_task)
+    except Exception:
+        return None  # run_verification reports the failure
+    if state.challenge_hash == EMPTY_CHALLENGE or not state.base_block <= state.current_block <= state.expires_block:
+        return None
+    return result_key(upload.sha256, pop_address, state.challenge_hash)
+
+class VerificationRejected(Exception):
+    """The upload cannot be verified against this Pop clone (no or expired challenge)"""
 
-            # Find nearest unused audio peak
-            nearest_audio = None
-            nearest_audio_idx = None
-            min_audio_dist = float('inf')
-            for i, peak in enumerate(audio_peaks):
-                if i not in used_audio_indices:
-                    dist = abs(peak - t)
-                    if dist < min_audio_dist:
-                        min_audio_dist = dist
-                        nearest_audio = peak
-                        nearest_audio_idx = i
-            
-            # Find nearest unused strobe peak
-            nearest_strobe = None
-            nearest_strobe_idx = None
-            min_strobe_dist = float('inf')
-            for i, peak in enumerate(strobe_peaks):
-                if i not in used_strobe_indices:
-                    dist = abs(peak - t)
-                    if dist < min_strobe_dist:
-                        min_strobe_dist = dist
-                        nearest_strobe = peak
-                        nearest_strobe_idx = i
-
-            ok_here = True
-            if nearest_audio is None or abs(nearest_audio - t) > tolerance_s:
-                ok_here = False
-            if nearest_strobe is None or abs(nearest_strobe - t) > tolerance_s:
-                ok_here = False
-            if nearest_audio is not None and nearest_strobe is not None:
-                if abs(nearest_audio - nearest_strobe) > tolerance_s:
-                    ok_here = False
-
-            matched_audio.append(nearest_audio)
-            matched_strobes.append(nearest_strobe)
-
-            if ok_here:
-                successes += 1
-                # Mark these peaks as used
-                if nearest_audio_idx is not None:
-                    used_audio_indices.add(nearest_audio_idx)
-                if nearest_strobe_idx is not None:
-                    used_strobe_indices.add(nearest_strobe_idx)
-
-        # Require ALL expected times to match (no misses allowed)
-        required = len(expected_times_s)
-        alignment_ok = successes >= required
-
-        print(f"[MATCHING] Expected times: {expected_times_s}")
-        print(f"[MATCHING] Audio peaks: {audio_peaks}")
-        print(f"[MATCHING] Strobe peaks: {strobe_peaks}")
-        print(f"[MATCHING] Matched audio: {matched_audio}")
-        print(f"[MATCHING] Matched strobes: {matched_strobes}")
-        print(f"[MATCHING] Successes: {successes}/{len(expected_times_s)} (required: {required})")
-        print(f"[RESULT] Alignment OK: {alignment_ok}, Verified: {alignment_ok}")
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason
+
+async def run_verification(job: Job, upload: SpooledUpload, pop_address: str, challenge_task: asyncio.Task,
+                           key: Optional[ResultKey] = None, debug: Optional[str] = None):
+    """
+    Background task behind a verification job; holds the reserved pool slot
+    until analysis is done. Stage graph: challenge lookup (started alongside
+    the upload) -> audio and video analysis in parallel workers ->
+    matcher -> verdict -> screenshot pin. With a `key`, the verdict is stored
+    in the result cache (unless the screenshot pin failed, so a retry redoes it).
+    With `debug` (what triggered it), the detector traces and matching
+    decisions are saved as a debug artifact.
+    """
+    try:
+        try:
+            # Challenge from the Pop clone (cached per clone; misses read owner,
+            # challenge and block number in one batch, expiry uses the tracked block)
+            try:
+                state = await challenge_task
+            except Exception as e:
+                raise VerificationRejected(f"Failed to fetch challenge from Pop clone: {str(e)}", "challenge_unavailable")
+
+            token_owner = state.token_owner
+            challenge_hash = state.challenge_hash[2:]
+            base_block = state.base_block
+            expires_block = state.expires_block
+            current_block = state.current_block
+
+            # Verify challenge exists
+            if state.challenge_hash == EMPTY_CHALLENGE:
+                raise VerificationRejected("No challenge found for this token", "no_challenge")
+
+            # Verify block validity
+            if current_block < base_block or current_block > expires_block:
+                raise VerificationRejected(
+                    f"Challenge expired. Current block: {current_block}, Valid range: {base_block}-{expires_block}",
+                    "challenge_expired",
+                )
+
+            log.debug("Challenge", job_id=job.id, pop_address=pop_address, token_owner=token_owner,
+                      challenge=f"0x{challenge_hash}", block_range=[base_block, expires_block],
+                      current_block=current_block)
+
+            from pipeline import analyze_audio, analyze_clip, analyze_video, combine_streams
+
+            # Expected patterns from the challenge hash (derived once per challenge)
+            try:
+                plan = plans.get('0x' + challenge_hash)
+            except ChallengeError as e:
+                raise VerificationRejected(f"Unusable challenge: {e}", "invalid_challenge")
+            expected_freqs = list(plan.audio_frequencies)
+            # Strobe timings in seconds, the detected peak units. The client plays
+            # one chirp per frequency, at the first strobes; any further strobes are silent
+            expected_times_s = list(plan.expected_times_s)
+            chirp_times_s = list(plan.chirp_times_s)
+            tolerance_s = plan.tolerance_s
+
+            log.debug("Expected patterns", job_id=job.id, frequencies_hz=expected_freqs,
+                      strobe_ms=plan.strobe_timings_ms)
+            jobs.record(job, "challenge", {
+                "challenge": '0x' + challenge_hash,
+                "block_range": [base_block, expires_block],
+                "current_block": current_block,
+            })
+
+            # Analyze only as far as the last expected window (or until one passes
+            # without any candidate event), in worker processes so the event loop
+            # keeps serving requests
+            if PARALLEL_STAGES:
+                # Audio and video decoded by separate workers, joined at the matcher
+                async def audio_stage():
+                    result = await job.timed("audio", analysis_pool.run(
+                        analyze_audio, upload.source, expected_freqs, chirp_times_s,
+                        engine=CHIRP_ENGINE,
+                        max_duration_s=MAX_ANALYZED_DURATION_S,
+                        tolerance_s=tolerance_s,
+                        windowed=AUDIO_WINDOWED,
+                        windows=plan.windows,
+                        deadline_s=plan.audio_deadline_s,
+                        band_bins=plan.band_bins,
+                        debug=debug is not None,
+                    ))
+                    jobs.record(job, "audio", {"audio_peaks": result.peaks, "early_reject": result.early_reject})
+                    return result
+
+                async def video_stage():
+                    result = await job.timed("video", analysis_pool.run(
+                        analyze_video, upload.source, expected_times_s,
+                        max_duration_s=MAX_ANALYZED_DURATION_S,
+                        luma_step=LUMA_SUBSAMPLE,
+                        skip_loop_filter=VIDEO_SKIP_LOOP_FILTER,
+                        tolerance_s=tolerance_s,
+                        windowed=AUDIO_WINDOWED,
+                        windows=plan.strobe_windows,
+                        deadline_s=plan.deadline_s,
+                        debug=debug is not None,
+                    ))
+                    jobs.record(job, "strobes", {"strobe_peaks": result.peaks, "early_reject": result.early_reject})
+                    return result
+
+                audio, video = await asyncio.gather(audio_stage(), video_stage(), return_exceptions=True)
+                for outcome in (audio, video):
+                    if isinstance(outcome, BaseException):
+                        raise outcome
+                analysis = combine_streams(audio, video)
+            else:
+                # Decode the upload once, streaming it into the chirp detector, the
+                # strobe detector and the screenshot picker
+                analysis = await job.timed("analysis", analysis_pool.run(
+                    analyze_clip, upload.source, expected_freqs, chirp_times_s,
+                    strobe_times_s=expected_times_s,
+                    engine=CHIRP_ENGINE,
+                    max_duration_s=MAX_ANALYZED_DURATION_S,
+                    luma_step=LUMA_SUBSAMPLE,
+                    skip_loop_filter=VIDEO_SKIP_LOOP_FILTER,
+                    tolerance_s=tolerance_s,
+                    windowed=AUDIO_WINDOWED,
+                    windows=plan.windows,
+                    strobe_windows=plan.strobe_windows,
+                    deadline_s=plan.deadline_s,
+                    band_bins=plan.band_bins,
+                    debug=debug is not None,
+                ))
+                jobs.record(job, "audio", {"audio_peaks": analysis.audio_peaks, "early_reject": analysis.early_reject})
+                jobs.record(job, "strobes", {"strobe_peaks": analysis.strobe_peaks, "early_reject": analysis.early_reject})
+        finally:
+            analysis_pool.release()
+            upload.discard()
+
+        # Time spent inside the workers, next to the wall times above (which include queueing)
+        job.timings.update({f"{stage}_worker": seconds for stage, seconds in analysis.timings.items()})
+        audio_peaks = analysis.audio_peaks
+        strobe_peaks = analysis.strobe_peaks
+        match_started = time.perf_counter()
+
+        report = match_events(expected_times_s, audio_peaks, strobe_peaks, tolerance_s,
+                              chirp_count=len(chirp_times_s))
+        decisions = report.decisions()
+        successes = report.matched
+        matched_audio = [event.audio_s for event in report.events]
+        matched_strobes = [event.strobe_s for event in report.events]
+
+        # Require ALL expected events to match (no misses allowed)
+        required = report.required
+        alignment_ok = report.ok and analysis.early_reject is None
+        job.timings["match"] = round(time.perf_counter() - match_started, 4)
+
+        if log.enabled(DEBUG):
+            log.debug("Matching", job_id=job.id, audio_peaks=audio_peaks, strobe_peaks=strobe_peaks,
+                      tolerance_s=tolerance_s, decisions=decisions)
+        log.info("Verdict", job_id=job.id, verified=alignment_ok, matched=successes, required=required,
+                 early_reject=analysis.early_reject)
 
         audio_match = alignment_ok
         strobe_match = alignment_ok
 
         verified = alignment_ok
-        
-        response = {
+        verdicts_total.inc(verified=str(verified).lower())
+        if not verified:
+            rejects_total.inc(reason="early_reject" if analysis.early_reject else "mismatch")
+
+        job.result = response = {
             "verified": verified,
             "challenge": '0x' + challenge_hash,
             "metrics": {
@@ -398,73 +927,138 @@ async def verify_clip(
                 "expected_audio_count": len(expected_freqs),
                 "detected_audio_count": len(audio_peaks),
                 "strobe_peaks": strobe_peaks,
-                "expected_strobe_count": len(expected_strobes),
+                "expected_strobe_count": len(expected_times_s),
                 "detected_strobe_count": len(strobe_peaks),
                 "matched_audio_peaks": matched_audio,
                 "matched_strobe_peaks": matched_strobes,
                 "expected_strobe_times_s": expected_times_s,
                 "alignment_ok": alignment_ok,
-                "ssim": ssim,
+                "early_reject": analysis.early_reject,
+                "analyzed_until_s": analysis.analyzed_until_s,
+                "ssim": analysis.ssim,
+                "upload_bytes": upload.size,
+                "upload_sha256": upload.sha256,
                 "audio_match": audio_match,
-                "strobe_match": strobe_match
+                "strobe_match": strobe_match,
+                "timings": job.timings
             }
         }
         
-        # If verified, extract screenshot and upload to IPFS
+        jobs.record(job, "verdict", {"verified": verified})
+
+        if debug is not None:
+            artifact = {
+                "job_id": job.id,
+                "trigger": debug,
+                "created_at": time.time(),
+                "challenge": '0x' + challenge_hash,
+                "expected": plan.summary(),
+                "config": {"engine": CHIRP_ENGINE, "windowed": AUDIO_WINDOWED, "parallel_stages": PARALLEL_STAGES,
+                           "luma_step": LUMA_SUBSAMPLE},
+                "analysis": {"audio_peaks": audio_peaks, "strobe_peaks": strobe_peaks,
+                             "analyzed_until_s": analysis.analyzed_until_s, "early_reject": analysis.early_reject},
+                "audio": (analysis.debug or {}).get("audio"),
+                "video": (analysis.debug or {}).get("video"),
+                "matching": {"tolerance_s": tolerance_s, "decisions": decisions, "matched": successes,
+                             "required": required, "verified": verified},
+            }
+            try:
+                size = await run_in_threadpool(artifacts.save, job.id, artifact)
+                response["debug_artifact"] = f"/verify/{job.id}/debug"
+                log.info("Debug artifact saved", job_id=job.id, trigger=debug, bytes=size)
+            except Exception:
+                log.exception("Failed to save debug artifact", job_id=job.id)
+
+        # If verified, encode the screenshot and queue it for pinning to IPFS; the
+        # verdict doesn't wait for the uploader (clients follow GET /pins/{pin_id})
         if verified:
             try:
-                print("[SCREENSHOT] Extracting screenshot from verified footage...")
-                # Extract screenshot from middle of the video
-                screenshot_base64 = extract_screenshot(temp_file, timestamp_s=None)
-                
-                print("[IPFS] Uploading screenshot to IPFS...")
-                ipfs_cid = upload_to_ipfs(screenshot_base64)
-                
-                # Add IPFS data to response
-                response["ipfs_cid"] = ipfs_cid
-                # Include full base64 for preview (browser can handle it)
-                response["screenshot_preview"] = f"data:image/png;base64,{screenshot_base64}"
-                
-                print(f"[SUCCESS] Screenshot uploaded: {ipfs_cid}")
-                print(f"[SUCCESS] Screenshot size: {len(screenshot_base64)} bytes (base64)")
+                if analysis.screenshot is None:
+                    raise ValueError("No video frame available for screenshot")
+                screenshot_started = time.perf_counter()
+                image = await run_in_threadpool(encode_screenshot, analysis.screenshot)
+                thumbnail = await run_in_threadpool(encode_thumbnail, analysis.screenshot)
+                job.timings["screenshot_encode"] = round(time.perf_counter() - screenshot_started, 4)
+
+                # Only the size-capped thumbnail is embedded in the response
+                ext, mime = IMAGE_TYPES[SCREENSHOT_FORMAT]
+                response["screenshot_preview"] = f"data:{mime};base64,{base64.b64encode(thumbnail).decode('ascii')}"
+                response["metrics"]["screenshot_time_s"] = analysis.screenshot_time
+                log.debug("Screenshot encoded", job_id=job.id, time_s=analysis.screenshot_time, bytes=len(image),
+                          format=SCREENSHOT_FORMAT, thumbnail_bytes=len(thumbnail))
+
+                pin = await pins.enqueue(job.id, image, "screenshot" + ext, mime)
+                job.timings["screenshot"] = round(time.perf_counter() - screenshot_started, 4)
+                response["pin_id"] = pin.id
+                apply_pin(response, pin)
+                jobs.record(job, "screenshot", {"pin_id": pin.id, "ipfs_status": pin.status})
             except Exception as e:
-                print(f"[ERROR] Failed to process screenshot: {e}")
-                # Don't fail verification if screenshot upload fails
+                log.exception("Failed to process screenshot", job_id=job.id)
+                # Don't fail verification if the screenshot can't be queued
                 response["ipfs_error"] = str(e)
-        
+                jobs.record(job, "screenshot", {"error": str(e)})
+
         # Store verification in history
-        import time
         verification_entry = {
+            "job_id": job.id,
             "verified": verified,
             "challenge": '0x' + challenge_hash,
             "pop_address": pop_address,
             "token_owner": token_owner,
             "ipfs_cid": response.get("ipfs_cid"),
+            "ipfs_status": response.get("ipfs_status"),
             "screenshot_preview": response.get("screenshot_preview", "")[:200] if response.get("screenshot_preview") else None,  # Truncate for storage
             "timestamp": int(time.time()),
             "block_number": current_block
         }
-        verification_history.insert(0, verification_entry)  # Most recent first
-        # Keep only last 100 verifications
-        if len(verification_history) > 100:
-            verification_history.pop()
-        
-        return response
+        history.add(verification_entry)
+
+        jobs.finish(job)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return {
-            "verified": False,
-            "error": str(e)
-        }
+        rejects_total.inc(reason=e.reason if isinstance(e, VerificationRejected) else "error")
+        if isinstance(e, VerificationRejected):
+            log.info("Job rejected", job_id=job.id, reason=e.reason, error=str(e))
+        else:
+            log.exception("Job failed", job_id=job.id)
+        if job.result is None:
+            job.result = {"verified": False, "error": str(e)}
+        jobs.finish(job, error=str(e))
     finally:
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
+        if key is not None:
+            results.finish(key, job, cacheable=job.result is not None and "ipfs_error" not in job.result)
 
 @app.get("/history")
-async def get_history():
-    """Return verification history"""
+async def get_history(
+    request: Request,
+    response: Response,
+    cursor: Optional[int] = None,
+    limit: int = 50,
+    pop_address: Optional[str] = None,
+    token_owner: Optional[str] = None,
+    verified: Optional[bool] = None,
+    since: Optional[int] = None,
+    count: bool = False,
+):
+    """
+    Verification history, newest first. Filter by pop_address, token_owner,
+    verified and since (unix time); pass next_cursor back as `cursor` for the
+    next page. `total` is only counted with count=true (it scans every
+    matching row). Answers 304 while nothing has changed for an If-None-Match ETag.
+    """
+    query = hashlib.sha1(str(sorted(request.query_params.multi_items())).encode()).hexdigest()[:12]
+    if request.headers.get("if-none-match") == f'"{await history.revision()}-{query}"':
+        return Response(status_code=304)
+    try:
+        revision, total, entries, next_cursor = await history.page(
+            cursor=cursor, limit=limit, pop_address=pop_address, token_owner=token_owner,
+            verified=verified, since=since, count=count,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filter: {e}")
+    response.headers["ETag"] = f'"{revision}-{query}"'
+    response.headers["Cache-Control"] = "no-cache"
     return {
-        "verifications": verification_history,
-        "total": len(verification_history)
+        "verifications": entries,
+        "total": total,
+        "next_cursor": next_cursor,
     }
@@ -0,0 +1,281 @@
+"""
+State shared by several server processes on one host.
+
+`uvicorn server:app --workers N` starts N copies of the server, and each one
+would otherwise keep its own challenge and verdict caches and job table, poll
+the chain on its own, and run as many analyses as its pool allows. With
+SHARED_STATE, they use:
+
+- SharedStore: one SQLite file (WAL) holding the challenge cache, the block
+  height, finished verdicts and job states. Whichever process a client's
+  next request lands on sees the same challenge, verdict and job.
+- FileLease: an flock held by one process at a time; the holder polls the
+  block height and scans challenge logs for everyone.
+- AnalysisSlots: one flock'ed file per slot, capping the decode and analysis
+  jobs running at once across all processes. The kernel releases the locks
+  of a process that dies, so a crash never leaks a slot.
+
+History and the pin outbox are SQLite files in DATA_DIR already, and their
+writes are safe from several processes.
+"""
+import asyncio
+import fcntl
+import json
+import os
+import random
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from logs import get_logger
+
+# Rows older than these are pruned (jobs: since their last change, verdicts: since stored)
+JOB_TTL_S = 600
+RESULT_TTL_S = 3600
+# Pruning runs after this many writes
+PRUNE_EVERY = 500
+# Slot polling while every analysis slot is taken (doubles up to the max)
+SLOT_POLL_S = 0.01
+SLOT_POLL_MAX_S = 0.1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS challenges (address TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, verdict TEXT NOT NULL, stored_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, snapshot TEXT NOT NULL, updated_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS chain (key TEXT PRIMARY KEY, value INTEGER NOT NULL, updated_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated_at);
+CREATE INDEX IF NOT EXISTS results_stored ON results (stored_at);
+"""
+
+log = get_logger("shared")
+
+
+class SharedStore:
+    """
+    SQLite store for state shared across server processes. All database
+    access goes through one thread per process. Writes with put_* are
+    queued on that thread without waiting for them; reads see every write
+    this process queued before them.
+    """
+
+    def __init__(self, path: str, job_ttl_s: float = JOB_TTL_S, result_ttl_s: float = RESULT_TTL_S):
+        self.path = path
+        self.job_ttl_s = job_ttl_s
+        self.result_ttl_s = result_ttl_s
+        self.reads = 0
+        self.writes = 0
+        self.errors = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    async def _db(self, fn, *args):
+        self.reads += 1
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _submit(self, fn, *args):
+        self.writes += 1
+        self._executor.submit(self._guarded, fn, *args)
+
+    def _guarded(self, fn, *args):
+        try:
+            fn(*args)
+            if self.writes % PRUNE_EVERY == 0:
+                self._prune()
+        except Exception as e:
+            self.errors += 1
+            log.error("Shared state write failed", error=str(e))
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=10.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    # -- database (shared-state thread only) --
+
+    def _upsert(self, table: str, key_column: str, value_column: str, time_column: str, key: str, value: str):
+        self._connection().execute(
+            f"INSERT OR REPLACE INTO {table} ({key_column}, {value_column}, {time_column}) VALUES (?, ?, ?)",
+            (key, value, time.time()),
+        )
+
+    def _select(self, sql: str, params: tuple) -> list:
+        return self._connection().execute(sql, params).fetchall()
+
+    def _delete(self, table: str, key_column: str, keys: List[str]) -> int:
+        if not keys:
+            return 0
+        cursor = self._connection().execute(
+            f"DELETE FROM {table} WHERE {key_column} IN ({', '.join('?' * len(keys))})", keys)
+        return cursor.rowcount
+
+    def _prune(self):
+        now = time.time()
+        conn = self._connection()
+        conn.execute("DELETE FROM jobs WHERE updated_at < ?", (now - self.job_ttl_s,))
+        conn.execute("DELETE FROM results WHERE stored_at < ?", (now - self.result_ttl_s,))
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # -- challenges and block height --
+
+    async def get_challenges(self, addresses: Iterable[str]) -> Dict[str, dict]:
+        """Stored challenge states (ChallengeState fields) by checksum address."""
+        addresses = list(addresses)
+        if not addresses:
+            return {}
+        rows = await self._db(self._select, f"SELECT address, state FROM challenges WHERE address IN"
+                                            f" ({', '.join('?' * len(addresses))})", tuple(addresses))
+        return {address: json.loads(state) for address, state in rows}
+
+    async def challenge_addresses(self) -> List[str]:
+        return [address for (address,) in await self._db(self._select, "SELECT address FROM challenges", ())]
+
+    def put_challenge(self, address: str, state: dict):
+        self._submit(self._upsert, "challenges", "address", "state", "updated_at", address, json.dumps(state))
+
+    async def drop_challenges(self, addresses: List[str]) -> int:
+        return await self._db(self._delete, "challenges", "address", list(addresses))
+
+    async def block(self) -> Tuple[Optional[int], float]:
+        """The last published block height and its age in seconds (inf when none)."""
+        rows = await self._db(self._select, "SELECT value, updated_at FROM chain WHERE key = 'block'", ())
+        if not rows:
+            return None, float("inf")
+        block, updated_at = rows[0]
+        return block, max(0.0, time.time() - updated_at)
+
+    def put_block(self, block: int):
+        self._submit(self._upsert, "chain", "key", "value", "updated_at", "block", block)
+
+    # -- verdicts --
+
+    async def get_result(self, key: str) -> Optional[dict]:
+        rows = await self._db(self._select, "SELECT verdict FROM results WHERE key = ? AND stored_at >= ?",
+                              (key, time.time() - self.result_ttl_s))
+        return json.loads(rows[0][0]) if rows else None
+
+    def put_result(self, key: str, verdict: dict):
+        self._submit(self._upsert, "results", "key", "verdict", "stored_at", key, json.dumps(verdict))
+
+    # -- jobs --
+
+    async def get_job(self, job_id: str) -> Optional[dict]:
+        rows = await self._db(self._select, "SELECT snapshot FROM jobs WHERE id = ? AND updated_at >= ?",
+                              (job_id, time.time() - self.job_ttl_s))
+        return json.loads(rows[0][0]) if rows else None
+
+    def put_job(self, job_id: str, snapshot: dict):
+        # Serialized here: the job keeps changing on the event loop while the write waits
+        self._submit(self._upsert, "jobs", "id", "snapshot", "updated_at", job_id, json.dumps(snapshot))
+
+    def drop_job(self, job_id: str):
+        self._submit(self._delete, "jobs", "id", [job_id])
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+
+    def stats(self) -> dict:
+        return {"reads": self.reads, "writes": self.writes, "errors": self.errors}
+
+
+class FileLease:
+    """
+    Exclusive flock on `path`, held by at most one process on the host until
+    it exits or release()s; the others keep trying with acquire().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self) -> bool:
+        """Take the lease if it is free; True while this process holds it."""
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        log.info("Lease acquired", path=self.path, pid=os.getpid())
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class AnalysisSlots:
+    """
+    Caps decode and analysis jobs running at once across every process using
+    `directory`: a job holds an flock on one of `limit` slot files. Waiting
+    polls, so there is no ordering between processes.
+    """
+
+    def __init__(self, directory: str, limit: int):
+        self.directory = directory
+        self.limit = max(1, limit)
+        self.waits = 0
+        self._fds: List[Optional[int]] = [None] * self.limit
+        self._held: Set[int] = set()
+
+    def _fd(self, slot: int) -> int:
+        if self._fds[slot] is None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"slot-{slot}.lock")
+            self._fds[slot] = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        return self._fds[slot]
+
+    def try_acquire(self) -> Optional[int]:
+        """A free slot's number (now held), or None when all are taken."""
+        start = random.randrange(self.limit)  # spread processes over the slot files
+        for i in range(self.limit):
+            slot = (start + i) % self.limit
+            if slot in self._held:
+                continue
+            try:
+                fcntl.flock(self._fd(slot), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            self._held.add(slot)
+            return slot
+        return None
+
+    async def acquire(self) -> int:
+        slot = self.try_acquire()
+        delay = SLOT_POLL_S
+        if slot is None:
+            self.waits += 1
+        while slot is None:
+            await asyncio.sleep(delay)
+            delay = min(SLOT_POLL_MAX_S, delay * 2)
+            slot = self.try_acquire()
+        return slot
+
+    def release(self, slot: int):
+        if slot in self._held:
+            self._held.discard(slot)
+            fcntl.flock(self._fds[slot], fcntl.LOCK_UN)
+
+    @property
+    def held(self) -> int:
+        """Slots this process holds (other processes' are not probed: that would race real acquirers)."""
+        return len(self._held)
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "held_here": self.held, "waits": self.waits}
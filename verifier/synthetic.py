@@ -0,0 +1,106 @@
+"""
+Synthetic challenge recordings.
+
+Tones and ROI strobes at the times the benchmark challenge derives, muxed
+like a browser recording, in any duration, resolution, frame rate, codec
+and noise level. bench.py and loadtest.py measure with them, and the
+server's startup warmup (warmup.py) runs a short one through the pipeline.
+"""
+import os
+from dataclasses import dataclass
+
+import av
+import numpy as np
+
+from challenge import derive_challenge
+
+# Challenge the synthetic clips answer (realistic frequencies and timings)
+BENCH_CHALLENGE = "0x6ef75522465ec01539b7a5d7a57e972c0669f8ae9af8f003dfe4c417ecbd504b"
+# Strobe ROI drawn into the clips; must match pipeline.STROBE_ROI
+ROI = (100, 100, 200, 200)
+# Tone and flash length, as the web app plays them
+EVENT_S = 0.1
+RESOLUTIONS = {"480p": (640, 480), "720p": (1280, 720), "1080p": (1920, 1080)}
+# codec -> (container extension, video encoder, encoder options, audio encoder, audio rate)
+CODECS = {
+    "vp8": (".webm", "libvpx", {"deadline": "realtime", "cpu-used": "8"}, "libopus", 48000),
+    "vp9": (".webm", "libvpx-vp9", {"deadline": "realtime", "cpu-used": "8"}, "libopus", 48000),
+    "h264": (".mp4", "libx264", {"preset": "ultrafast"}, "aac", 44100),
+}
+
+
+@dataclass(frozen=True)
+class ClipSpec:
+    duration_s: float
+    resolution: str
+    fps: int
+    codec: str
+    noise: float  # noise amplitude relative to the tones (audio) and the flash (video)
+
+    @property
+    def name(self) -> str:
+        return f"{self.duration_s:g}s-{self.resolution}-{self.fps}fps-{self.codec}-noise{self.noise:g}"
+
+
+def expected_events():
+    derived = derive_challenge(BENCH_CHALLENGE)
+    return derived["audio_frequencies"], [t / 1000.0 for t in derived["strobe_timings"]]
+
+
+def synthesize_clip(spec: ClipSpec, path: str, seed: int = 0):
+    """Mux a recording of the bench challenge matching `spec` into `path`."""
+    ext, video_codec, options, audio_codec, sr = CODECS[spec.codec]
+    width, height = RESOLUTIONS[spec.resolution]
+    freqs, times = expected_events()
+    rng = np.random.default_rng(seed)
+
+    t = np.arange(int(spec.duration_s * sr)) / sr
+    audio = np.zeros_like(t)
+    for freq, start in zip(freqs, times):
+        span = (t >= start) & (t < start + EVENT_S)
+        audio[span] += 0.5 * np.sin(2 * np.pi * freq * t[span])
+    audio += rng.normal(0.0, 0.5 * spec.noise, len(audio))
+    audio = np.clip(audio, -1.0, 1.0).astype(np.float32)
+
+    # A few noise planes are cycled; generating one per 1080p frame would dominate the run
+    background = np.full((height, width, 3), 32, dtype=np.int16)
+    planes = [rng.normal(0.0, 64 * spec.noise, (height, width, 1)).astype(np.int16) for _ in range(4)] \
+        if spec.noise else [np.zeros((1, 1, 1), dtype=np.int16)]
+    x, y, w, h = ROI
+
+    container = av.open(path, mode="w")
+    video = container.add_stream(video_codec, rate=spec.fps, options=options)
+    video.width, video.height, video.pix_fmt = width, height, "yuv420p"
+    audio_stream = container.add_stream(audio_codec, rate=sr)
+    audio_stream.codec_context.layout = "mono"
+
+    block = 1024
+    for start in range(0, len(audio), block):
+        frame = av.AudioFrame.from_ndarray(audio[None, start:start + block], format="flt", layout="mono")
+        frame.sample_rate = sr
+        frame.pts = start
+        for packet in audio_stream.encode(frame):
+            container.mux(packet)
+    for i in range(int(spec.duration_s * spec.fps)):
+        pixels = background + planes[i % len(planes)]
+        if any(start <= i / spec.fps < start + EVENT_S for start in times):
+            pixels[y:y + h, x:x + w] = 255
+        frame = av.VideoFrame.from_ndarray(np.clip(pixels, 0, 255).astype(np.uint8), format="bgr24")
+        frame.pts = i
+        for packet in video.encode(frame):
+            container.mux(packet)
+    for stream in (audio_stream, video):
+        for packet in stream.encode(None):
+            container.mux(packet)
+    container.close()
+
+
+def clip_path(spec: ClipSpec, clips_dir: str) -> str:
+    """The synthesized clip for `spec` in `clips_dir`, generated on first use."""
+    path = os.path.join(clips_dir, spec.name + CODECS[spec.codec][0])
+    if not os.path.exists(path):
+        # Per-process scratch name: several server processes may warm up from the same directory
+        part = f"{path}.{os.getpid()}.part{CODECS[spec.codec][0]}"
+        synthesize_clip(spec, part)
+        os.replace(part, path)
+    return path
@@ -1,74 +1,1189 @@
+import asyncio
 import numpy as np
 import cv2
+import av
 import soundfile as sf
 import os
-from audio import detect_chirps
-from video import detect_strobes
+import tracemalloc
+from audio import detect_chirps, ChirpStream, HOP_LENGTH
+from video import detect_strobes, detect_strobes_in_luminance, StrobeStream
+from ingest import ScreenshotPicker, decode_clip, demux, frame_quality, roi_luminance
+from pipeline import analyze_audio, analyze_clip, analyze_video, analysis_deadline, combine_streams
+from workers import AnalysisPool, PoolSaturated, PoolUnavailable
+from jobs import JobStore
+from results import ResultCache, result_key
+from pinning import PinOutbox
+from history import HistoryStore
+from matching import match_events
+from plans import PlanCache, build_plan
+from challenge import ChallengeError
+from metrics import Counter, Registry
+from artifacts import ArtifactStore
+import bench
+import synthetic
+import warmup
+import loadtest
+import logs
+import contextlib
+import io
+import json
+import re
+import shutil
+import sys
+import subprocess
+from chain import BlockTracker, ChainError, ChainReader, ChallengeCache
+from uploads import UploadError, receive_upload, receive_uploads
+from shared import AnalysisSlots, FileLease, SharedStore
+from fakes import FakeRpc, FakeUploader
+from starlette.requests import Request
+import hashlib
+import tempfile
+import time
 
-def generate_test_assets():
-    # Generate Audio with chirps at 900, 1200, 1500 Hz
-    sr = 44100
-    duration = 5.0
+CHIRP_TIMES = [1.0, 2.5, 4.0]
+FREQS = [900, 1200, 1500]
+ROI = (100, 100, 200, 200)
+
+def synthesize_audio(sr, duration):
     t = np.linspace(0, duration, int(sr * duration), endpoint=False)
     audio = np.zeros_like(t)
-    
-    # Add chirps
-    chirp_times = [1.0, 2.5, 4.0]
-    freqs = [900, 1200, 1500]
-    
-    for i, time in enumerate(chirp_times):
+
+    for i, time in enumerate(CHIRP_TIMES):
         # 100ms chirp
         start_idx = int(time * sr)
         end_idx = int((time + 0.1) * sr)
         segment_t = t[start_idx:end_idx]
-        audio[start_idx:end_idx] += 0.5 * np.sin(2 * np.pi * freqs[i] * segment_t)
-        
-    sf.write('test.wav', audio, sr)
+        audio[start_idx:end_idx] += 0.5 * np.sin(2 * np.pi * FREQS[i] * segment_t)
+    return audio
+
+def synthesize_frame(i, fps, width, height):
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+
+    # Strobe times matching audio roughly
+    strobe_frames = [int(t * fps) for t in CHIRP_TIMES]
+
+    # Draw strobe if current frame is a strobe frame
+    is_strobe = False
+    for sf_idx in strobe_frames:
+        if i >= sf_idx and i < sf_idx + 3: # 3 frames duration
+            is_strobe = True
+            break
+
+    if is_strobe:
+        # White rectangle in ROI (100, 100, 200, 200)
+        cv2.rectangle(frame, (100, 100), (300, 300), (255, 255, 255), -1)
+    return frame
+
+def write_webm(path, duration=5.0, fps=30, width=640, height=480, sr=48000):
+    """Mux audio chirps and video strobes into one WebM (VP8/Opus), like a browser recording"""
+    audio = synthesize_audio(sr, duration).astype(np.float32)
+    container = av.open(path, mode='w')
+    video_stream = container.add_stream('libvpx', rate=fps)
+    video_stream.width, video_stream.height, video_stream.pix_fmt = width, height, 'yuv420p'
+    audio_stream = container.add_stream('libopus', rate=sr)
+    audio_stream.codec_context.layout = 'mono'
+
+    block = 960
+    for start in range(0, len(audio), block):
+        frame = av.AudioFrame.from_ndarray(audio[None, start:start + block], format='flt', layout='mono')
+        frame.sample_rate = sr
+        frame.pts = start
+        for packet in audio_stream.encode(frame):
+            container.mux(packet)
+    for i in range(int(duration * fps)):
+        frame = av.VideoFrame.from_ndarray(synthesize_frame(i, fps, width, height), format='bgr24')
+        frame.pts = i
+        for packet in video_stream.encode(frame):
+            container.mux(packet)
+    for stream in (audio_stream, video_stream):
+        for packet in stream.encode(None):
+            container.mux(packet)
+    container.close()
+
+def generate_test_assets():
+    # Generate Audio with chirps at 900, 1200, 1500 Hz
+    sr = 44100
+    duration = 5.0
+    sf.write('test.wav', synthesize_audio(sr, duration), sr)
     print("Generated test.wav")
-    
+
     # Generate Video with strobes
     width, height = 640, 480
     fps = 30
     out = cv2.VideoWriter('test.mp4', cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
-    
-    # Strobe times matching audio roughly
-    strobe_frames = [int(t * fps) for t in chirp_times]
-    
     for i in range(int(duration * fps)):
-        frame = np.zeros((height, width, 3), dtype=np.uint8)
-        
-        # Draw strobe if current frame is a strobe frame
-        is_strobe = False
-        for sf_idx in strobe_frames:
-            if i >= sf_idx and i < sf_idx + 3: # 3 frames duration
-                is_strobe = True
-                break
-        
-        if is_strobe:
-            # White rectangle in ROI (100, 100, 200, 200)
-            cv2.rectangle(frame, (100, 100), (300, 300), (255, 255, 255), -1)
-            
-        out.write(frame)
-        
+        out.write(synthesize_frame(i, fps, width, height))
     out.release()
     print("Generated test.mp4")
 
+    # Generate a muxed browser-style recording
+    write_webm('test.webm', duration=duration, fps=fps, width=width, height=height)
+    print("Generated test.webm")
+
+def assert_near(detected, expected, tol=0.1):
+    assert len(detected) == len(expected), f"{detected} != {expected}"
+    for d, e in zip(detected, expected):
+        assert abs(d - e) <= tol, f"{detected} != {expected}"
+
+def setup_module():
+    generate_test_assets()
+
+def teardown_module():
+    for path in ('test.wav', 'test.mp4', 'test.webm'):
+        if os.path.exists(path):
+            os.remove(path)
+
 def test_detection():
     print("Testing detection...")
-    
+
     # Test Audio
-    detected_audio = detect_chirps('test.wav', [900, 1200, 1500])
+    detected_audio = detect_chirps('test.wav', FREQS)
     print(f"Detected Audio Chirps: {detected_audio}")
-    
+    assert_near(detected_audio, CHIRP_TIMES)
+
     # Test Video
     # ROI: x=100, y=100, w=200, h=200
-    detected_video = detect_strobes('test.mp4', (100, 100, 200, 200))
+    detected_video = detect_strobes('test.mp4', ROI)
+    print(f"Detected Video Strobes: {detected_video}")
+    assert_near(detected_video, CHIRP_TIMES)
+
+def test_single_pass_decode():
+    print("Testing single-pass decode...")
+
+    clip = decode_clip('test.webm', ROI)
+    assert clip.screenshot is not None
+    assert clip.screenshot.shape == (480, 640, 3)
+
+    detected_audio = detect_chirps(clip.samples, FREQS, sr=clip.sample_rate)
+    print(f"Detected Audio Chirps: {detected_audio}")
+    assert_near(detected_audio, CHIRP_TIMES)
+
+    detected_video = detect_strobes_in_luminance(clip.luminance, clip.frame_times)
     print(f"Detected Video Strobes: {detected_video}")
-    
-    # Cleanup
-    os.remove('test.wav')
-    os.remove('test.mp4')
+    assert_near(detected_video, CHIRP_TIMES)
+
+def test_engine_parity():
+    print("Testing chirp engine parity...")
+
+    sr = 44100
+    rng = np.random.default_rng(0)
+    clean = synthesize_audio(sr, 5.0)
+    noisy = clean + 0.02 * rng.standard_normal(len(clean))
+    clip = decode_clip('test.webm', ROI)
+    cases = [
+        ('test.wav', None),
+        (clean.astype(np.float32), sr),
+        (noisy.astype(np.float32), sr),
+        (clip.samples, clip.sample_rate),
+    ]
+    for audio, audio_sr in cases:
+        reference = detect_chirps(audio, FREQS, sr=audio_sr, engine="stft")
+        targeted = detect_chirps(audio, FREQS, sr=audio_sr, engine="goertzel")
+        print(f"STFT: {reference}, Goertzel: {targeted}")
+        # Onsets may differ by at most one analysis frame (thresholds are estimated differently)
+        assert_near(targeted, reference, tol=HOP_LENGTH / sr + 1e-6)
+        assert_near(targeted, CHIRP_TIMES)
+
+def test_streaming_detectors():
+    print("Testing streaming detectors...")
+
+    clip = decode_clip('test.webm', ROI)
+    chirps = ChirpStream(FREQS, clip.sample_rate)
+    strobes = StrobeStream(ROI)
+    demux('test.webm', [chirps, strobes])
+    assert_near(chirps.finish(), detect_chirps(clip.samples, FREQS, sr=clip.sample_rate, engine="goertzel"), tol=1e-9)
+    assert_near(strobes.finish(), detect_strobes_in_luminance(clip.luminance, clip.frame_times), tol=1e-9)
+
+    # Variable frame rate (every third frame dropped) and equal-height flashes
+    # closer than MIN_STROBE_SPACING_S pick the same strobes in both paths
+    frame_times = np.array([i / 30 for i in range(150) if i % 3 != 2])
+    dropped = np.full(len(frame_times), 40.0)
+    dropped[[20, 27, 60, 65]] = [200.0, 120.0, 180.0, 180.0]
+    saturated = np.full(150, 40.0)
+    saturated[[30, 36]] = 240.0
+    for luminance, times in [(dropped, frame_times), (saturated, np.arange(150) / 30)]:
+        stream = StrobeStream(ROI)
+        for lum, t in zip(luminance, times):
+            stream.feed(float(lum), float(t))
+        expected = detect_strobes_in_luminance(luminance, times)
+        print(f"Streamed: {stream.finish()}, batch: {expected}")
+        assert_near(stream.finish(), expected, tol=1e-9)
+
+    # Memory stays flat for a 2 minute recording and max_duration_s caps the analysis
+    sr = 44100
+    clean = synthesize_audio(sr, 5.0).astype(np.float32)
+    long_clip = np.tile(clean, 24)
+    tracemalloc.start()
+    stream = ChirpStream(FREQS, sr)
+    for start in range(0, len(long_clip), 4096):
+        stream.feed(long_clip[start:start + 4096])
+    detected = stream.finish()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"Streamed {len(long_clip) / sr:.0f}s, peak {peak / 1e6:.2f} MB")
+    assert len(detected) == 3 * 24
+    assert peak < 4e6
+
+    capped = ChirpStream(FREQS, sr, max_duration_s=5.0)
+    capped.feed(long_clip)
+    assert_near(capped.finish(), CHIRP_TIMES)
+
+    strobes = StrobeStream(ROI, max_duration_s=3.0)
+    demux('test.webm', [strobes], max_duration_s=3.0)
+    assert_near(strobes.finish(), CHIRP_TIMES[:2])
+
+def test_windowed_analysis():
+    print("Testing window-sparse chirp analysis...")
+
+    sr = 44100
+    rng = np.random.default_rng(1)
+    clean = synthesize_audio(sr, 5.0)
+    noisy = clean + 0.02 * rng.standard_normal(len(clean))
+    clip = decode_clip('test.webm', ROI)
+    windows = [(t - 0.6, t + 0.6) for t in CHIRP_TIMES]
+    for audio, audio_sr in [(clean.astype(np.float32), sr), (noisy.astype(np.float32), sr), (clip.samples, clip.sample_rate)]:
+        full = detect_chirps(audio, FREQS, sr=audio_sr, engine="goertzel")
+        windowed = detect_chirps(audio, FREQS, sr=audio_sr, engine="goertzel", windows=windows)
+        print(f"Full: {full}, windowed: {windowed}")
+        assert_near(windowed, full, tol=1e-9)
+
+    # Only the windows (plus the cluster lead-in) are transformed
+    stream = ChirpStream(FREQS, sr, windows=windows)
+    stream.feed(clean.astype(np.float32))
+    assert_near(stream.finish(), CHIRP_TIMES)
+    assert stream.frames_transformed < 0.85 * stream.n_frames
+
+    # Chirps outside every window are not reported
+    assert_near(detect_chirps(clean.astype(np.float32), FREQS, sr=sr, engine="goertzel", windows=windows[:2]),
+                CHIRP_TIMES[:2])
+
+    # Windows are settled as soon as their noise span is read, so pending candidates stay bounded
+    long_clip = np.tile(clean.astype(np.float32), 8)
+    long_times = [t + 5.0 * k for k in range(8) for t in CHIRP_TIMES]
+    stream = ChirpStream(FREQS, sr, windows=[(t - 0.6, t + 0.6) for t in long_times])
+    pending = 0
+    for start in range(0, len(long_clip), 4096):
+        stream.feed(long_clip[start:start + 4096])
+        pending = max(pending, sum(len(c) for c in stream._candidates.values()))
+        if stream.analyzed_until_s > 8.0:
+            assert stream.has_candidate_between(6.4, 7.6) and not stream.has_candidate_between(7.7, 8.3)
+    assert_near(stream.finish(), long_times)
+    print(f"Pending chirp candidates: at most {pending}")
+    assert pending < 3 * 30
+
+    # Strobe candidates far from every window are dropped as they are found
+    strobes = StrobeStream(ROI, windows=[(t - 0.6, t + 0.6) for t in CHIRP_TIMES[:1]])
+    demux('test.webm', [strobes])
+    assert_near(strobes.finish(), CHIRP_TIMES[:1])
+    assert not strobes.has_candidate_between(2.0, 4.1)
+
+def test_roi_luminance():
+    print("Testing ROI luma extraction...")
+
+    for path in ('test.webm', 'test.mp4'):
+        with av.open(path) as container:
+            for i, frame in enumerate(container.decode(video=0)):
+                if i % 10:
+                    continue
+                gray = frame.to_ndarray(format='gray')[100:300, 100:300]
+                assert abs(roi_luminance(frame, ROI) - float(np.mean(gray))) < 1.0
+                assert abs(roi_luminance(frame, ROI, step=2) - float(np.mean(gray[::2, ::2]))) < 1.0
+
+    strobes = StrobeStream(ROI, luma_step=4)
+    demux('test.webm', [strobes], skip_loop_filter=True)
+    assert_near(strobes.finish(), CHIRP_TIMES)
+
+def test_early_termination():
+    print("Testing early termination...")
+
+    # Decoding stops at the last window that can still change the verdict
+    analysis = analyze_clip('test.webm', FREQS, CHIRP_TIMES[:2])
+    assert analysis.early_reject is None
+    assert analysis.analyzed_until_s <= analysis_deadline(CHIRP_TIMES[:2]) + 0.05
+    assert_near(analysis.audio_peaks, CHIRP_TIMES[:2])
+    assert_near(analysis.strobe_peaks, CHIRP_TIMES[:2])
+    assert analysis.screenshot is not None
+
+    # A window with no event rejects as soon as it has passed
+    analysis = analyze_clip('test.webm', FREQS, [1.0, 1.8, 4.0])
+    print(f"Early reject: {analysis.early_reject} at {analysis.analyzed_until_s:.2f}s")
+    assert analysis.early_reject is not None
+    assert analysis.analyzed_until_s < 3.5
+
+def test_split_stream_analysis():
+    print("Testing per-stream analysis stages...")
+
+    single = analyze_clip('test.webm', FREQS, CHIRP_TIMES)
+    split = combine_streams(analyze_audio('test.webm', FREQS, CHIRP_TIMES), analyze_video('test.webm', CHIRP_TIMES))
+    assert_near(split.audio_peaks, single.audio_peaks, tol=1e-9)
+    assert_near(split.strobe_peaks, single.strobe_peaks, tol=1e-9)
+    assert split.screenshot is not None and split.screenshot_time == single.screenshot_time
+    assert set(split.timings) == {"audio", "video"}
+
+    # Each stream still stops at its own missed window
+    split = combine_streams(analyze_audio('test.webm', FREQS, [1.0, 1.8, 4.0]), analyze_video('test.webm', [1.0, 1.8, 4.0]))
+    assert split.early_reject is not None and split.screenshot is None
+
+def test_analysis_pool():
+    print("Testing bounded analysis pool...")
+
+    pool = AnalysisPool(workers=1, queue_depth=1)
+
+    async def run():
+        with pool.admit():
+            with pool.admit():
+                # Both slots taken: the next request is refused with a retry hint
+                try:
+                    with pool.admit():
+                        assert False, "admitted past capacity"
+                except PoolSaturated as e:
+                    assert e.retry_after_s >= 1
+            return await pool.run(analyze_clip, 'test.webm', FREQS, CHIRP_TIMES)
+
+    try:
+        analysis = asyncio.run(run())
+    finally:
+        pool.shutdown()
+    assert pool.in_flight == 0 and pool.rejected == 1
+    assert_near(analysis.audio_peaks, CHIRP_TIMES)
+    assert_near(analysis.strobe_peaks, CHIRP_TIMES)
+
+def test_startup_warmup():
+    print("Testing worker warmup at startup...")
+
+    pool = AnalysisPool(workers=1, queue_depth=0)
+
+    async def run():
+        await pool.start(clip)
+        # The warmed worker answers the first job without paying the imports
+        started = time.perf_counter()
+        with pool.admit():
+            analysis = await pool.run(analyze_clip, 'test.webm', FREQS, CHIRP_TIMES)
+        return analysis, time.perf_counter() - started
+
+    with tempfile.TemporaryDirectory() as directory:
+        clip = warmup.warmup_clip(directory)
+        assert warmup.warmup_clip(directory) == clip and os.path.getsize(clip) > 0
+        try:
+            analysis, elapsed = asyncio.run(run())
+        finally:
+            pool.shutdown()
+    print(f"First job on a warmed worker: {elapsed:.2f}s")
+    assert pool.warmup_clip == clip
+    assert_near(analysis.audio_peaks, CHIRP_TIMES)
+    # The warmup clip comes from synthetic.py; the server never loads the benchmark CLI
+    subprocess.run([sys.executable, '-c', "import sys, warmup; assert 'bench' not in sys.modules"], check=True)
+
+def test_job_events():
+    print("Testing verification job events...")
+
+    async def run():
+        store = JobStore()
+        job = store.create()
+        store.record(job, "challenge")
+        seen = []
+
+        async def follow():
+            async for stage in store.events(job, heartbeat_s=0.05):
+                seen.append(stage["stage"] if stage else None)
+
+        follower = asyncio.create_task(follow())
+        await asyncio.sleep(0.12)
+        job.result = {"verified": True}
+        store.record(job, "verdict", {"verified": True})
+        store.finish(job)
+        await asyncio.wait_for(follower, timeout=1.0)
+        return store, job, seen
+
+    store, job, seen = asyncio.run(run())
+    # Past stages are replayed, idle gaps produce heartbeats, the stream ends with the job
+    stages = [s for s in seen if s is not None]
+    assert stages == ["challenge", "verdict", "complete"]
+    assert None in seen
+    assert job.snapshot()["status"] == "complete"
+    assert store.get(job.id) is job and store.get("missing") is None
+
+def test_event_matching():
+    print("Testing optimal event matching...")
+
+    # Nearest-first would give 1.3 to the event at 1.0 and leave 1.4 with nothing in range
+    report = match_events([1.0, 1.4], [1.3, 0.5], [0.5, 1.3], tolerance_s=0.6)
+    assert report.ok and report.matched == 2
+    assert [e.audio_s for e in report.events] == [0.5, 1.3]
+    assert [e.strobe_s for e in report.events] == [0.5, 1.3]
+
+    # A peak serves one event only; misses say why and what was closest
+    report = match_events([1.0, 1.2], [1.1], [1.0, 1.2], tolerance_s=0.3)
+    assert not report.ok and report.matched == 1
+    missed = [d for d in report.decisions() if not d['ok']]
+    assert missed[0]['missed'] == ['audio'] and missed[0]['nearest_audio_s'] == 1.1
+
+    # Strobes must also be near the event's chirp
+    report = match_events([2.0], [1.6], [2.4], tolerance_s=0.5)
+    assert report.decisions()[0]['missed'] == ['audio_strobe_gap']
+
+    # Events past the chirps need only a strobe; none are dropped
+    report = match_events([1.0, 2.0, 3.0], [1.0, 2.0], [1.0, 2.0], tolerance_s=0.2, chirp_count=2)
+    assert report.required == 3 and report.matched == 2
+    assert report.decisions()[2]['missed'] == ['strobe'] and report.decisions()[2]['audio_expected'] is False
+    assert match_events([1.0, 2.0, 3.0], [1.0, 2.0], [1.0, 2.0, 3.05], tolerance_s=0.2, chirp_count=2).ok
+    assert not match_events([1.0], [], [1.0]).ok
+
+    # Tens of events among hundreds of noise peaks
+    rng = np.random.default_rng(7)
+    expected = np.arange(40) * 0.5 + 0.5
+    noise = rng.uniform(0, 21, 400)
+    audio = np.concatenate([expected + rng.uniform(-0.05, 0.05, 40), noise])
+    strobes = np.concatenate([expected + rng.uniform(-0.05, 0.05, 40), rng.permutation(noise)])
+    started = time.perf_counter()
+    report = match_events(expected.tolist(), audio.tolist(), strobes.tolist(), tolerance_s=0.3)
+    elapsed = time.perf_counter() - started
+    print(f"40 events, 440 peaks per stream: {elapsed * 1000:.1f}ms")
+    assert report.ok and elapsed < 1.0
+    assert not match_events(expected.tolist(), audio[1:].tolist(), strobes.tolist(), tolerance_s=0.01).ok
+
+WEB_CHALLENGE_TS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web', 'src', 'lib', 'challenge.ts')
+
+def web_derive_challenges(hashes):
+    """deriveChallenge from the web client, run under node with the TypeScript types stripped."""
+    with open(WEB_CHALLENGE_TS) as f:
+        source = f.read()
+    source = re.sub(r'export interface \w+ \{.*?\n\}\n', '', source, flags=re.S)
+    source = re.sub(r':\s*(?:string|number|DerivedChallenge|FormData|ChallengeParams)(?:\[\])?', '', source)
+    source = source.replace('export ', '')
+    source += '\nconsole.log(JSON.stringify(JSON.parse(process.argv[1]).map(deriveChallenge)));\n'
+    out = subprocess.run(['node', '-e', source, json.dumps(hashes)], capture_output=True, text=True, check=True)
+    return json.loads(out.stdout)
+
+def test_detection_plans():
+    print("Testing detection plans and their sync with the web client...")
+
+    rng = np.random.default_rng(11)
+    hashes = ['0x' + bytes(rng.integers(0, 256, 32, dtype=np.uint8)).hex() for _ in range(300)]
+    hashes.append(synthetic.BENCH_CHALLENGE)
+    if shutil.which('node') is None:
+        print("node not found, skipping the web client cross-check")
+        web = None
+    else:
+        web = web_derive_challenges(hashes)
+
+    unusable = 0
+    for i, challenge_hash in enumerate(hashes):
+        try:
+            plan = build_plan(challenge_hash)
+        except ChallengeError:
+            unusable += 1
+            # The web client derives NaN (null) timings from these
+            assert web is None or None in web[i]['strobeTimings']
+            continue
+        if web is not None:
+            assert list(plan.audio_frequencies) == web[i]['audioFrequencies'], challenge_hash
+            assert list(plan.strobe_timings_ms) == web[i]['strobeTimings'], challenge_hash
+        assert plan.expected_times_s == tuple(t / 1000.0 for t in plan.strobe_timings_ms)
+        assert plan.chirp_times_s == plan.expected_times_s[:len(plan.audio_frequencies)]
+        assert all(plan.band_bins) and plan.deadline_s > max(plan.expected_times_s)
+    assert 0 < unusable < 30
+
+    cache = PlanCache(max_entries=2)
+    first = cache.get(hashes[0])
+    assert cache.get(hashes[0].upper().replace('0X', '0x')) is first and (cache.hits, cache.misses) == (1, 1)
+    try:
+        plan.band_bins = ()
+        assert False, "plans are mutable"
+    except AttributeError:
+        pass
+    # Batch precompile skips unusable hashes; the LRU keeps the newest plans
+    plans = cache.precompile(hashes[:5] + ['0x' + '00' * 32, '0x1234'])
+    assert set(plans) == set(hashes[:5])
+    assert cache.stats()['plans'] == 2 and cache.get(hashes[4]) is plans[hashes[4]]
+
+    # The pipeline takes a plan's windows, deadline and band bins instead of deriving them
+    from audio import band_bins, filter_bank
+    from ingest import AUDIO_SAMPLE_RATE
+    bands = tuple(tuple(band_bins(f, AUDIO_SAMPLE_RATE)) for f in FREQS)
+    assert np.array_equal(filter_bank(tuple(FREQS), AUDIO_SAMPLE_RATE, 50.0, bands).bin_freqs,
+                          filter_bank(tuple(FREQS), AUDIO_SAMPLE_RATE).bin_freqs)
+    derived = analyze_clip('test.webm', FREQS, CHIRP_TIMES, roi=ROI)
+    given = analyze_clip('test.webm', FREQS, CHIRP_TIMES, roi=ROI, windows=[(t - 0.6, t + 0.6) for t in CHIRP_TIMES],
+                         deadline_s=analysis_deadline(CHIRP_TIMES), band_bins=bands)
+    assert (given.audio_peaks, given.strobe_peaks) == (derived.audio_peaks, derived.strobe_peaks)
+    early = analyze_audio('test.webm', FREQS, CHIRP_TIMES, deadline_s=2.0, band_bins=bands)
+    assert early.early_reject is None and early.analyzed_until_s < 2.1
+    assert_near(early.peaks, CHIRP_TIMES[:1])
+
+def test_chain_reads():
+    print("Testing batched chain reads...")
+
+    challenge = '0x' + 'ab' * 32
+    pop_address = '0x' + '22' * 20
+
+    async def run(rpc, timeout_s=2.0):
+        url = await rpc.start()
+        reader = ChainReader(url, timeout_s=timeout_s)
+        try:
+            first = await reader.read_challenge(pop_address)
+            second = await reader.read_challenge(pop_address)
+            return first, second, reader
+        finally:
+            await reader.close()
+            await rpc.stop()
+
+    # All three reads share one round trip per lookup
+    rpc = FakeRpc(challenge, 100, 200, 150)
+    state, _, reader = asyncio.run(run(rpc))
+    assert len(rpc.requests) == 2 and all(len(body) == 3 for body in rpc.requests)
+    assert state.challenge_hash == challenge
+    assert (state.base_block, state.expires_block, state.current_block) == (100, 200, 150)
+    assert state.token_owner.lower() == '0x' + '11' * 20
+
+    # Endpoints without batch support get concurrent single calls
+    rpc = FakeRpc(challenge, 100, 200, 150, batches=False)
+    state, _, reader = asyncio.run(run(rpc))
+    assert not reader.batch_supported
+    assert state.current_block == 150
+    assert len(rpc.requests) == 1 + 2 * 3
+
+    # A slow endpoint fails the lookup after the timeout
+    rpc = FakeRpc(challenge, 100, 200, 150, latency_s=1.0)
+    try:
+        asyncio.run(run(rpc, timeout_s=0.2))
+        assert False, "slow RPC did not time out"
+    except ChainError as e:
+        assert "timed out" in str(e)
+
+def test_challenge_cache():
+    print("Testing challenge cache and block tracker...")
+
+    pop_address = '0x' + '22' * 20
+
+    async def run():
+        rpc = FakeRpc('0x' + 'ab' * 32, 100, 200, 150)
+        reader = ChainReader(await rpc.start())
+        tracker = BlockTracker(reader, interval_s=60.0)
+        cache = ChallengeCache(reader, tracker)
+        try:
+            first = await cache.get(pop_address)
+            again = await cache.get(pop_address)
+            batches = sum(isinstance(body, list) for body in rpc.requests)
+            assert first == again and batches == 1 and cache.hits == 1
+
+            # New blocks inside the range keep the entry; expiry checks use the tracked height
+            rpc.block = 160
+            await tracker.poll()
+            assert (await cache.get(pop_address)).current_block == 160
+            assert cache.hits == 2
+
+            # A ChallengeGenerated log invalidates it; concurrent misses share one batch
+            rpc.block = 170
+            rpc.issue('0x' + 'cd' * 32, 170, 270, address=pop_address)
+            await tracker.poll()
+            states = await asyncio.gather(*(cache.get(pop_address) for _ in range(5)))
+            assert all(s.challenge_hash == '0x' + 'cd' * 32 for s in states)
+            assert sum(isinstance(body, list) for body in rpc.requests) == 2
+            assert cache.invalidations == 1
+
+            # Past expiry the entry is re-read once, then served for the rest of that block
+            rpc.block = 300
+            await tracker.poll()
+            expired = await cache.get(pop_address)
+            await cache.get(pop_address)
+            assert expired.current_block > expired.expires_block
+            assert sum(isinstance(body, list) for body in rpc.requests) == 3
+            return cache.stats()
+        finally:
+            await reader.close()
+            await rpc.stop()
+
+    stats = asyncio.run(run())
+    print(f"Cache stats: {stats}")
+    assert stats["block"] == 300 and stats["invalidations"] == 2
+
+def multipart_request(parts, chunk_size=64 * 1024):
+    """A Starlette request streaming a multipart body built from (name, filename, data) parts."""
+    boundary = b'test-boundary'
+    body = b''
+    for name, filename, data in parts:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else '')
+        body += b'--' + boundary + b'\r\nContent-Disposition: ' + disposition.encode() + b'\r\n\r\n' + data + b'\r\n'
+    body += b'--' + boundary + b'--\r\n'
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+    async def receive():
+        chunk = chunks.pop(0)
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    headers = [(b'content-type', b'multipart/form-data; boundary=' + boundary),
+               (b'content-length', str(len(body)).encode())]
+    return Request({"type": "http", "method": "POST", "headers": headers}, receive)
+
+def test_upload_ingest():
+    print("Testing streaming upload ingest...")
+
+    with open('test.webm', 'rb') as f:
+        clip = f.read()
+    address = '0x' + '33' * 20
+    parts = [('pop_address', None, address.encode()), ('file', 'capture.webm', clip)]
+
+    async def receive(**limits):
+        seen = []
+        fields, upload = await receive_upload(multipart_request(parts), on_field=lambda n, v: seen.append((n, v)), **limits)
+        return seen, fields, upload
+
+    # Small uploads stay in memory, hashed as they stream in; fields are reported as they complete
+    seen, fields, upload = asyncio.run(receive())
+    assert seen == [('pop_address', address)] and fields == {'pop_address': address}
+    assert upload.data == clip and upload.path is None
+    assert upload.sha256 == hashlib.sha256(clip).hexdigest() and upload.size == len(clip)
+
+    # Larger ones are spilled to a private file, with the same content and hash
+    _, _, spilled = asyncio.run(receive(memory_bytes=len(clip) // 3))
+    try:
+        assert spilled.data is None and os.path.exists(spilled.path)
+        with open(spilled.path, 'rb') as f:
+            assert f.read() == clip
+        assert spilled.sha256 == upload.sha256
+    finally:
+        spilled.discard()
+    assert not os.path.exists(spilled.path)
+
+    # In-memory and on-disk sources analyze identically
+    from_memory = analyze_clip(upload.source, FREQS, CHIRP_TIMES, roi=ROI)
+    from_disk = analyze_clip('test.webm', FREQS, CHIRP_TIMES, roi=ROI)
+    assert from_memory.audio_peaks == from_disk.audio_peaks
+    assert from_memory.strobe_peaks == from_disk.strobe_peaks
+
+    # Oversized bodies are refused with 413 (while streaming, even without a usable Content-Length)
+    for limit in (len(clip) // 2, len(clip) - 1):
+        try:
+            asyncio.run(receive(max_bytes=limit))
+            raise AssertionError("oversized upload accepted")
+        except UploadError as e:
+            assert e.status_code == 413
+    print(f"Upload: {upload.size} bytes in memory, {spilled.size} bytes spilled")
+
+def test_batch_verification():
+    print("Testing batch lookups, multi-file uploads and waiting slots...")
+
+    known = '0x' + '22' * 20
+    addresses = ['0x%040x' % (i + 1) for i in range(120)]
+
+    async def lookups():
+        rpc = FakeRpc('0x' + 'ab' * 32, 100, 200, 150)
+        reader = ChainReader(await rpc.start())
+        tracker = BlockTracker(reader, interval_s=60.0)
+        cache = ChallengeCache(reader, tracker)
+        try:
+            await cache.get(known)
+            rpc.requests.clear()
+            states = await cache.get_many([known, 'not-an-address'] + addresses + addresses[:3])
+            batches = [body for body in rpc.requests if isinstance(body, list)]
+            again = await cache.get(addresses[-1])
+            return states, batches, rpc.requests, again, cache
+        finally:
+            await reader.close()
+            await rpc.stop()
+
+    # Misses go out together: a block number and batches of at most MAX_BATCH_CALLS calls
+    states, batches, requests, again, cache = asyncio.run(lookups())
+    assert len(states) == 122 and isinstance(states['not-an-address'], ValueError)
+    assert all(states[a].challenge_hash == '0x' + 'ab' * 32 and states[a].current_block == 150
+               for a in [known] + addresses)
+    assert len(batches) == 3 and sum(len(body) for body in batches) == 2 * len(addresses)
+    assert len(requests) == len(batches) + 1
+    assert again == states[addresses[-1]] and cache.hits == 2 and cache.misses == 1 + len(addresses)
+
+    # Every file part is handed over as it completes, with the fields before it;
+    # an oversized one becomes its error and the rest of the body still parses
+    with open('test.webm', 'rb') as f:
+        clip = f.read()
+    parts = []
+    for i, data in enumerate([clip, clip + clip, clip[:1000]]):
+        parts += [('pop_address', None, addresses[i].encode()), ('file', f'clip{i}.webm', data)]
+
+    async def receive():
+        received = []
+
+        async def on_upload(fields, upload):
+            received.append((fields['pop_address'], upload))
+
+        fields = await receive_uploads(multipart_request(parts, chunk_size=4096), on_upload,
+                                       max_bytes=len(clip) + 1, memory_bytes=len(clip) // 2)
+        return fields, received
+
+    fields, received = asyncio.run(receive())
+    assert fields == {'pop_address': addresses[2]}
+    assert [address for address, _ in received] == addresses[:3]
+    first, oversized, last = (upload for _, upload in received)
+    try:
+        assert first.path is not None and first.sha256 == hashlib.sha256(clip).hexdigest()
+        assert isinstance(oversized, UploadError) and oversized.status_code == 413
+        assert last.data == clip[:1000]
+    finally:
+        first.discard()
+
+    async def discard(fields, upload):
+        if not isinstance(upload, UploadError):
+            upload.discard()
+
+    try:
+        asyncio.run(receive_uploads(multipart_request(parts), discard, max_files=2))
+        assert False, "accepted more files than max_files"
+    except UploadError as e:
+        assert e.status_code == 413
+
+    # Batch clips wait for a slot in turn instead of being refused
+    async def slots():
+        pool = AnalysisPool(workers=1, queue_depth=4)
+        order = []
+        await pool.acquire()
+
+        async def clip(name):
+            await pool.acquire()
+            order.append(name)
+
+        waiting = [asyncio.create_task(clip(name)) for name in ('a', 'b')]
+        await asyncio.sleep(0.05)
+        assert order == [] and pool.stats()['waiting'] == 2 and pool.in_flight == 1
+        pool.reserve()  # single uploads still get the queue slots
+        pool.release()
+        pool.release()
+        await asyncio.sleep(0.05)
+        assert order == ['a'] and pool.in_flight == 1
+        pool.shutdown()
+        try:
+            await waiting[1]
+            assert False, "acquired after shutdown"
+        except PoolUnavailable:
+            pass
+
+    asyncio.run(slots())
+    print(f"Batch lookup: {len(addresses)} clones in {len(requests)} round trips")
+
+def test_shared_state():
+    print("Testing state shared across server processes...")
+
+    pop_address = '0x' + '22' * 20
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'shared.db')
+
+    async def run():
+        rpc = FakeRpc('0x' + 'ab' * 32, 100, 200, 150)
+        url = await rpc.start()
+        # Two "processes": their own readers, trackers and caches over one store file
+        stores = [SharedStore(path), SharedStore(path)]
+        leases = [FileLease(os.path.join(directory, 'poller.lock')) for _ in stores]
+        readers = [ChainReader(url) for _ in stores]
+        trackers = [BlockTracker(r, interval_s=60.0, store=st, lease=l) for r, st, l in zip(readers, stores, leases)]
+        caches = [ChallengeCache(r, t, store=st) for r, t, st in zip(readers, trackers, stores)]
+        try:
+            # Only the lease holder polls; the other takes the published height
+            await trackers[0].current()
+            await stores[0].block()  # its queued writes are done
+            polls = len(rpc.requests)
+            assert await trackers[1].current() == 150 and len(rpc.requests) == polls
+            assert leases[0].held and not leases[1].held
+
+            # A challenge read by one process is served to the other from the store
+            first = await caches[0].get(pop_address)
+            await stores[0].block()
+            reads = sum(isinstance(body, list) for body in rpc.requests)
+            assert await caches[1].get(pop_address) == first
+            assert caches[1].hits == 1 and sum(isinstance(body, list) for body in rpc.requests) == reads
+
+            # ...and a new challenge's log seen by the poller drops it for both
+            rpc.block = 160
+            rpc.issue('0x' + 'cd' * 32, 160, 260, address=pop_address)
+            await trackers[0].poll()
+            again = await caches[1].get(pop_address)
+            assert again.challenge_hash == '0x' + 'cd' * 32 and caches[0].invalidations == 1
+
+            # Verdicts and job states are visible to the other process
+            key = result_key('%064x' % 1, pop_address, '0x' + 'cd' * 32)
+            store = JobStore()
+            store.watchers.append(lambda job, discarded: stores[0].drop_job(job.id) if discarded
+                                  else stores[0].put_job(job.id, job.snapshot()))
+            job = store.create()
+            job.result = {"verified": True, "pin_id": job.id}
+            store.record(job, "verdict", {"verified": True})
+            store.finish(job)
+            ResultCache(store=stores[0]).finish(key, job)
+            duplicate = store.create()
+            store.discard(duplicate)
+            other = ResultCache(store=stores[1])
+            assert other.get(key) is None
+            assert await other.lookup(key) == job.result and other.hits == 1 and other.get(key) == job.result
+            snapshot = await stores[1].get_job(job.id)
+            assert snapshot["status"] == "complete" and [s["stage"] for s in snapshot["stages"]] == ["verdict", "complete"]
+            assert await stores[1].get_job(duplicate.id) is None
+        finally:
+            for reader, st in zip(readers, stores):
+                await reader.close()
+                await st.close()
+            await rpc.stop()
+
+    asyncio.run(run())
+
+    # Analysis slots are capped across processes; a dying holder frees its slot
+    slots_dir = os.path.join(directory, 'slots')
+    here = AnalysisSlots(slots_dir, 2)
+    held = here.try_acquire()
+    holder = subprocess.Popen(
+        [sys.executable, '-c', 'import time; from shared import AnalysisSlots; '
+                         f'assert AnalysisSlots({slots_dir!r}, 2).try_acquire() is not None; '
+                         'print("held", flush=True); time.sleep(60)'],
+        stdout=subprocess.PIPE, text=True)
+    try:
+        assert holder.stdout.readline().strip() == 'held'
+        assert here.try_acquire() is None and here.held == 1
+    finally:
+        holder.kill()
+        holder.wait()
+    assert here.try_acquire() is not None and here.stats()['held_here'] == 2
+    here.release(held)
+    assert here.held == 1 and here.stats() == {'limit': 2, 'held_here': 1, 'waits': 0}
+    shutil.rmtree(directory)
+
+def test_result_cache():
+    print("Testing verdict cache...")
+
+    store = JobStore()
+    cache = ResultCache(ttl_s=60.0, max_entries=2)
+    keys = [result_key('%064x' % i, '0x' + '44' * 20, '0x' + 'ab' * 32) for i in range(3)]
+
+    # The first submission computes; a concurrent duplicate follows its job
+    job = store.create()
+    assert cache.get(keys[0]) is None and cache.running(keys[0]) is None
+    cache.start(keys[0], job)
+    assert cache.running(keys[0]) is job
+
+    # Completed verdicts are stored (as copies); failed or uncacheable ones are not
+    job.result = {"verified": True, "ipfs_cid": "bafy"}
+    store.finish(job)
+    cache.finish(keys[0], job)
+    hit = cache.get(keys[0])
+    hit["verified"] = False
+    assert cache.get(keys[0]) == {"verified": True, "ipfs_cid": "bafy"}
+    assert cache.running(keys[0]) is None
+
+    failed = store.create()
+    cache.start(keys[1], failed)
+    failed.result = {"verified": False, "error": "timeout"}
+    store.finish(failed, error="timeout")
+    cache.finish(keys[1], failed)
+    assert cache.get(keys[1]) is None
+
+    # Least recently used verdicts are dropped past max_entries, stale ones after the TTL
+    for key in keys[1:]:
+        done = store.create()
+        cache.start(key, done)
+        done.result = {"verified": False}
+        store.finish(done)
+        cache.finish(key, done)
+    assert cache.get(keys[0]) is None and cache.get(keys[2]) is not None
+    cache.ttl_s = 0.0
+    assert cache.get(keys[2]) is None
+
+    stats = cache.stats()
+    print(f"Result cache stats: {stats}")
+    assert stats["hits"] == 3 and stats["coalesced"] == 1 and stats["misses"] == 4
+
+def test_screenshot_selection():
+    print("Testing screenshot scoring...")
+
+    rng = np.random.default_rng(0)
+    detail = rng.integers(40, 216, size=(240, 320, 3), dtype=np.uint8)
+    to_frame = lambda img: av.VideoFrame.from_ndarray(img, format='bgr24').reformat(format='yuv420p')
+    sharp = frame_quality(to_frame(detail))
+    blurred = frame_quality(to_frame(cv2.GaussianBlur(detail, (9, 9), 3)))
+    flashed = frame_quality(to_frame(np.clip(detail.astype(np.int32) + 120, 0, 255).astype(np.uint8)))
+    assert sharp > blurred and sharp > flashed
+
+    # The best candidate wins unless it sits on a strobe
+    picker = ScreenshotPicker(target_time_s=1.0, stride=1)
+    for i, img in enumerate([cv2.GaussianBlur(detail, (9, 9), 3), detail, cv2.GaussianBlur(detail, (5, 5), 1)]):
+        picker.on_video(to_frame(img), i * 0.5)
+    picker.result()
+    assert picker.frame_time == 0.5
+    picker.result(exclude_times=[0.5])
+    assert picker.frame_time == 1.0
+
+    # On the synthetic clip the flat frames tie, so a strobe frame is never picked
+    analysis = analyze_clip('test.webm', FREQS, CHIRP_TIMES, roi=ROI)
+    assert analysis.screenshot is not None
+    assert all(abs(analysis.screenshot_time - t) > 0.2 for t in analysis.strobe_peaks)
+    print(f"Scores: sharp {sharp:.0f}, blurred {blurred:.0f}, flashed {flashed:.0f}; "
+          f"clip screenshot at {analysis.screenshot_time:.2f}s")
+
+def test_pin_outbox():
+    print("Testing IPFS pin outbox...")
+
+    async def settle(outbox, pin_id, timeout_s=5.0):
+        deadline = time.monotonic() + timeout_s
+        while True:
+            pin = await outbox.get(pin_id)
+            if pin.status != 'pending' or time.monotonic() > deadline:
+                return pin
+            await asyncio.sleep(0.01)
+
+    async def run(path):
+        uploader = FakeUploader(statuses=[503, 503, 400])
+        url = await uploader.start()
+        outbox = PinOutbox(path, url, concurrency=2, max_attempts=3, backoff_s=0.01)
+        settled = []
+        outbox.listeners.append(settled.append)
+        try:
+            # Enqueueing returns at once; transient errors are retried with backoff
+            pin = await outbox.enqueue('job-1', b'jpeg-1', 'screenshot.jpg', 'image/jpeg')
+            assert pin.status == 'pending' and pin.cid is None
+            outbox.start()
+            pin = await settle(outbox, 'job-1')
+            assert pin.status == 'failed' and pin.attempts == 3 and pin.cid is None
+
+            # A failed pin can be queued again; enqueueing is idempotent per id
+            assert await outbox.retry('job-1')
+            await outbox.enqueue('job-1', b'jpeg-1', 'screenshot.jpg', 'image/jpeg')
+            pin = await settle(outbox, 'job-1')
+            assert pin.status == 'pinned' and pin.cid.startswith('bafyfake')
+            assert uploader.last_upload == b'jpeg-1' and (uploader.failed, uploader.uploads) == (3, 1)
+            assert [p.status for p in settled] == ['failed', 'pinned']
+            await outbox.stop()
+
+            # Pins queued before a restart are still pinned afterwards
+            outbox = PinOutbox(path, url, backoff_s=0.01)
+            await outbox.enqueue('job-2', b'jpeg-2', 'screenshot.jpg', 'image/jpeg')
+            await outbox.stop()
+            outbox = PinOutbox(path, url, backoff_s=0.01)
+            outbox.start()
+            pin = await settle(outbox, 'job-2')
+            assert pin.status == 'pinned' and (await outbox.get('job-1')).status == 'pinned'
+            return outbox.stats()
+        finally:
+            await outbox.stop()
+            await uploader.stop()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        stats = asyncio.run(run(os.path.join(data_dir, 'pins.db')))
+    print(f"Pin stats after restart: {stats}")
+    assert stats["pinned"] == 1
+
+def test_history_store():
+    print("Testing persistent verification history...")
+
+    pops = ['0x' + '55' * 20, '0x' + '66' * 20]
+
+    async def run(path):
+        store = HistoryStore(path, flush_interval_s=60.0)
+        store.start()
+        try:
+            for i in range(250):
+                store.add({"job_id": f"job-{i}", "verified": i % 3 == 0, "pop_address": pops[i % 2],
+                           "token_owner": '0x' + '11' * 20, "timestamp": 1_700_000_000 + i, "block_number": i})
+            # Reads see queued writes; pages are newest first and join up without gaps
+            revision, total, entries, cursor = await store.page(limit=100, count=True)
+            seen = [e["job_id"] for e in entries]
+            while cursor is not None:
+                _, total_later, entries, cursor = await store.page(cursor=cursor, limit=100)
+                assert total_later is None  # only counted on request
+                seen += [e["job_id"] for e in entries]
+            assert total == 250 and seen == [f"job-{i}" for i in reversed(range(250))]
+            assert store.flushes == 1
+
+            _, total, entries, _ = await store.page(pop_address=pops[1].upper().replace('X', 'x'), verified=True,
+                                                    count=True)
+            assert total == len([i for i in range(250) if i % 2 == 1 and i % 3 == 0])
+            assert all(e["verified"] and e["pop_address"].lower() == pops[1] for e in entries)
+            _, total, _, _ = await store.page(since=1_700_000_000 + 240, count=True)
+            assert total == 10
+
+            # The revision only moves when something was written
+            assert await store.revision() == revision
+            store.update_pin("job-3", "bafy-history", "pinned")
+            assert await store.revision() == revision + 1
+        finally:
+            await store.stop()
+
+        # Entries survive a restart
+        store = HistoryStore(path)
+        try:
+            _, total, entries, _ = await store.page(pop_address=pops[1], limit=1, since=1_700_000_003, count=True)
+            _, _, pinned, _ = await store.page(verified=True, since=1_700_000_003, limit=500)
+            assert total == 124 and pinned[-1]["ipfs_cid"] == "bafy-history"
+            return total
+        finally:
+            await store.stop()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        total = asyncio.run(run(os.path.join(data_dir, 'history.db')))
+    print(f"History entries for one Pop after restart: {total}")
+
+def test_metrics():
+    print("Testing Prometheus metrics rendering...")
+
+    registry = Registry()
+    stages = registry.histogram("stage_seconds", "Stage wall time", ["stage"], buckets=(0.1, 1.0))
+    rejects = registry.counter("rejects_total", "Rejected uploads", ["reason"])
+    stages.observe(0.05, stage="decode")
+    stages.observe(0.5, stage="decode")
+    stages.observe(5.0, stage="decode")
+    rejects.inc(reason='bad "upload"\n')
+    rejects.inc(2, reason="saturated")
+
+    def collector():
+        depth = Counter("pool_rejected_total", "Pool rejections")
+        depth.inc(3)
+        return [depth]
+    registry.add_collector(collector)
+
+    text = registry.render()
+    print(text)
+    lines = text.splitlines()
+    # Buckets are cumulative and end with +Inf == count
+    assert 'stage_seconds_bucket{stage="decode",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="decode",le="1"} 2' in lines
+    assert 'stage_seconds_bucket{stage="decode",le="+Inf"} 3' in lines
+    assert 'stage_seconds_count{stage="decode"} 3' in lines and stages.count(stage="decode") == 3
+    assert 'rejects_total{reason="bad \\"upload\\"\\n"} 1' in lines
+    assert 'rejects_total{reason="saturated"} 2' in lines
+    assert "# TYPE pool_rejected_total counter" in lines and "pool_rejected_total 3" in lines
+    try:
+        rejects.inc(stage="decode")
+        assert False, "wrong label names should be refused"
+    except ValueError:
+        pass
+
+def test_debug_artifacts():
+    print("Testing level-gated logging and debug artifacts...")
+
+    # Below the configured level nothing is formatted or written
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        logs.configure(level="INFO", fmt="json")
+        try:
+            log = logs.get_logger("test")
+            log.debug("hidden", peaks=[1.0])
+            log.info("shown", peaks=np.array([0.123456789, 2.0]), job_id="abc")
+        finally:
+            logs.configure(level="INFO", fmt="text")
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 1, lines
+    entry = json.loads(lines[0])
+    assert entry["msg"] == "shown" and entry["tag"] == "test" and entry["peaks"] == [0.1235, 2.0]
+
+    # Traces are only recorded when asked for
+    assert analyze_clip('test.webm', FREQS, CHIRP_TIMES).debug is None
+    analysis = analyze_clip('test.webm', FREQS, CHIRP_TIMES, debug=True)
+    audio, video = analysis.debug["audio"], analysis.debug["video"]
+    assert set(audio["bands"]) == {str(f) for f in FREQS}
+    assert all(len(band) == len(audio["frames"]) for band in audio["bands"].values())
+    assert len(audio["thresholds"]) == len(audio["windows"])
+    # Each chirp shows up as a band peak above its window threshold
+    frame_s = audio["frame_s"]
+    for freq, t in zip(FREQS, CHIRP_TIMES):
+        band = audio["bands"][str(freq)]
+        near = [m for f, m in zip(audio["frames"], band) if abs(f * frame_s - t) < 0.1]
+        assert near and max(near) > max(audio["thresholds"])
+    assert len(video["luminance"]) == len(video["times"]) > 100
+    assert_near([t for t in video["peaks"] if t > 0.1], analysis.strobe_peaks, tol=1e-9)
+
+    split = combine_streams(analyze_audio('test.webm', FREQS, CHIRP_TIMES, debug=True),
+                            analyze_video('test.webm', CHIRP_TIMES, debug=True))
+    assert split.debug["audio"]["frames"] == audio["frames"]
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        store = ArtifactStore(os.path.join(data_dir, 'debug'), keep=2)
+        ids = [f"{i:032x}" for i in range(3)]
+        for artifact_id in ids:
+            size = store.save(artifact_id, {"job_id": artifact_id, "audio": audio, "video": video})
+            os.utime(os.path.join(data_dir, 'debug', f"{artifact_id}.json.gz"), (time.time(), time.time() + int(artifact_id, 16)))
+        print(f"Debug artifact: {size} bytes compressed")
+        assert store.load(ids[0]) is None  # pruned
+        loaded = store.load(ids[2])
+        assert loaded["audio"]["frames"] == audio["frames"]
+        assert store.load("../../etc/passwd") is None
+
+def test_benchmark_clips():
+    print("Testing benchmark clip synthesis and regression checks...")
+
+    with tempfile.TemporaryDirectory() as clips_dir:
+        for codec in ('vp9', 'h264'):
+            spec = synthetic.ClipSpec(duration_s=5.0, resolution='480p', fps=24, codec=codec, noise=0.5)
+            path = synthetic.clip_path(spec, clips_dir)
+            assert path.endswith(synthetic.CODECS[codec][0])
+            result = bench.run_stage('analyze_match', path, repeat=1)
+            print(f"{spec.name}: {result}")
+            assert result['found'] and result['wall_s'] > 0 and result['peak_rss_mb'] > 0
+
+    baseline = {'clip': {'analyze_match': {'wall_s': 1.0, 'cpu_s': 1.0, 'peak_rss_mb': 200.0, 'found': True}}}
+    steady = {'clip': {'analyze_match': {'wall_s': 1.1, 'cpu_s': 0.9, 'peak_rss_mb': 201.0, 'found': True}}}
+    slower = {'clip': {'analyze_match': {'wall_s': 1.5, 'cpu_s': 1.0, 'peak_rss_mb': 200.0, 'found': False}}}
+    assert bench.compare(steady, baseline, threshold=0.25) == []
+    regressions = bench.compare(slower, baseline, threshold=0.25)
+    assert len(regressions) == 2 and any('no longer finds' in line for line in regressions)
+
+def test_load_harness():
+    print("Testing load-test stand-ins and report...")
+
+    pop_address = '0x' + '33' * 20
+
+    async def run():
+        import aiohttp
+        rpc = loadtest.fake_chain(start_block=500)
+        failing = FakeUploader(error_rate=1.0)
+        reader = ChainReader(await rpc.start())
+        url = await failing.start()
+        try:
+            state = await reader.read_challenge(pop_address)
+            async with aiohttp.ClientSession() as session:
+                form = aiohttp.FormData()
+                form.add_field('file', b'png', filename='s.png')
+                async with session.post(f"{url}/upload", data=form) as response:
+                    status = response.status
+            return state, status
+        finally:
+            await reader.close()
+            await rpc.stop()
+            await failing.stop()
+
+    state, status = asyncio.run(run())
+    assert state.challenge_hash == synthetic.BENCH_CHALLENGE
+    assert state.base_block == 500 and state.base_block <= state.current_block < state.expires_block
+    assert status == 503
+
+    recorder = loadtest.Recorder()
+    for ms in range(1, 101):
+        recorder.record('POST /verify', 202 if ms <= 90 else 429, ms / 1000.0)
+    row = recorder.report()['POST /verify']
+    assert row['count'] == 100 and row['statuses'] == {'202': 90, '429': 10}
+    assert row['p50_ms'] == 50.5 and row['p99_ms'] == 99.0 and row['max_ms'] == 100.0
 
 if __name__ == "__main__":
-    generate_test_assets()
-    test_detection()
+    setup_module()
+    try:
+        test_detection()
+        test_single_pass_decode()
+        test_engine_parity()
+        test_streaming_detectors()
+        test_windowed_analysis()
+        test_roi_luminance()
+        test_early_termination()
+        test_split_stream_analysis()
+        test_analysis_pool()
+        test_startup_warmup()
+        test_job_events()
+        test_event_matching()
+        test_detection_plans()
+        test_chain_reads()
+        test_challenge_cache()
+        test_upload_ingest()
+        test_batch_verification()
+        test_shared_state()
+        test_result_cache()
+        test_screenshot_selection()
+        test_pin_outbox()
+        test_history_store()
+        test_metrics()
+        test_debug_artifacts()
+        test_benchmark_clips()
+        test_load_harness()
+    finally:
+        teardown_module()
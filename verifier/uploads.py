@@ -0,0 +1,254 @@
+"""
+Streaming upload ingest.
+
+The multipart body of /verify (and of /verify/batch, which carries many
+clips) is parsed straight off the request stream: each clip is hashed
+(SHA-256) and size-checked chunk by chunk, kept in memory while it is small
+and spilled to a private file on tmpfs once it is not.
+The analysis workers get the bytes (or the spill path) directly, with no
+working-directory copy to read back, so concurrent uploads never share a
+file.
+"""
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+# Largest accepted clip (the 5s challenge recording is typically well under 5 MB)
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+# Clips up to this size stay in memory; larger ones are spilled
+MEMORY_UPLOAD_BYTES = 8 * 1024 * 1024
+# Spill directory: tmpfs when the host has one
+SPILL_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+
+
+class UploadError(Exception):
+    """Malformed or unacceptable upload; `status_code` is the HTTP status to answer with."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class SpooledUpload:
+    filename: str
+    size: int
+    sha256: str
+    data: Optional[bytes] = None  # the clip, when kept in memory
+    path: Optional[str] = None  # the spill file otherwise
+
+    @property
+    def source(self) -> Union[bytes, str]:
+        """What to hand ingest.demux (picklable for the worker processes)."""
+        return self.data if self.data is not None else self.path
+
+    def discard(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+        self.data = None
+
+
+class UploadSpool:
+    """Accumulates one file part: hashes, enforces the size limit and spills past memory_bytes."""
+
+    def __init__(self, filename: str, max_bytes: int = MAX_UPLOAD_BYTES,
+                 memory_bytes: int = MEMORY_UPLOAD_BYTES, spill_dir: str = SPILL_DIR):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.spill_dir = spill_dir
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._chunks: List[bytes] = []
+        self._file = None
+        self._path: Optional[str] = None
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadError(f"Upload exceeds {self.max_bytes} bytes", status_code=413)
+        self._hash.update(data)
+        if self._file is None and self.size > self.memory_bytes:
+            fd, self._path = tempfile.mkstemp(prefix="pops-upload-", dir=self.spill_dir)
+            self._file = os.fdopen(fd, "wb")
+            pending, self._chunks = self._chunks, []
+            await run_in_threadpool(self._file.writelines, pending)
+        if self._file is not None:
+            await run_in_threadpool(self._file.write, data)
+        else:
+            self._chunks.append(data)
+
+    def finish(self) -> SpooledUpload:
+        upload = SpooledUpload(filename=self.filename, size=self.size, sha256=self._hash.hexdigest())
+        if self._file is not None:
+            self._file.close()
+            upload.path = self._path
+        else:
+            upload.data = b"".join(self._chunks)
+        self._chunks = []
+        return upload
+
+    def discard(self):
+        self._chunks = []
+        if self._file is not None:
+            self._file.close()
+        if self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
+
+
+async def receive_uploads(request: Request,
+                          on_upload: Callable[[Dict[str, str], Union[SpooledUpload, UploadError]], Awaitable[None]],
+                          file_field: str = "file", on_field: Optional[Callable[[str, str], None]] = None,
+                          max_files: Optional[int] = None, max_bytes: int = MAX_UPLOAD_BYTES,
+                          max_body_bytes: Optional[int] = None, memory_bytes: int = MEMORY_UPLOAD_BYTES,
+                          spill_dir: str = SPILL_DIR) -> Dict[str, str]:
+    """
+    Parse a multipart/form-data request as it streams in. Text fields are
+    returned (and passed to `on_field` as soon as each one is complete, so
+    callers can start work before the clips have arrived). Every
+    `file_field` part is spooled and awaited through `on_upload` once it is
+    complete, with the text fields seen before it; reading pauses until
+    on_upload returns, and the upload is then the callee's. A part over
+    `max_bytes` is dropped and handed over as its UploadError instead.
+    Raises UploadError for anything else wrong with the body.
+    """
+    if max_body_bytes is not None:
+        content_length = request.headers.get("content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > max_body_bytes:
+            raise UploadError(f"Upload exceeds {max_body_bytes} bytes", status_code=413)
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadError("Expected a multipart/form-data body")
+
+    fields: Dict[str, str] = {}
+    files = 0
+    received = 0
+    part = {"headers": {}, "name": None, "spool": None, "data": b""}
+    header = {"field": b"", "value": b""}
+    pending: List[Tuple[UploadSpool, bytes]] = []  # file bytes parsed from the current chunk
+    completed: List[Tuple[Dict[str, str], UploadSpool]] = []  # file parts that ended in it
+    spools: List[UploadSpool] = []  # not yet handed to on_upload
+    failed: Dict[UploadSpool, UploadError] = {}
+
+    def on_part_begin():
+        part.update(headers={}, name=None, spool=None, data=b"")
+
+    def on_header_field(data, start, end):
+        header["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        header["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][header["field"].lower()] = header["value"]
+        header.update(field=b"", value=b"")
+
+    def on_headers_finished():
+        nonlocal files
+        _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise UploadError('Multipart part without a "name"')
+        part["name"] = options[b"name"].decode("utf-8", "replace")
+        if part["name"] == file_field:
+            files += 1
+            if max_files is not None and files > max_files:
+                raise UploadError(f'More than one "{file_field}" part' if max_files == 1
+                                  else f'More than {max_files} "{file_field}" parts', status_code=413)
+            filename = options.get(b"filename", b"upload").decode("utf-8", "replace")
+            part["spool"] = UploadSpool(filename, max_bytes, memory_bytes, spill_dir)
+            spools.append(part["spool"])
+
+    def on_part_data(data, start, end):
+        if part["spool"] is not None:
+            pending.append((part["spool"], data[start:end]))
+        else:
+            part["data"] += data[start:end]
+            if len(part["data"]) > 64 * 1024:
+                raise UploadError(f'Field "{part["name"]}" is too large')
+
+    def on_part_end():
+        if part["spool"] is not None:
+            completed.append((dict(fields), part["spool"]))
+        elif part["name"] is not None:
+            value = part["data"].decode("utf-8", "replace")
+            fields[part["name"]] = value
+            if on_field is not None:
+                on_field(part["name"], value)
+
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+    })
+
+    async def flush():
+        for spool, data in pending:
+            if spool in failed:
+                continue
+            try:
+                await spool.write(data)
+            except UploadError as e:
+                spool.discard()
+                failed[spool] = e
+        pending.clear()
+        for seen, spool in completed:
+            spools.remove(spool)
+            await on_upload(seen, failed.pop(spool) if spool in failed else spool.finish())
+        completed.clear()
+
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if max_body_bytes is not None and received > max_body_bytes:
+                raise UploadError(f"Upload exceeds {max_body_bytes} bytes", status_code=413)
+            parser.write(chunk)
+            await flush()
+        parser.finalize()
+        await flush()
+    except UploadError:
+        for spool in spools:
+            spool.discard()
+        raise
+    except Exception as e:
+        for spool in spools:
+            spool.discard()
+        raise UploadError(f"Malformed multipart body: {e}")
+    return fields
+
+
+async def receive_upload(request: Request, file_field: str = "file",
+                         on_field: Optional[Callable[[str, str], None]] = None,
+                         max_bytes: int = MAX_UPLOAD_BYTES, memory_bytes: int = MEMORY_UPLOAD_BYTES,
+                         spill_dir: str = SPILL_DIR) -> Tuple[Dict[str, str], SpooledUpload]:
+    """
+    receive_uploads for a body with exactly one `file_field` part. Returns
+    the text fields and the spooled part. Raises UploadError.
+    """
+    uploads: List[SpooledUpload] = []
+
+    async def keep(_fields, upload):
+        if isinstance(upload, UploadError):
+            raise upload
+        uploads.append(upload)
+
+    try:
+        fields = await receive_uploads(request, keep, file_field=file_field, on_field=on_field, max_files=1,
+                                       max_bytes=max_bytes, max_body_bytes=max_bytes + 64 * 1024,
+                                       memory_bytes=memory_bytes, spill_dir=spill_dir)
+    except UploadError:
+        for upload in uploads:
+            upload.discard()
+        raise
+    if not uploads:
+        raise UploadError(f'Missing "{file_field}" part')
+    return fields, uploads[0]
@@ -1,23 +1,25 @@
 import requests
 import sys
+import time
 
-def verify_local(file_path):
-    url = "http://localhost:8000/verify"
-    files = {'file': open(file_path, 'rb')}
-    data = {
-        'challenge': 'test_challenge',
-        'base_block': 100,
-        'expires_block': 200
-    }
-    
+def verify_local(file_path, pop_address, url="http://localhost:8000"):
     try:
-        response = requests.post(url, files=files, data=data)
-        print(response.json())
+        with open(file_path, 'rb') as f:
+            # pop_address is sent before the file so the server can reject early
+            response = requests.post(f"{url}/verify", data={'pop_address': pop_address}, files={'file': f})
+        job = response.json()
+        print(job)
+        if response.status_code != 202:
+            return
+        while job.get('status') not in ('complete', 'failed'):
+            time.sleep(0.5)
+            job = requests.get(f"{url}/verify/{job['job_id']}").json()
+        print(job.get('result') or job)
     except Exception as e:
         print(f"Error: {e}")
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python verify_local.py <path_to_video>")
+    if len(sys.argv) < 3:
+        print("Usage: python verify_local.py <path_to_video> <pop_address> [verifier_url]")
         sys.exit(1)
-    verify_local(sys.argv[1])
+    verify_local(*sys.argv[1:4])
@@ -1,83 +1,255 @@
-import cv2
+from bisect import bisect_left
+from collections import Counter
+from typing import List, Optional, Tuple
+
 import numpy as np
-from typing import List, Tuple
 from scipy.signal import find_peaks
 
+from ingest import LumaCollector, demux, roi_luminance
+from logs import get_logger
+
+# Strobes closer than this are merged (find_peaks `distance`)
+MIN_STROBE_SPACING_S = 0.4
+# Absolute floor for a luminance jump to count as a strobe
+MIN_STROBE_HEIGHT = 10.0
+# Candidates farther than this from every window are dropped by StrobeStream:
+# a peak and the neighbour it could suppress under the spacing rule
+STROBE_HORIZON_S = 2 * MIN_STROBE_SPACING_S
+
+log = get_logger("video")
+
 def detect_strobes(video_path: str, roi: Tuple[int, int, int, int]) -> List[float]:
     """
     Detects luminance spikes in a specific ROI.
     roi: (x, y, w, h)
     Returns timestamps of detected strobes.
     """
-    cap = cv2.VideoCapture(video_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    
-    x, y, w, h = roi
-    luminance = []
-
-    # Read all frames and count them (OpenCV frame count is unreliable for WebM)
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
+    luma = LumaCollector(roi)
+    demux(video_path, [luma])
+    luminance, frame_times = luma.result()
+
+    log.debug("ROI", roi=roi)
+    return detect_strobes_in_luminance(luminance, frame_times)
 
-        crop = frame[y:y+h, x:x+w]
-        gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
-        mean_lum = float(np.mean(gray))
-        luminance.append(mean_lum)
-
-    cap.release()
-    
-    # Calculate actual FPS from frame count and duration
-    actual_frame_count = len(luminance)
-    if fps > 100 or fps <= 0:
-        import subprocess
-        try:
-            # Get actual duration from ffprobe
-            result = subprocess.run([
-                'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
-                '-of', 'default=noprint_wrappers=1:nokey=1', video_path
-            ], capture_output=True, text=True, check=True)
-            duration = float(result.stdout.strip())
-            if duration > 0 and actual_frame_count > 0:
-                fps = actual_frame_count / duration
-                print(f"[VIDEO] Calculated FPS: {fps:.2f} ({actual_frame_count} frames / {duration:.2f}s)")
-            else:
-                print(f"[VIDEO] Invalid duration, defaulting to 30 FPS")
-                fps = 30.0
-        except Exception as e:
-            print(f"[VIDEO] Failed to get duration, defaulting to 30 FPS: {e}")
-            fps = 30.0
-    
-    print(f"[VIDEO] Captured {actual_frame_count} frames at {fps:.2f} FPS = {actual_frame_count/fps:.2f}s duration")
-    print(f"[VIDEO] ROI: x={x}, y={y}, w={w}, h={h}")
-
-    if not luminance:
-        print("[VIDEO] No luminance data!")
+def detect_strobes_in_luminance(luminance: np.ndarray, frame_times: np.ndarray) -> List[float]:
+    """
+    Detects luminance spikes in a per-frame ROI luminance curve.
+    frame_times are the presentation timestamps (seconds) of each sample, so
+    variable frame rate recordings (e.g. browser WebM) map to real time.
+    Returns timestamps of detected strobes.
+    """
+    lum_arr = np.asarray(luminance, dtype=np.float64)
+    times = np.asarray(frame_times, dtype=np.float64)
+
+    if len(lum_arr) == 0:
+        log.debug("No luminance data")
         return []
 
-    lum_arr = np.array(luminance)
+    # Effective frame rate from the PTS rather than the (unreliable) container FPS
+    fps = _median_fps(Counter(_interval_ms(float(iv)) for iv in np.diff(times)))
+    log.debug("Captured frames", frames=len(lum_arr), fps=fps, duration_s=times[-1])
+
     diff = np.diff(lum_arr)
     diff = np.insert(diff, 0, 0.0)
 
     diff_std = float(np.std(diff))
-    min_height = max(10.0, 3.0 * diff_std)
-    
-    print(f"[VIDEO] Luminance diff std: {diff_std:.2f}, min_height: {min_height:.2f}")
+    min_height = max(MIN_STROBE_HEIGHT, 3.0 * diff_std)
+    log.debug("Luminance diff", std=diff_std, min_height=min_height)
 
-    distance = int(fps * 0.4) if fps > 0 else 1
+    distance = max(1, int(fps * MIN_STROBE_SPACING_S))
     peaks, properties = find_peaks(diff, height=min_height, distance=distance)
-    
-    print(f"[VIDEO] Raw peaks detected: {len(peaks)} at frames {peaks.tolist()}")
+    log.debug("Raw peaks", frames=peaks)
 
-    times = (peaks / fps) if fps > 0 else peaks
+    peak_times = times[peaks]
     # Allow early challenge strobes; only drop the very first few frames (<100ms)
-    filtered = [float(t) for t in times if t > 0.1]
-    
-    print(f"[VIDEO] Filtered strobes (>0.1s): {[f'{t:.3f}s' for t in filtered]}")
+    filtered = [float(t) for t in peak_times if t > 0.1]
+    log.debug("Filtered strobes (>0.1s)", strobes_s=filtered)
 
     return sorted(filtered)
 
+class StrobeStream:
+    """
+    Incremental strobe detector fed one frame at a time.
+
+    Keeps running sums of the luminance differences for the 3-sigma
+    threshold and only the local maxima that already clear the absolute
+    MIN_STROBE_HEIGHT floor, instead of the whole luminance curve, so memory
+    stays flat for long clips. Frames past `max_duration_s` are ignored;
+    `luma_step` subsamples the ROI (see ingest.roi_luminance).
+    With `windows` ([(start_s, end_s)], e.g. expected strobe ± tolerance)
+    candidates farther than STROBE_HORIZON_S from every window are dropped as
+    they are found, so only strobes near the windows are reported and memory
+    is bounded by the windows; without them every candidate is kept.
+    The frame rate comes from a histogram of PTS intervals at 1 ms
+    resolution, so it matches detect_strobes_in_luminance on variable frame
+    rate input too.
+    With `trace`, the luminance curve is kept as well (see trace()).
+    Usable directly as an ingest consumer (`on_video`).
+    """
+
+    def __init__(self, roi: Tuple[int, int, int, int], max_duration_s: Optional[float] = None,
+                 luma_step: int = 1, trace: bool = False, windows: Optional[List[Tuple[float, float]]] = None):
+        self.roi = roi
+        self._windows = sorted(windows) if windows is not None else None
+        self._window = 0  # first window a new candidate can still be near
+        self.luma_step = luma_step
+        self.max_duration_s = max_duration_s
+        self.n_frames = 0
+        self._first_time = None
+        self._intervals: Counter = Counter()  # PTS interval (ms) -> count
+        self._prev_lum = None
+        # Running moments of the diff series (diff[0] = 0)
+        self._diff_sum = 0.0
+        self._diff_sq_sum = 0.0
+        # Local-maximum tracking, mirroring scipy's plateau handling
+        self._prev_diff = None
+        self._prev_time = None
+        self._rise = None  # (frame, time) where the current rise started
+        self._candidates: List[Tuple[int, float, float]] = []  # (frame, time, height), by time
+        self._candidate_times: List[float] = []
+        # Debug trace: (time, luminance) per frame, and the finish() decisions
+        self._trace: Optional[List[Tuple[float, float]]] = [] if trace else None
+        self._decisions: dict = {}
+
+    def on_video(self, frame, time_s: float):
+        if self.max_duration_s is not None and time_s > self.max_duration_s:
+            return
+        self.feed(roi_luminance(frame, self.roi, self.luma_step), time_s)
+
+    def feed(self, luminance: float, time_s: float):
+        if self._first_time is None:
+            self._first_time = time_s
+        else:
+            self._intervals[_interval_ms(time_s - self._prev_time)] += 1
+        if self._trace is not None:
+            self._trace.append((time_s, luminance))
+        d = 0.0 if self._prev_lum is None else luminance - self._prev_lum
+        self._prev_lum = luminance
+        self._diff_sum += d
+        self._diff_sq_sum += d * d
+
+        i = self.n_frames
+        if self._prev_diff is not None:
+            if d > self._prev_diff:
+                self._rise = (i, time_s)
+            elif d < self._prev_diff and self._rise is not None:
+                # Peak (or plateau) ended at i - 1; scipy reports the plateau middle
+                start, start_time = self._rise
+                end, end_time = i - 1, self._prev_time
+                height = self._prev_diff
+                if height >= MIN_STROBE_HEIGHT:
+                    mid = (start + end) // 2
+                    mid_time = start_time if end == start else start_time + (end_time - start_time) * (mid - start) / (end - start)
+                    if self._near_window(mid_time):
+                        self._candidates.append((mid, mid_time, height))
+                        self._candidate_times.append(mid_time)
+                self._rise = None
+        self._prev_diff = d
+        self._prev_time = time_s
+        self.n_frames += 1
+
+    def _near_window(self, time_s: float) -> bool:
+        if self._windows is None:
+            return True
+        # Candidates arrive in time order, so windows left behind are never revisited
+        while self._window < len(self._windows) and self._windows[self._window][1] + STROBE_HORIZON_S < time_s:
+            self._window += 1
+        return self._window < len(self._windows) and self._windows[self._window][0] - STROBE_HORIZON_S <= time_s
+
+    @property
+    def analyzed_until_s(self) -> float:
+        """Time of the last frame fed."""
+        return self._prev_time if self._prev_time is not None else 0.0
+
+    def has_candidate_between(self, start_s: float, end_s: float) -> bool:
+        """
+        Whether a strobe could still be reported in [start_s, end_s]. Reported
+        strobes are always candidates (or a rise still in progress), so False
+        means none can appear there whatever the final threshold is.
+        """
+        if self._rise is not None and self._rise[1] <= end_s:
+            return True
+        i = bisect_left(self._candidate_times, start_s)
+        return i < len(self._candidate_times) and self._candidate_times[i] <= end_s
+
+    def finish(self) -> List[float]:
+        """Returns strobe timestamps, as detect_strobes_in_luminance does."""
+        if self.n_frames == 0:
+            log.debug("No luminance data")
+            return []
+        n = self.n_frames
+        span = self._prev_time - self._first_time
+        fps = _median_fps(self._intervals)
+        mean = self._diff_sum / n
+        diff_std = float(np.sqrt(max(0.0, self._diff_sq_sum / n - mean * mean)))
+        min_height = max(MIN_STROBE_HEIGHT, 3.0 * diff_std)
+        log.debug("Streamed frames", frames=n, fps=fps, duration_s=span, diff_std=diff_std, min_height=min_height)
+
+        peaks = [c for c in self._candidates if c[2] >= min_height]
+        distance = max(1, int(fps * MIN_STROBE_SPACING_S))
+        keep = _select_by_distance([p[0] for p in peaks], [p[2] for p in peaks], distance)
+        peaks = [p for p, k in zip(peaks, keep) if k]
+        log.debug("Raw peaks", frames=[p[0] for p in peaks])
+
+        # Allow early challenge strobes; only drop the very first few frames (<100ms)
+        filtered = [float(p[1]) for p in peaks if p[1] > 0.1]
+        log.debug("Filtered strobes (>0.1s)", strobes_s=filtered)
+        if self._trace is not None:
+            self._decisions = {
+                "fps": fps,
+                "diff_std": diff_std,
+                "min_height": min_height,
+                "candidates": [[t, height] for _, t, height in self._candidates],
+                "peaks": [p[1] for p in peaks],
+            }
+        return sorted(filtered)
+
+    def trace(self) -> Optional[dict]:
+        """
+        Luminance curve recorded with `trace` (None otherwise): per-frame times
+        and ROI luminance, the local maxima considered as strobes with their
+        heights, and the threshold they had to clear. Call after finish().
+        """
+        if self._trace is None:
+            return None
+        return dict(self._decisions, times=[t for t, _ in self._trace], luminance=[l for _, l in self._trace])
+
+def _interval_ms(interval_s: float) -> int:
+    return round(interval_s * 1000)
+
+def _median_fps(intervals: Counter) -> float:
+    """Frame rate from the median of a PTS interval (ms) histogram; 30 without intervals."""
+    counts = sorted((ms, n) for ms, n in intervals.items() if ms > 0)
+    total = sum(n for _, n in counts)
+    if not total:
+        return 30.0
+    middle = []
+    seen = 0
+    for ms, n in counts:
+        seen += n
+        while len(middle) < 2 and seen > ((total - 1) // 2, total // 2)[len(middle)]:
+            middle.append(ms)
+        if len(middle) == 2:
+            break
+    return 2000.0 / (middle[0] + middle[1])
+
+def _select_by_distance(peaks: List[int], heights: List[float], distance: int) -> List[bool]:
+    """Same rule as find_peaks(distance=...): higher peaks suppress closer neighbours."""
+    keep = [True] * len(peaks)
+    # Ties go to the later peak, as find_peaks walks its argsort from the end
+    for j in sorted(range(len(peaks)), key=lambda k: (heights[k], k), reverse=True):
+        if not keep[j]:
+            continue
+        k = j - 1
+        while k >= 0 and peaks[j] - peaks[k] < distance:
+            keep[k] = False
+            k -= 1
+        k = j + 1
+        while k < len(peaks) and peaks[k] - peaks[j] < distance:
+            keep[k] = False
+            k += 1
+    return keep
+
 def calculate_ssim(video_path: str) -> float:
     # Placeholder for SSIM calculation between frames or vs reference
     # For PoC, we might just check if video has content
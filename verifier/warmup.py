@@ -0,0 +1,41 @@
+"""
+Startup warmup.
+
+Without it, the first verification after every deploy pays the imports of
+librosa, scipy, cv2 and PyAV, plus their first-call costs (codec setup,
+filter bank coefficients, BLAS initialisation). Instead, a one-second
+recording of the benchmark challenge is synthesized once (synthetic.py, kept
+in DATA_DIR/warmup). It then goes through the stages a verification uses: the
+single-pass analysis in every worker process as it starts, and the plan and
+screenshot encoding in the server process.
+"""
+import os
+from typing import Optional
+
+from logs import get_logger
+from synthetic import ClipSpec, clip_path, expected_events
+
+# A few frames around the first event of the benchmark challenge (0.64s)
+WARMUP_SPEC = ClipSpec(duration_s=1.0, resolution="480p", fps=15, codec="vp8", noise=0.1)
+
+log = get_logger("warmup")
+
+
+def warmup_clip(directory: str) -> str:
+    """Path of the warmup clip in `directory`, synthesized on first use."""
+    os.makedirs(directory, exist_ok=True)
+    return clip_path(WARMUP_SPEC, directory)
+
+
+def warm_worker(clip: Optional[str]):
+    """Analysis worker initializer: import the detectors and run them once on `clip`."""
+    from pipeline import analyze_clip
+
+    if clip is None:
+        return
+    freqs, times = expected_events()
+    try:
+        analyze_clip(clip, freqs[:1], times[:1], luma_step=2)
+    except Exception:
+        # A cold worker still works; don't take the pool down over its warmup
+        log.exception("Worker warmup failed", clip=clip)
@@ -0,0 +1,217 @@
+"""
+Bounded process pool for CPU-bound verification work.
+
+Decoding and detection run in worker processes so the FastAPI event loop
+stays free for /health, /history and the other requests. Admission is
+bounded: at most `workers` requests hold a worker and `queue_depth` more
+wait; anything beyond that is refused immediately with a Retry-After estimate
+instead of piling up behind the pool. Batch uploads wait for a slot instead
+(acquire), taking at most the workers' share so the wait queue stays open
+for single requests. With several server processes on one host, each job
+also holds one of the host-wide AnalysisSlots (shared.py) while it runs.
+"""
+import asyncio
+import collections
+import contextlib
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Deque, Optional
+
+from logs import get_logger
+from shared import AnalysisSlots
+
+# Job duration assumed before any job has finished (a 5s clip analyzes in well under this)
+INITIAL_JOB_ESTIMATE_S = 2.0
+# Weight of the newest job in the moving average used for Retry-After
+JOB_ESTIMATE_ALPHA = 0.2
+
+log = get_logger("pool")
+
+
+class PoolSaturated(Exception):
+    """All workers are busy and the wait queue is full."""
+
+    def __init__(self, retry_after_s: int):
+        super().__init__(f"verification queue is full, retry in {retry_after_s}s")
+        self.retry_after_s = retry_after_s
+
+
+class PoolUnavailable(Exception):
+    """The pool is shut down or a worker process died."""
+
+
+def _warm_up(warmup_clip: Optional[str] = None):
+    # Pay the numpy/librosa/PyAV import cost once per worker, not on the first job,
+    # and with a warmup clip the first-call costs too (see warmup.py)
+    import pipeline  # noqa: F401
+    if warmup_clip is not None:
+        from warmup import warm_worker
+        warm_worker(warmup_clip)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _timed(fn, args, kwargs):
+    started = time.monotonic()
+    result = fn(*args, **kwargs)
+    return result, time.monotonic() - started
+
+
+class AnalysisPool:
+    """
+    Process pool with bounded admission. The executor (spawn context, so
+    workers never inherit the server's threads or RPC connections) is
+    created on first use.
+    """
+
+    def __init__(self, workers: int, queue_depth: int, slots: Optional[AnalysisSlots] = None):
+        self.workers = max(1, workers)
+        self.queue_depth = max(0, queue_depth)
+        self.slots = slots
+        self.in_flight = 0
+        self.rejected = 0
+        self.job_estimate_s = INITIAL_JOB_ESTIMATE_S
+        self.warmup_clip: Optional[str] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._closed = False
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_depth
+
+    def retry_after_s(self) -> int:
+        """Seconds until a slot is likely free: queued jobs drained across the workers."""
+        waves = max(1, self.in_flight - self.workers + 1) / self.workers
+        return max(1, math.ceil(waves * self.job_estimate_s))
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._closed:
+            raise PoolUnavailable("analysis pool is shut down")
+        if self._executor is None:
+            log.info("Starting analysis workers", workers=self.workers, queue_depth=self.queue_depth)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_up,
+                initargs=(self.warmup_clip,),
+            )
+        return self._executor
+
+    async def start(self, warmup_clip: Optional[str] = None):
+        """
+        Start every worker now rather than on the first job, each running
+        `warmup_clip` through the detectors before it takes work (workers
+        started later, e.g. after a crash, warm up the same way).
+        """
+        self.warmup_clip = warmup_clip
+        executor = self._get_executor()
+        # Workers are spawned on demand; one concurrent ping per worker starts them all
+        pids = await asyncio.gather(*(asyncio.wrap_future(executor.submit(_ping)) for _ in range(self.workers)))
+        log.info("Analysis workers ready", workers=len(set(pids)), warmed=warmup_clip is not None)
+
+    def reserve(self):
+        """
+        Reserve a slot for one request, before its upload is read; pair with
+        release(). Raises PoolSaturated when every slot is taken and
+        PoolUnavailable after shutdown.
+        """
+        if self._closed:
+            raise PoolUnavailable("analysis pool is shut down")
+        if self.in_flight >= self.capacity:
+            self.rejected += 1
+            raise PoolSaturated(self.retry_after_s())
+        self.in_flight += 1
+
+    async def acquire(self, limit: Optional[int] = None):
+        """
+        reserve() that waits, first come first served, until fewer than
+        `limit` slots (default: one per worker) are taken, rather than
+        raising PoolSaturated. Raises PoolUnavailable after shutdown.
+        """
+        limit = min(self.capacity, limit or self.workers)
+        while not self._closed and self.in_flight >= limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()  # pass the wakeup on
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.reserve()
+
+    def _wake(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    @contextlib.contextmanager
+    def admit(self):
+        """reserve() for the duration of a block."""
+        self.reserve()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Run `fn(*args, **kwargs)` in a worker process (holding a reserved slot),
+        first waiting for a host-wide slot if there are any. `fn` and its
+        arguments must be picklable: module-level functions, paths and plain
+        values. Raises PoolUnavailable if a worker dies.
+        """
+        executor = self._get_executor()
+        slot = await self.slots.acquire() if self.slots is not None else None
+        try:
+            future = executor.submit(_timed, fn, args, kwargs)
+            result, elapsed = await asyncio.wrap_future(future)
+        except BrokenProcessPool as e:
+            # A worker died (e.g. OOM on a hostile upload); start fresh next time
+            log.error("Worker pool broken", error=str(e))
+            if self._executor is executor:
+                self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise PoolUnavailable("analysis worker crashed") from e
+        finally:
+            if slot is not None:
+                self.slots.release(slot)
+        self.job_estimate_s += JOB_ESTIMATE_ALPHA * (elapsed - self.job_estimate_s)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "rejected": self.rejected,
+            "job_estimate_s": round(self.job_estimate_s, 3),
+            "slots": self.slots.stats() if self.slots is not None else None,
+        }
+
+    def shutdown(self):
+        self._closed = True
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # wakes into reserve(), which raises PoolUnavailable
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
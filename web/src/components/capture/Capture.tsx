@@ -13,10 +13,18 @@ interface VerificationResult {
     challenge?: string;
     ipfs_cid?: string;
     screenshot_preview?: string;
+    ipfs_error?: string;
+    ipfs_status?: 'pending' | 'pinned' | 'failed';
+    pin_id?: string;
     metrics?: any;
     error?: string;
 }
 
+// How often a running verification job is polled
+const VERIFY_POLL_INTERVAL_MS = 500;
+// How often a pending screenshot pin is polled once the verdict is in
+const PIN_POLL_INTERVAL_MS = 2000;
+
 interface CaptureProps {
     disabled?: boolean;
     popAddress: string;
@@ -456,8 +464,9 @@ export const Capture: React.FC<CaptureProps> = ({ disabled, popAddress }) => {
         if (!state.challengeHash) return;
 
         const formData = new FormData();
-        formData.append('file', blob, 'capture.webm');
+        // pop_address first: the verifier starts the challenge lookup while the clip uploads
         formData.append('pop_address', popAddress);
+        formData.append('file', blob, 'capture.webm');
 
         try {
             const response = await fetch('/api/verify', {
@@ -465,8 +474,47 @@ export const Capture: React.FC<CaptureProps> = ({ disabled, popAddress }) => {
                 body: formData,
             });
 
-            const result = await response.json();
-            dispatch({ type: 'VERIFICATION_COMPLETE', result });
+            const accepted = await response.json();
+            if (!response.ok) {
+                throw new Error(accepted.detail || `Verifier unavailable (HTTP ${response.status})`);
+            }
+
+            // The verifier answers with a job id; poll it. The verdict is shown as soon
+            // as it is known; the screenshot is pinned in the background afterwards.
+            let result: VerificationResult | undefined;
+            while (true) {
+                await new Promise((resolve) => setTimeout(resolve, VERIFY_POLL_INTERVAL_MS));
+                const jobResponse = await fetch(`/api/verify/${accepted.job_id}`);
+                const job = await jobResponse.json();
+                if (!jobResponse.ok) {
+                    throw new Error(job.detail || `Verification job lost (HTTP ${jobResponse.status})`);
+                }
+                if (job.result) {
+                    result = job.result;
+                    dispatch({ type: 'VERIFICATION_COMPLETE', result: job.result });
+                }
+                if (job.status === 'complete' || job.status === 'failed') {
+                    if (!job.result) {
+                        dispatch({ type: 'VERIFICATION_COMPLETE', result: { verified: false, error: job.error } });
+                    }
+                    break;
+                }
+            }
+
+            // Sealing needs the CID: follow the pin until the uploader has it (or gave up)
+            while (result?.verified && result.pin_id && result.ipfs_status === 'pending') {
+                await new Promise((resolve) => setTimeout(resolve, PIN_POLL_INTERVAL_MS));
+                const pinResponse = await fetch(`/api/pins/${result.pin_id}`);
+                if (!pinResponse.ok) continue;
+                const pin = await pinResponse.json();
+                result = {
+                    ...result,
+                    ipfs_status: pin.status,
+                    ipfs_cid: pin.cid ?? undefined,
+                    ipfs_error: pin.status === 'failed' ? pin.error || 'Screenshot pinning failed' : undefined,
+                };
+                dispatch({ type: 'VERIFICATION_COMPLETE', result });
+            }
         } catch (error) {
             dispatch({
                 type: 'VERIFICATION_COMPLETE',
@@ -563,6 +611,14 @@ export const Capture: React.FC<CaptureProps> = ({ disabled, popAddress }) => {
                 };
             
             case 'verified':
+                // The verdict arrives before the screenshot is pinned; sealing needs the CID
+                if (!state.verificationResult?.ipfs_cid && !state.verificationResult?.ipfs_error) {
+                    return {
+                        label: 'Pinning screenshot...',
+                        icon: <Loader2 className="w-5 h-5 animate-spin" />,
+                        disabled: true,
+                    };
+                }
                 return {
                     label: 'Seal On-Chain',
                     icon: <Upload className="w-5 h-5" />,